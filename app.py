@@ -1,19 +1,35 @@
 import streamlit as st
-import requests
+# requests, PyPDF2, python-docx, lxml и Pillow импортируются в функциях при первом использовании:
+# холодный старт и перезапуски скрипта, которым они не нужны, их не загружают
 import json
-from PyPDF2 import PdfReader
-from docx import Document
-from bs4 import BeautifulSoup
 import io
+import html
+import os
+import sys
+import csv
+import zipfile
+import argparse
+import copy
 import base64
 import re
 import time
 from urllib.parse import urlparse
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 import hashlib
+import uuid
+import difflib
+import unicodedata
+import sqlite3
 import threading
+import asyncio
+import functools
+import bisect
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from collections import OrderedDict, deque, namedtuple
 from queue import Queue
+from contextlib import contextmanager
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -27,6 +43,7 @@ FREE_TIER_CONFIG = {
             "priority": 1,  # Самый высокий приоритет (максимальный RPD ~1000)
             "rpm": 15,  # Запросов в минуту
             "tpm": 250000,  # Токенов в минуту
+            "rpd": 1000,  # Запросов в день
             "price_input": 0.0,
             "price_output": 0.0
         },
@@ -34,6 +51,7 @@ FREE_TIER_CONFIG = {
             "priority": 2,  # Средний приоритет (RPD ~20-50)
             "rpm": 10,
             "tpm": 250000,
+            "rpd": 50,
             "price_input": 0.0,
             "price_output": 0.0
         },
@@ -41,6 +59,7 @@ FREE_TIER_CONFIG = {
             "priority": 3,  # Низкий приоритет (резерв)
             "rpm": 15,
             "tpm": 250000,
+            "rpd": 200,
             "price_input": 0.0,
             "price_output": 0.0
         }
@@ -51,52 +70,2961 @@ FREE_TIER_CONFIG = {
     }
 }
 
+# ==================== ЛОКАЛЬНОЕ ХРАНИЛИЩЕ ====================
+# Все процессы и сессии на узле используют общий каталог с SQLite-базами
+DATA_DIR = os.environ.get(
+    "LEGALAI_DATA_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".legalai")
+)
+
+def open_sqlite(name):
+    """Подключение к SQLite-базе в режиме WAL (общей для всех процессов узла).
+    name — имя файла в DATA_DIR или абсолютный путь"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(
+        os.path.join(DATA_DIR, name),
+        timeout=30,
+        isolation_level=None,  # Транзакции управляются явно
+        check_same_thread=False
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def quota_day(now=None):
+    """Текущие сутки квоты: RPD сбрасывается в полночь по тихоокеанскому времени"""
+    now = now or datetime.now(timezone.utc)
+    try:
+        pacific = ZoneInfo("America/Los_Angeles")
+    except Exception:
+        pacific = timezone(timedelta(hours=-8))
+    local = now.astimezone(pacific) - timedelta(hours=FREE_TIER_CONFIG["global_limits"]["reset_time_hours"])
+    return local.date().isoformat()
+
+# Слова (любой алфавит), числа и отдельные знаки пунктуации
+TOKEN_PATTERN = re.compile(r"[^\W\d_]+|\d+|[^\w\s]")
+
+def estimate_tokens(text):
+    """Оценка числа токенов: латиница ~4 символа на токен, кириллица и числа ~3, знак — 1"""
+    tokens = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        word = match.group()
+        if word.isascii() and word.isalpha():
+            tokens += -(-len(word) // 4)
+        elif word[0].isalnum():
+            tokens += -(-len(word) // 3)
+        else:
+            tokens += 1
+    return max(1, tokens)
+
+class SlidingWindow:
+    """Скользящее окно лимитов одной модели: запросы (RPM) и токены (TPM) за минуту"""
+
+    def __init__(self, rpm, tpm, period=60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.period = period
+        self.events = deque()  # (время, токены) в порядке поступления
+        self.tokens = 0
+
+    def add(self, ts, tokens):
+        self.events.append((ts, tokens))
+        self.tokens += tokens
+
+    def evict(self, now):
+        """Удаление событий старше окна — амортизированно O(1)"""
+        horizon = now - self.period
+        while self.events and self.events[0][0] <= horizon:
+            self.tokens -= self.events.popleft()[1]
+
+    def has_room(self, now, tokens):
+        self.evict(now)
+        tokens = min(tokens, self.tpm)
+        return len(self.events) < self.rpm and self.tokens + tokens <= self.tpm
+
+    def wait_time(self, now, tokens):
+        """Точное время до освобождения слота под запрос с заданным числом токенов"""
+        self.evict(now)
+        tokens = min(tokens, self.tpm)
+        wait = 0.0
+        if len(self.events) >= self.rpm:
+            ts = self.events[len(self.events) - self.rpm][0]
+            wait = ts + self.period - now
+        excess = self.tokens + tokens - self.tpm
+        if excess > 0:
+            for ts, used in self.events:
+                excess -= used
+                if excess <= 0:
+                    wait = max(wait, ts + self.period - now)
+                    break
+        return max(0.0, wait)
+
 # Менеджер лимитов
 class RateLimitManager:
-    def __init__(self):
-        self.requests_log = []
+    """Журнал квот в SQLite: счетчики RPM, TPM и RPD общие для всех сессий и процессов.
+
+    Каждый процесс держит зеркало журнала в окнах SlidingWindow и подтягивает
+    из базы только новые события, поэтому допуск запроса не пересчитывает журнал.
+    config — лимиты моделей (по умолчанию FREE_TIER_CONFIG); их же читают планировщик и клиент.
+    """
+
+    def __init__(self, db_name="quota.sqlite3", config=FREE_TIER_CONFIG):
+        self.config = config
+        self.lock = threading.Lock()
+        self.conn = open_sqlite(db_name)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS rate_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts REAL NOT NULL,
+                model TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS rate_events_model_ts ON rate_events (model, ts);
+            CREATE TABLE IF NOT EXISTS daily_usage (
+                day TEXT PRIMARY KEY,
+                requests INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS model_cooldowns (
+                model TEXT PRIMARY KEY,
+                until REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS model_daily_usage (
+                day TEXT NOT NULL,
+                model TEXT NOT NULL,
+                requests INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, model)
+            );
+        """)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(rate_events)")}
+        if "tokens" not in columns:
+            self.conn.execute("ALTER TABLE rate_events ADD COLUMN tokens INTEGER NOT NULL DEFAULT 0")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS rate_events_ts ON rate_events (ts)")
+        self.windows = {
+            model: SlidingWindow(cfg["rpm"], cfg["tpm"])
+            for model, cfg in config["models"].items()
+        }
+        self.cooldowns = {}
+        self.last_event_id = 0
+        self.last_cleanup = 0.0
+
+    def _transaction(self):
+        """Эксклюзивная транзакция: атомарна между процессами"""
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def _sync(self, now):
+        """Подтягивание событий, записанных другими процессами"""
+        rows = self.conn.execute(
+            "SELECT id, ts, model, tokens FROM rate_events WHERE id > ? ORDER BY id",
+            (self.last_event_id,)
+        ).fetchall()
+        horizon = now - 60
+        for event_id, ts, model, tokens in rows:
+            self.last_event_id = event_id
+            if ts > horizon and model in self.windows:
+                self.windows[model].add(ts, tokens)
+        self.cooldowns = dict(self.conn.execute(
+            "SELECT model, until FROM model_cooldowns WHERE until > ?", (now,)
+        ).fetchall())
+
+    @property
+    def daily_requests(self):
+        """Число запросов за текущие сутки квоты"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT requests FROM daily_usage WHERE day = ?", (quota_day(),)
+            ).fetchone()
+            return row[0] if row else 0
+
+    def check_daily_limit(self):
+        """Проверка дневного лимита запросов"""
+        limit = self.config["global_limits"]["daily_request_limit"]
+        day = quota_day()
+        with self.lock:
+            self._transaction()
+            try:
+                row = self.conn.execute(
+                    "SELECT requests FROM daily_usage WHERE day = ?", (day,)
+                ).fetchone()
+                if row and row[0] >= limit:
+                    self.conn.execute("ROLLBACK")
+                    return False
+                self.conn.execute(
+                    "INSERT INTO daily_usage (day, requests) VALUES (?, 1) "
+                    "ON CONFLICT(day) DO UPDATE SET requests = requests + 1",
+                    (day,)
+                )
+                # Старые сутки больше не нужны
+                self.conn.execute("DELETE FROM daily_usage WHERE day < ?", (day,))
+                self.conn.execute("COMMIT")
+                return True
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _model_daily(self, day):
+        return dict(self.conn.execute(
+            "SELECT model, requests FROM model_daily_usage WHERE day = ?", (day,)
+        ).fetchall())
+
+    def acquire(self, models, tokens):
+        """Допуск запроса: первая по порядку модель с запасом RPM/TPM/RPD.
+
+        Возвращает (модель, 0) или (None, минимальное время ожидания слота).
+        """
+        day = quota_day()
+        with self.lock:
+            now = time.time()
+            self._transaction()
+            try:
+                self._sync(now)
+                used_today = self._model_daily(day)
+                waits = []
+                for model in models:
+                    if used_today.get(model, 0) >= self.config["models"][model]["rpd"]:
+                        continue  # Дневная квота модели исчерпана
+                    window = self.windows[model]
+                    cooldown = self.cooldowns.get(model, 0) - now
+                    if cooldown <= 0 and window.has_room(now, tokens):
+                        cur = self.conn.execute(
+                            "INSERT INTO rate_events (ts, model, tokens) VALUES (?, ?, ?)",
+                            (now, model, tokens)
+                        )
+                        self.last_event_id = cur.lastrowid
+                        window.add(now, tokens)
+                        self.conn.execute(
+                            "INSERT INTO model_daily_usage (day, model, requests) VALUES (?, ?, 1) "
+                            "ON CONFLICT(day, model) DO UPDATE SET requests = requests + 1",
+                            (day, model)
+                        )
+                        # Очистка журнала не чаще раза в минуту
+                        if now - self.last_cleanup > 60:
+                            self.conn.execute("DELETE FROM rate_events WHERE ts <= ?", (now - 60,))
+                            self.conn.execute("DELETE FROM model_cooldowns WHERE until <= ?", (now,))
+                            self.conn.execute("DELETE FROM model_daily_usage WHERE day < ?", (day,))
+                            self.last_cleanup = now
+                        self.conn.execute("COMMIT")
+                        return model, 0
+                    waits.append(max(cooldown, window.wait_time(now, tokens)))
+                self.conn.execute("COMMIT")
+                if not waits:
+                    # У всех моделей исчерпан RPD: ждать в пределах суток бессмысленно
+                    return None, None
+                return None, min(waits)
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def headroom(self, models, tokens=0):
+        """Запас по моделям: {модель: (ожидание слота RPM/TPM, остаток RPD)}"""
+        day = quota_day()
+        with self.lock:
+            now = time.time()
+            self._sync(now)
+            used_today = self._model_daily(day)
+            return {
+                model: (
+                    max(0, self.cooldowns.get(model, 0) - now, self.windows[model].wait_time(now, tokens)),
+                    self.config["models"][model]["rpd"] - used_today.get(model, 0)
+                )
+                for model in models
+            }
+
+    def cool_down(self, model, seconds):
+        """Временное исключение модели (429 или таймаут) для всех процессов"""
+        until = time.time() + seconds
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO model_cooldowns (model, until) VALUES (?, ?) "
+                "ON CONFLICT(model) DO UPDATE SET until = MAX(until, excluded.until)",
+                (model, until)
+            )
+            self.cooldowns[model] = max(self.cooldowns.get(model, 0), until)
+
+    def get_wait_time(self, model, tokens=0):
+        """Время ожидания при превышении RPM/TPM"""
+        with self.lock:
+            now = time.time()
+            self._sync(now)
+            cooldown = self.cooldowns.get(model, 0) - now
+            return max(0, cooldown, self.windows[model].wait_time(now, tokens))
+
+    def reset_daily(self):
+        """Ручной сброс дневного счетчика"""
+        with self.lock:
+            self.conn.execute("DELETE FROM daily_usage WHERE day = ?", (quota_day(),))
+        logger.info("Счетчик дневных запросов сброшен")
+
+@st.cache_resource
+def get_limit_manager():
+    """Один менеджер лимитов на процесс: переживает перезапуски скрипта Streamlit"""
+    return RateLimitManager()
+
+# Инициализация менеджера лимитов
+limit_manager = get_limit_manager()
+
+# ==================== ПОСТОЯННЫЙ КЭШ РЕЗУЛЬТАТОВ ====================
+# Версия промптов: меняется при правке текстов промптов, чтобы не отдавать старые ответы
+PROMPT_VERSION = "2026.10"
+
+def normalize_for_digest(text):
+    """Нормализация текста перед хешированием: Unicode NFC и схлопывание пробелов"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def content_digest(content):
+    """SHA-256 полного содержимого документа (текст нормализуется, байты берутся как есть)"""
+    if isinstance(content, str):
+        content = normalize_for_digest(content).encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+def cache_key(kind, content, **params):
+    """Адрес результата: дайджест документа + параметры запроса, версия промптов и модели"""
+    models = sorted(FREE_TIER_CONFIG["models"], key=lambda m: FREE_TIER_CONFIG["models"][m]["priority"])
+    material = json.dumps({
+        "kind": kind,
+        "digest": content_digest(content),
+        "params": params,
+        "prompt_version": PROMPT_VERSION,
+        "models": models,
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """Content-addressed кэш ответов в SQLite с LRU-вытеснением по размеру и счетчиками"""
+
+    def __init__(self, db_name="cache.sqlite3", max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = open_sqlite(db_name)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed);
+            CREATE TABLE IF NOT EXISTS cache_stats (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+
+    def _count(self, name, delta=1):
+        self.conn.execute(
+            "INSERT INTO cache_stats (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, delta)
+        )
+
+    def get(self, key):
+        """Результат по ключу или None; обращение продлевает жизнь записи"""
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row:
+                self.conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._count("hits" if row else "misses")
+        metrics.inc("legalai_cache_requests_total", cache="results", result="hit" if row else "miss")
+        return row[0] if row else None
+
+    def put(self, key, value):
+        """Сохранение результата и вытеснение самых старых записей сверх лимита"""
+        size = len(value.encode("utf-8"))
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO results (key, value, size, created, accessed) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, value, size, now, now)
+                )
+                total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+                if total > self.max_bytes:
+                    evicted = 0
+                    for old_key, old_size in self.conn.execute(
+                        "SELECT key, size FROM results ORDER BY accessed"
+                    ).fetchall():
+                        if total <= self.max_bytes:
+                            break
+                        self.conn.execute("DELETE FROM results WHERE key = ?", (old_key,))
+                        total -= old_size
+                        evicted += 1
+                    self._count("evictions", evicted)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def stats(self):
+        """Счетчики попаданий/промахов и занятый объем"""
+        with self.lock:
+            stats = dict(self.conn.execute("SELECT name, value FROM cache_stats").fetchall())
+            entries, size = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+            ).fetchone()
+        stats.update(entries=entries, bytes=size)
+        return stats
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM results")
+
+# ==================== ПОДГОТОВКА ИЗОБРАЖЕНИЙ ====================
+IMAGE_MAX_SIDE = 1536       # Больше модель все равно не различает: плитки по 768 px
+IMAGE_TILE_SIDE = 768
+IMAGE_PAGE_RATIO = 1.5      # Высота "страницы" при нарезке длинных сканов (A4 ≈ 1.41)
+IMAGE_MAX_TILES = 8
+IMAGE_QUALITY = 80
+
+PreparedImage = namedtuple("PreparedImage", "parts tokens source_bytes payload_bytes")
+
+@functools.lru_cache(maxsize=None)
+def image_format():
+    """Формат и MIME-тип для отправки: WebP, если Pillow собран с ним, иначе JPEG"""
+    from PIL import features
+    return ("WEBP", "image/webp") if features.check("webp") else ("JPEG", "image/jpeg")
+
+def image_tokens(width, height):
+    """Стоимость изображения: до 384 px — 258 токенов, крупнее — по 258 на плитку 768×768"""
+    if width <= 384 and height <= 384:
+        return 258
+    return -(-width // IMAGE_TILE_SIDE) * -(-height // IMAGE_TILE_SIDE) * 258
+
+def _image_frames(image):
+    """Кадры изображения (многостраничный TIFF) с учетом EXIF-поворота, в RGB или оттенках серого.
+    Прозрачные области накладываются на белый фон: при отбрасывании альфа-канала они чернеют."""
+    from PIL import Image, ImageOps, ImageSequence
+    for frame in ImageSequence.Iterator(image):
+        frame = ImageOps.exif_transpose(frame)
+        mode = "L" if frame.mode in ("1", "L", "LA", "I", "I;16") else "RGB"
+        if frame.mode in ("RGBA", "LA", "PA", "La", "RGBa") or "transparency" in frame.info:
+            frame = frame.convert("RGBA")
+            frame = Image.alpha_composite(Image.new("RGBA", frame.size, "white"), frame)
+        yield frame.convert(mode)
+
+def _split_tall(frame):
+    """Длинный скан (несколько страниц подряд) режется на страницы с небольшим перекрытием"""
+    width, height = frame.size
+    page = int(width * IMAGE_PAGE_RATIO)
+    if height <= page * 1.3:
+        return [frame]
+    overlap = page // 20  # Строка на границе попадет в обе части
+    count = -(-(height - overlap) // (page - overlap))
+    if count > IMAGE_MAX_TILES:
+        # Частей больше лимита: части выше страницы, чтобы покрыть весь скан без пропусков
+        count = IMAGE_MAX_TILES
+        page = -(-(height + (count - 1) * overlap) // count)
+    step = (height - page) / max(1, count - 1)
+    return [frame.crop((0, int(i * step), width, min(height, int(i * step) + page))) for i in range(count)]
+
+def prepare_image(content, max_side=IMAGE_MAX_SIDE):
+    """Изображение для запроса: поворот по EXIF, уменьшение до рабочего разрешения,
+    нарезка длинных сканов и перекодирование. Возвращает PreparedImage"""
+    from PIL import Image
+    image_type, mime = image_format()
+    with Image.open(io.BytesIO(content)) as image:
+        tiles = [tile for frame in _image_frames(image) for tile in _split_tall(frame)]
+    if len(tiles) > IMAGE_MAX_TILES:
+        # Слишком много страниц: каждая уменьшается сильнее, общий объем тот же
+        max_side = max(IMAGE_TILE_SIDE, int(max_side * (IMAGE_MAX_TILES / len(tiles)) ** 0.5))
+    parts, tokens = [], 0
+    for tile in tiles:
+        tile.thumbnail((max_side, max_side), Image.LANCZOS)
+        buffer = io.BytesIO()
+        tile.save(buffer, image_type, quality=IMAGE_QUALITY)
+        parts.append((mime, base64.b64encode(buffer.getvalue()).decode("ascii")))
+        tokens += image_tokens(*tile.size)
+    return PreparedImage(parts, tokens, len(content), sum(len(data) for _, data in parts))
+
+# ==================== НАСТРОЙКИ И ТЕЛО ЗАПРОСА ====================
+def get_setting(name, default=None):
+    """Настройка из переменных окружения или st.secrets"""
+    value = os.environ.get(name)
+    if value:
+        return value
+    try:
+        return st.secrets.get(name, default)
+    except Exception:  # Нет secrets.toml (например, запуск без Streamlit)
+        return default
+
+def http_session(pool_connections, pool_maxsize, headers=None):
+    """Сессия requests с пулом keep-alive соединений"""
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    session.headers.update(headers or {})
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def build_payload(prompt, content, is_image=False):
+    """Тело запроса generateContent с ограничениями Free Tier (для изображений content — PreparedImage)"""
+    if is_image:
+        return {
+            "contents": [{
+                "parts": [{"text": compact_prompt(prompt)}] + [
+                    {"inline_data": {"mime_type": mime_type, "data": data}}
+                    for mime_type, data in content.parts
+                ]
+            }],
+            "generationConfig": {
+                "temperature": 0.1,
+                "maxOutputTokens": 1024,  # Ограничиваем вывод
+                "topP": 0.8
+            }
+        }
+    return {
+        "contents": [{
+            "parts": [{"text": f"{compact_prompt(prompt)}\n\nТЕКСТ:\n{content}"}]
+        }],
+        "generationConfig": {
+            "temperature": 0.2,
+            "maxOutputTokens": 2048,  # Лимит вывода
+            "topP": 0.9
+        }
+    }
+
+# ==================== МЕТРИКИ ====================
+# Описание метрик для экспорта: имя -> (тип, пояснение)
+METRIC_HELP = {
+    "legalai_extract_pages_total": ("counter", "Извлеченные страницы (части DOCX) по формату"),
+    "legalai_extract_errors_total": ("counter", "Ошибки извлечения страниц по формату"),
+    "legalai_extract_page_seconds": ("histogram", "Время извлечения одной страницы"),
+    "legalai_cache_requests_total": ("counter", "Обращения к кэшам: cache, result=hit|miss"),
+    "legalai_api_request_seconds": ("histogram", "Длительность запроса к модели по исходу"),
+    "legalai_api_retries_total": ("counter", "Повторные запросы к той же модели"),
+    "legalai_api_fallbacks_total": ("counter", "Переходы на следующую модель"),
+    "legalai_backoff_sleep_seconds_total": ("counter", "Время ожидания свободной квоты"),
+    "legalai_api_tokens_total": ("counter", "Токены по usageMetadata: kind=prompt|output"),
+    "legalai_singleflight_total": ("counter", "Вызовы модели: result=leader|coalesced|negative"),
+    "legalai_jobs_total": ("counter", "Фоновые задачи: status=submitted|deduplicated|done|error"),
+    "legalai_index_search_seconds": ("histogram", "Поиск фрагментов в индексе прошлых анализов"),
+}
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metrics:
+    """Счетчики и гистограммы процесса с метками; выгрузка в текстовом формате Prometheus"""
+
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    hist["buckets"][index] += 1
+                    break
+            hist["count"] += 1
+            hist["sum"] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        """Копия счетчиков и гистограмм для отображения"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: {"buckets": list(h["buckets"]), "count": h["count"], "sum": h["sum"]}
+                          for key, h in self.histograms.items()}
+        return counters, histograms
+
+    def quantile(self, hist, q):
+        """Оценка квантиля по корзинам гистограммы (верхняя граница корзины)"""
+        target, seen = hist["count"] * q, 0
+        for bound, count in zip(self.buckets, hist["buckets"]):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    @staticmethod
+    def format_value(value):
+        """Число для экспозиции и панели метрик: целые без экспоненты, дробные через repr (без потери точности)"""
+        if isinstance(value, int) or float(value).is_integer():
+            return str(int(value))
+        return repr(float(value))
+
+    def render_prometheus(self):
+        """Текстовый формат экспозиции Prometheus"""
+        counters, histograms = self.snapshot()
+        labels = lambda pairs, extra=(): "{" + ",".join(
+            f'{k}="{v}"' for k, v in pairs + tuple(extra)
+        ) + "}" if pairs or extra else ""
+        lines = []
+        for name, (kind, help_text) in METRIC_HELP.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            if kind == "counter":
+                for (metric, pairs), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{labels(pairs)} {self.format_value(value)}")
+                continue
+            for (metric, pairs), hist in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets, hist["buckets"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{labels(pairs, [('le', self.format_value(bound))])} {cumulative}")
+                lines.append(f"{name}_bucket{labels(pairs, [('le', '+Inf')])} {hist['count']}")
+                lines.append(f"{name}_sum{labels(pairs)} {self.format_value(hist['sum'])}")
+                lines.append(f"{name}_count{labels(pairs)} {hist['count']}")
+        return "\n".join(lines) + "\n"
+
+@st.cache_resource
+def get_metrics():
+    """Одни метрики на процесс: переживают перезапуски скрипта Streamlit"""
+    return Metrics()
+
+metrics = get_metrics()
+
+@st.cache_resource
+def start_metrics_exporter(port):
+    """HTTP-эндпоинт /metrics для Prometheus в фоновом потоке (один на процесс)"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    try:
+        server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    except OSError as e:
+        logger.error(f"Экспорт метрик на порту {port} недоступен: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-exporter", daemon=True).start()
+    logger.info(f"Метрики Prometheus: http://0.0.0.0:{port}/metrics")
+    return server
+
+# Последний вызов st.cache_data в этом потоке выполнил функцию (промах), а не взял из кэша
+_cache_calls = threading.local()
+
+def counted_cache_data(cache_name, **cache_options):
+    """st.cache_data со счетчиком попаданий и промахов в метриках"""
+    def decorate(func):
+        @functools.wraps(func)
+        def compute(*args, **kwargs):
+            _cache_calls.miss = True
+            return func(*args, **kwargs)
+        cached = st.cache_data(**cache_options)(compute)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            _cache_calls.miss = False
+            result = cached(*args, **kwargs)
+            metrics.inc("legalai_cache_requests_total", cache=cache_name,
+                        result="miss" if _cache_calls.miss else "hit")
+            return result
+        wrapper.clear = cached.clear
+        return wrapper
+    return decorate
+
+# Экспорт для Prometheus включается портом: LEGALAI_METRICS_PORT=9108
+if get_setting("LEGALAI_METRICS_PORT"):
+    start_metrics_exporter(int(get_setting("LEGALAI_METRICS_PORT")))
+
+# ==================== ПЛАНИРОВЩИК МОДЕЛЕЙ ====================
+class ModelHealth:
+    """Скользящая статистика модели: задержки, доля ошибок и предохранитель (circuit breaker)"""
+
+    def __init__(self, window=50, failure_threshold=3, open_seconds=30, max_open_seconds=300):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)  # True — успешный ответ
+        self.failure_threshold = failure_threshold
+        self.base_open_seconds = open_seconds
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.probe_until = 0.0
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def state(self, now):
+        if now < self.open_until:
+            return "open"
+        if self.consecutive_failures >= self.failure_threshold:
+            return "half-open"
+        return "closed"
+
+    def available(self, now):
+        """Закрытый предохранитель или полуоткрытый без идущей пробы"""
+        state = self.state(now)
+        return state == "closed" or (state == "half-open" and now >= self.probe_until)
+
+    def record(self, ok, latency, now):
+        self.outcomes.append(ok)
+        self.probe_until = 0.0
+        if ok:
+            self.latencies.append(latency)
+            self.consecutive_failures = 0
+            self.open_seconds = self.base_open_seconds
+            return
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            # Размыкание с растущей паузой, пока модель не ответит успешно
+            self.open_until = now + self.open_seconds
+            self.open_seconds = min(self.open_seconds * 2, self.max_open_seconds)
+
+class ModelScheduler:
+    """Адаптивный выбор модели по живой задержке, доле ошибок, предохранителям и остатку квот"""
+
+    def __init__(self, limiter, prior_latency=8.0, probe_timeout=30):
+        self.limiter = limiter
+        self.prior_latency = prior_latency
+        self.probe_timeout = probe_timeout
+        self.lock = threading.Lock()
+        self.models = limiter.config["models"]
+        self.health = {model: ModelHealth() for model in self.models}
+
+    def _expected_latency(self, model, health):
+        """Медиана задержки (без статистики — априорная оценка по приоритету) с учетом повторов"""
+        p50 = self.percentile_or_prior(model, health, 0.5)
+        return p50 / (1 - min(health.error_rate, 0.9))
+
+    def percentile_or_prior(self, model, health, q):
+        if len(health.latencies) >= 3:
+            return health.percentile(q)
+        return self.prior_latency * (1 + 0.1 * self.models[model]["priority"])
+
+    def rank(self, models, tokens):
+        """Модели по ожидаемому времени ответа в пределах бюджета.
+
+        Возвращает (список, 0) или ([], ожидание до пробы предохранителя);
+        ожидание None — у всех моделей исчерпан RPD.
+        """
+        now = time.time()
+        headroom = self.limiter.headroom(models, tokens)
+        scored, reopen = [], []
+        with self.lock:
+            for model in models:
+                health = self.health[model]
+                wait, rpd_left = headroom[model]
+                if rpd_left <= 0:
+                    continue
+                if not health.available(now):
+                    reopen.append(max(health.open_until, health.probe_until) - now)
+                    continue
+                expected = wait + self._expected_latency(model, health)
+                # Редкую дневную квоту бережем: штраф, когда остается меньше 20%
+                share = rpd_left / self.models[model]["rpd"]
+                expected *= 1 + max(0.0, 0.2 - share) * 5
+                scored.append((expected, self.models[model]["priority"], model))
+        if scored:
+            return [model for _, _, model in sorted(scored)], 0
+        return [], max(0.0, min(reopen)) if reopen else None
+
+    def begin(self, model):
+        """Отметка пробного запроса к полуоткрытой модели"""
+        now = time.time()
+        with self.lock:
+            health = self.health[model]
+            if health.state(now) == "half-open":
+                health.probe_until = now + self.probe_timeout
+
+    def record(self, model, ok, latency):
+        with self.lock:
+            self.health[model].record(ok, latency, time.time())
+
+    def hedge_delay(self, model):
+        """Через сколько секунд дублировать запрос: p95 задержки модели"""
+        with self.lock:
+            health = self.health[model]
+            return min(20.0, max(3.0, self.percentile_or_prior(model, health, 0.95)))
+
+    def snapshot(self):
+        """Состояние моделей для интерфейса"""
+        now = time.time()
+        with self.lock:
+            return {
+                model: {
+                    "p50": health.percentile(0.5),
+                    "p95": health.percentile(0.95),
+                    "error_rate": health.error_rate,
+                    "state": health.state(now),
+                }
+                for model, health in self.health.items()
+            }
+
+# ==================== КЛИЕНТ GEMINI ====================
+# Маркер в потоке фрагментов: накопленный частичный ответ нужно сбросить
+STREAM_RESET = object()
+
+# Ошибки, которые не исправит повтор того же запроса: их помнит негативный кэш
+ERROR_BAD_IMAGE = "❌ Не удалось обработать изображение"
+ERROR_DAILY_LIMIT = "⚠️ Достигнут дневной лимит запросов. Попробуйте завтра."
+ERROR_INTERNAL = "⚠️ Внутренняя ошибка запроса"
+ERROR_REJECTED = "❌ Все модели отклонили запрос (ошибка 4xx). Проверьте документ."
+DETERMINISTIC_ERRORS = (ERROR_BAD_IMAGE, ERROR_REJECTED)
+
+class GeminiClient:
+    """Клиент Gemini: пул keep-alive соединений и фоновый event loop.
+
+    Повторы, паузы и переключение моделей выполняются корутинами в отдельном
+    потоке, поэтому поток скрипта Streamlit не спит, а несколько запросов
+    могут выполняться одновременно. Модель для каждого запроса выбирает
+    ModelScheduler. Модели и их лимиты берутся из limiter.config.
+    """
+
+    def __init__(self, limiter, base_url, pool_size=16, timeout=30, api_key=None):
+        self.limiter = limiter
+        self._api_key = api_key
+        self.scheduler = ModelScheduler(limiter)
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._session = None
+        self._session_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="gemini-http")
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name="gemini-loop", daemon=True)
+        self.loop_thread.start()
+        # Подготовленные изображения: повторы, смена модели и новый анализ не кодируют их заново
+        self.images = OrderedDict()
+        self.images_lock = threading.Lock()
+
+    @property
+    def api_key(self):
+        """Ключ, переданный клиенту, иначе GOOGLE_API_KEY из настроек"""
+        return self._api_key or get_setting("GOOGLE_API_KEY")
+
+    @property
+    def session(self):
+        """HTTP-сессия создается при первом запросе к модели"""
+        with self._session_lock:
+            if self._session is None:
+                self._session = http_session(len(self.limiter.config["models"]), self.pool_size)
+            return self._session
+
+    def close(self):
+        """Останавливает event loop, пул потоков и закрывает HTTP-сессию"""
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+            self.loop.close()
+        self.executor.shutdown(wait=True)
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    async def _post(self, url, payload, api_key):
+        """HTTP-запрос в пуле потоков через общую сессию"""
+        return await self.loop.run_in_executor(self.executor, functools.partial(
+            self.session.post, url, json=payload, timeout=self.timeout,
+            headers={"x-goog-api-key": api_key}
+        ))
+
+    def _handle_failure(self, model, status, retry_after, error_msg, retry):
+        """Реакция на неуспешный ответ; возвращает True, если модель больше не пробовать"""
+        if status == 429:
+            # Обработка Rate Limit: модель уходит в паузу, запрос идет на следующую
+            retry_after = int(retry_after or 60)
+            logger.warning(f"Rate limit для {model}. Пауза модели {retry_after} сек")
+            self.limiter.cool_down(model, retry_after)
+            return False
+        if status >= 500:
+            logger.error(f"Ошибка сервера {model}: {status}, попытка {retry+1}")
+            self.limiter.cool_down(model, 2 ** retry)
+            return False
+        logger.error(f"Ошибка {model}: {status} - {error_msg}")
+        return True
+
+    @staticmethod
+    def _error_message(response):
+        try:
+            return response.json().get('error', {}).get('message', 'Unknown')
+        except ValueError:
+            return response.text[:200] or 'Unknown'
+
+    async def _attempt(self, model, payload, api_key, retry):
+        """Один запрос к модели; возвращает (модель, текст или None, сбой).
+
+        Сбой: None — можно повторить, "rejected" — модель отклонила запрос (4xx),
+        "fatal" — непредвиденная ошибка, модель больше не пробовать.
+        """
+        import requests
+        self.scheduler.begin(model)
+        started = time.monotonic()
+        ok, text, failure, outcome = False, None, None, "error"
+        try:
+            url = f"{self.base_url}/models/{model}:generateContent"
+            response = await self._post(url, payload, api_key)
+            outcome = self._outcome(response.status_code)
+            
+            if response.status_code == 200:
+                ok = True
+                result = response.json()
+                if 'candidates' in result and result['candidates']:
+                    text = result['candidates'][0]['content']['parts'][0]['text']
+                    logger.info(f"Успешно: {model}, токены: {self._usage(model, result.get('usageMetadata'), text)}")
+            else:
+                if self._handle_failure(
+                    model, response.status_code, response.headers.get('Retry-After'),
+                    self._error_message(response), retry
+                ):
+                    failure = "rejected"
+                
+        except requests.exceptions.Timeout:
+            outcome = "timeout"
+            logger.warning(f"Таймаут {model}, попытка {retry+1}")
+            self.limiter.cool_down(model, 2 ** retry)  # Exponential backoff
+        except requests.RequestException as e:
+            # Сетевой сбой не говорит о запросе ничего: как таймаут, модель пробуется позже
+            logger.warning(f"Сетевая ошибка {model}, попытка {retry+1}: {e}")
+            self.limiter.cool_down(model, 2 ** retry)
+        except Exception as e:
+            logger.error(f"Ошибка {model}: {str(e)}")
+            failure = "fatal"
+        elapsed = time.monotonic() - started
+        self.scheduler.record(model, ok, elapsed)
+        metrics.observe("legalai_api_request_seconds", elapsed, model=model, outcome=outcome)
+        return model, text, failure
+
+    @staticmethod
+    def _outcome(status):
+        """Метка исхода запроса для метрик"""
+        if status == 200:
+            return "ok"
+        if status == 429:
+            return "429"
+        return "5xx" if status >= 500 else "4xx"
+
+    def _usage(self, model, usage, text):
+        """Учет фактических токенов из usageMetadata; строка для журнала"""
+        if not usage:
+            return f"~{estimate_tokens(text)}"
+        prompt, output = usage.get("promptTokenCount", 0), usage.get("candidatesTokenCount", 0)
+        metrics.inc("legalai_api_tokens_total", prompt, model=model, kind="prompt")
+        metrics.inc("legalai_api_tokens_total", output, model=model, kind="output")
+        return f"{prompt} + {output}"
+
+    def _consume_stream(self, model, payload, api_key, sink):
+        """Чтение SSE-ответа streamGenerateContent; фрагменты текста сразу уходят в sink"""
+        url = f"{self.base_url}/models/{model}:streamGenerateContent?alt=sse"
+        with self.session.post(url, json=payload, timeout=self.timeout, stream=True,
+                               headers={"x-goog-api-key": api_key}) as response:
+            if response.status_code != 200:
+                return (response.status_code, response.headers.get('Retry-After'), None,
+                        self._error_message(response), None)
+            parts, usage = [], None
+            # chunk_size=None: строки отдаются по мере прихода, без добивки буфера
+            for line in response.iter_lines(chunk_size=None):
+                if not line or not line.startswith(b"data:"):
+                    continue
+                event = json.loads(line[5:])
+                usage = event.get("usageMetadata", usage)
+                for candidate in event.get("candidates", [])[:1]:
+                    for part in candidate.get("content", {}).get("parts", []):
+                        if part.get("text"):
+                            parts.append(part["text"])
+                            sink.put(part["text"])
+            return 200, None, "".join(parts) or None, None, usage
+
+    async def _stream_attempt(self, model, payload, api_key, retry, sink):
+        """Потоковый запрос к модели; при сбое посреди ответа частичный текст сбрасывается"""
+        import requests
+        self.scheduler.begin(model)
+        started = time.monotonic()
+        ok, text, failure, outcome = False, None, None, "error"
+        try:
+            status, retry_after, text, error_msg, usage = await self.loop.run_in_executor(
+                self.executor, self._consume_stream, model, payload, api_key, sink
+            )
+            outcome = self._outcome(status)
+            if status == 200:
+                ok = True
+                if text:
+                    logger.info(f"Успешно (поток): {model}, токены: {self._usage(model, usage, text)}")
+            else:
+                if self._handle_failure(model, status, retry_after, error_msg, retry):
+                    failure = "rejected"
+        except requests.exceptions.Timeout:
+            outcome = "timeout"
+            logger.warning(f"Таймаут {model}, попытка {retry+1}")
+            self.limiter.cool_down(model, 2 ** retry)
+        except requests.RequestException as e:
+            logger.warning(f"Сетевая ошибка {model}, попытка {retry+1}: {e}")
+            self.limiter.cool_down(model, 2 ** retry)
+        except Exception as e:
+            logger.error(f"Ошибка {model}: {str(e)}")
+            failure = "fatal"
+        if not text:
+            sink.put(STREAM_RESET)
+        elapsed = time.monotonic() - started
+        self.scheduler.record(model, ok, elapsed)
+        metrics.observe("legalai_api_request_seconds", elapsed, model=model, outcome=outcome)
+        return model, text, failure
+
+    async def _hedged(self, model, ranked, payload, api_key, tokens, retry):
+        """Запрос с подстраховкой: если модель не ответила за свой p95, дублируем на следующую"""
+        primary = asyncio.ensure_future(self._attempt(model, payload, api_key, retry))
+        done, _ = await asyncio.wait({primary}, timeout=self.scheduler.hedge_delay(model))
+        backups = [m for m in ranked if m != model]
+        if done or not backups:
+            return await primary
+        # Дублируем только при свободном слоте, без ожидания
+        backup_model, _ = self.limiter.acquire(backups, tokens)
+        if backup_model is None:
+            return await primary
+        logger.info(f"Подстраховочный запрос к {backup_model}: {model} отвечает дольше обычного")
+        pending = {primary, asyncio.ensure_future(self._attempt(backup_model, payload, api_key, 0))}
+        outcome = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                outcome = task.result()
+                if outcome[1]:
+                    return outcome  # Проигравший запрос завершится в фоне и попадет в статистику
+        return outcome
+
+    def prepared_image(self, content, max_entries=8):
+        """PreparedImage из LRU-кэша по хэшу исходных байтов"""
+        key = content_digest(content)
+        with self.images_lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                metrics.inc("legalai_cache_requests_total", cache="images", result="hit")
+                return self.images[key]
+        metrics.inc("legalai_cache_requests_total", cache="images", result="miss")
+        image = prepare_image(content)
+        with self.images_lock:
+            self.images[key] = image
+            while len(self.images) > max_entries:
+                self.images.popitem(last=False)
+        return image
+
+    def _prepare(self, prompt, content, is_image):
+        """Тело запроса и оценка токенов (вход + максимальный вывод) для учета TPM"""
+        if is_image:
+            content = self.prepared_image(content)
+            tokens = estimate_tokens(prompt) + content.tokens + 1024
+        else:
+            # Длинные документы делятся на части заранее (см. split_into_chunks)
+            tokens = estimate_tokens(prompt) + estimate_tokens(content) + 2048
+        return build_payload(prompt, content, is_image), tokens
+
+    async def _prepare_async(self, prompt, content, is_image):
+        """_prepare в пуле потоков (декодирование изображения не блокирует event loop);
+        при ошибке возвращает (None, текст ошибки)"""
+        try:
+            return await self.loop.run_in_executor(self.executor, self._prepare, prompt, content, is_image)
+        except Exception as e:
+            logger.error(f"Ошибка подготовки запроса: {e}")
+            return None, ERROR_BAD_IMAGE
+
+    async def _dispatch(self, tokens, max_retries, attempt):
+        """Цикл выбора модели планировщиком с учетом лимитов и повторов.
+
+        attempt(model, ranked, retry) выполняет запрос и возвращает (модель, текст, сбой) как _attempt.
+        ERROR_REJECTED — только если все модели ответили 4xx: сетевые сбои к нему не относятся.
+        """
+        candidates = list(self.limiter.config["models"])
+        attempts = dict.fromkeys(candidates, 0)
+        rejected = set()  # Модели, ответившие ошибкой запроса (4xx)
+        
+        while candidates:
+            ranked, wait_time = self.scheduler.rank(candidates, tokens)
+            if ranked:
+                # Первая по рейтингу модель со свободным слотом RPM/TPM
+                model, wait_time = self.limiter.acquire(ranked, tokens)
+            else:
+                model = None
+            if model is None:
+                if wait_time is None:
+                    return None, "⚠️ Дневные квоты всех моделей исчерпаны. Попробуйте завтра."
+                logger.warning(f"Нет доступной модели. Ждем {wait_time:.1f} сек")
+                metrics.inc("legalai_backoff_sleep_seconds_total", wait_time)
+                await asyncio.sleep(wait_time)
+                continue
+            
+            retry = attempts[model]
+            attempts[model] += 1
+            if retry:
+                metrics.inc("legalai_api_retries_total", model=model)
+            model, text, failure = await attempt(model, ranked, retry)
+            if text:
+                return text, None
+            if failure:
+                attempts[model] = max_retries
+                if failure == "rejected":
+                    rejected.add(model)
+            
+            # Если модель исчерпала попытки, пробуем следующую
+            if attempts[model] >= max_retries and model in candidates:
+                logger.info(f"Переход к следующей модели после {model}")
+                metrics.inc("legalai_api_fallbacks_total", model=model)
+                candidates.remove(model)
+        
+        if rejected == set(attempts):
+            return None, ERROR_REJECTED
+        return None, "⚠️ Все модели недоступны. Проверьте лимиты и попробуйте позже."
+
+    async def generate_content(self, prompt, content, is_image=False, max_retries=3, hedge=False):
+        """Асинхронный generateContent: выбор модели планировщиком, учет лимитов, повторы"""
+        api_key = self.api_key
+        payload, tokens = await self._prepare_async(prompt, content, is_image)
+        if payload is None:
+            return None, tokens
+        
+        async def attempt(model, ranked, retry):
+            if hedge:
+                return await self._hedged(model, ranked, payload, api_key, tokens, retry)
+            return await self._attempt(model, payload, api_key, retry)
+        
+        return await self._dispatch(tokens, max_retries, attempt)
+
+    async def stream_content(self, prompt, content, sink, is_image=False, max_retries=3):
+        """Асинхронный streamGenerateContent: фрагменты ответа по мере генерации уходят в sink"""
+        api_key = self.api_key
+        
+        async def attempt(model, ranked, retry):
+            return await self._stream_attempt(model, payload, api_key, retry, sink)
+        
+        try:
+            payload, tokens = await self._prepare_async(prompt, content, is_image)
+            if payload is None:
+                return None, tokens
+            return await self._dispatch(tokens, max_retries, attempt)
+        finally:
+            sink.put(None)
+
+    def submit(self, prompt, content, is_image=False, max_retries=3, hedge=False):
+        """Запуск generate_content из синхронного кода; возвращает concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(
+            self.generate_content(prompt, content, is_image, max_retries, hedge), self.loop
+        )
+
+    def stream(self, prompt, content, is_image=False, max_retries=3):
+        """Потоковый вызов из синхронного кода: генератор (накопленный текст, ошибка)"""
+        sink = Queue()
+        future = asyncio.run_coroutine_threadsafe(
+            self.stream_content(prompt, content, sink, is_image, max_retries), self.loop
+        )
+        text = ""
+        while True:
+            piece = sink.get()
+            if piece is None:
+                break
+            if piece is STREAM_RESET:
+                text = ""  # Модель сменилась: частичный ответ недействителен
+                continue
+            text += piece
+            yield text, None
+        result, error = future.result()
+        yield result, error
+
+@st.cache_resource
+def get_gemini_client():
+    """Один клиент (пул соединений и event loop) на процесс"""
+    return GeminiClient(
+        limit_manager,
+        get_setting("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+    )
+
+gemini_client = get_gemini_client()
+
+@st.cache_resource
+def get_result_cache():
+    """Общий для всех сессий процесса кэш результатов"""
+    return ResultCache(max_bytes=int(get_setting("LEGALAI_CACHE_MAX_MB", 256)) * 1024 * 1024)
+
+result_cache = get_result_cache()
+
+# ==================== УЛУЧШЕННАЯ ФУНКЦИЯ ВЫЗОВА GEMINI ====================
+def call_gemini_with_limits(prompt, content, is_image=False, max_retries=3, use_cache=True, hedge=False,
+                            backend=None):
+    """
+    Улучшенная функция вызова с учетом всех лимитов Free Tier
+    """
+    return submit_gemini_with_limits(prompt, content, is_image, max_retries, use_cache, hedge, backend).result()
+
+def _completed(result, error=None):
+    future = Future()
+    future.set_result((result, error))
+    return future
+
+class SingleFlight:
+    """Объединение одинаковых одновременных запросов в процессе.
+
+    Первый запрос с ключом становится ведущим и выполняет вызов, остальные
+    получают тот же Future. Детерминированные ошибки (DETERMINISTIC_ERRORS)
+    помнятся negative_ttl секунд и возвращаются без обращения к API.
+    """
+
+    def __init__(self, negative_ttl=60):
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.failures = {}
+
+    def begin(self, key):
+        """(Future, ведущий ли вызывающий); ведущий обязан вызвать finish"""
+        now = time.monotonic()
+        with self.lock:
+            failure = self.failures.get(key)
+            if failure and failure[1] > now:
+                metrics.inc("legalai_singleflight_total", result="negative")
+                return _completed(None, failure[0]), False
+            future = self.inflight.get(key)
+            if future is not None:
+                metrics.inc("legalai_singleflight_total", result="coalesced")
+                return future, False
+            future = self.inflight[key] = Future()
+        metrics.inc("legalai_singleflight_total", result="leader")
+        return future, True
+
+    def finish(self, key, result, error=None):
+        """Итог ведущего запроса: отдается всем ожидающим"""
+        now = time.monotonic()
+        with self.lock:
+            future = self.inflight.pop(key, None)
+            self.failures = {k: v for k, v in self.failures.items() if v[1] > now}
+            if error in DETERMINISTIC_ERRORS:
+                self.failures[key] = (error, now + self.negative_ttl)
+        if future is not None and not future.done():
+            future.set_result((result, error))
+
+@st.cache_resource
+def get_single_flight():
+    """Один реестр запросов в полете на процесс: общий для всех сессий"""
+    return SingleFlight()
+
+single_flight = get_single_flight()
+
+# Зависимости вызова модели; функции конвейера принимают их явно (backend=None — общие для процесса)
+GeminiBackend = namedtuple("GeminiBackend", ["limiter", "cache", "client", "flights"])
+
+def default_backend():
+    return GeminiBackend(limit_manager, result_cache, gemini_client, single_flight)
+
+def submit_gemini_with_limits(prompt, content, is_image=False, max_retries=3, use_cache=True, hedge=False,
+                              backend=None):
+    """Неблокирующий вызов с кэшем, проверкой ключа и дневного лимита; возвращает Future.
+
+    Одинаковые одновременные вызовы (ключ по полному содержимому) выполняются один раз.
+    hedge=True — для интерактивных запросов: медленный ответ дублируется на другую модель.
+    """
+    limiter, cache, client, flights = backend or default_backend()
+    key = cache_key("call", content, prompt=prompt, is_image=is_image)
+    if use_cache:
+        cached = cache.get(key)
+        if cached is not None:
+            return _completed(cached)
+    
+    if not client.api_key:
+        return _completed(None, "❌ API ключ не настроен")
+    
+    future, leader = flights.begin(key)
+    if not leader:
+        return future
+    # Ведущий обязан завершить Future при любом исходе: иначе ключ зависнет вместе со всеми ожидающими
+    try:
+        # Предыдущий ведущий мог завершиться между проверкой кэша и begin
+        cached = cache.get(key) if use_cache else None
+        if cached is not None:
+            flights.finish(key, cached)
+            return future
+        # Дневной лимит списывается только ведущим: присоединившиеся запросы к API не ходят
+        if not limiter.check_daily_limit():
+            flights.finish(key, None, ERROR_DAILY_LIMIT)
+            return future
+    except Exception as e:
+        logger.error(f"Ошибка подготовки запроса: {e}")
+        flights.finish(key, None, ERROR_INTERNAL)
+        return future
+    
+    async def generate_and_store():
+        # Запись в кэш до завершения Future: повторный запрос сразу попадет в кэш
+        result, error = None, ERROR_INTERNAL
+        try:
+            result, error = await client.generate_content(prompt, content, is_image, max_retries, hedge)
+            if result and not error:
+                await client.loop.run_in_executor(None, cache.put, key, result)
+        finally:
+            flights.finish(key, result, error)
+    
+    try:
+        asyncio.run_coroutine_threadsafe(generate_and_store(), client.loop)
+    except Exception as e:  # Клиент закрыт: корутина не запустится и finish не вызовет
+        logger.error(f"Ошибка запуска запроса: {e}")
+        flights.finish(key, None, ERROR_INTERNAL)
+    return future
+
+def stream_gemini_with_limits(prompt, content, is_image=False, max_retries=3, use_cache=True, backend=None):
+    """Потоковый вызов с кэшем и проверкой лимитов: генератор (накопленный текст, ошибка).
+
+    Последний элемент — итог; полный ответ записывается в кэш после завершения потока.
+    Если такой же запрос уже выполняется, генератор дожидается его и выдает только итог.
+    """
+    limiter, cache, client, flights = backend or default_backend()
+    key = cache_key("call", content, prompt=prompt, is_image=is_image)
+    cached = cache.get(key) if use_cache else None
+    if cached is not None:
+        yield cached, None
+        return
+    if not client.api_key:
+        yield None, "❌ API ключ не настроен"
+        return
+    
+    future, leader = flights.begin(key)
+    if not leader:
+        yield future.result()
+        return
+    
+    outcome = (None, "⚠️ Анализ прерван, запустите его снова")
+    try:
+        cached = cache.get(key) if use_cache else None
+        if cached is not None:
+            outcome = (cached, None)
+        elif not limiter.check_daily_limit():
+            outcome = (None, ERROR_DAILY_LIMIT)
+        else:
+            result, error = None, None
+            for result, error in client.stream(prompt, content, is_image, max_retries):
+                if result and not error:
+                    yield result, None
+            if result and not error:
+                cache.put(key, result)
+            outcome = (result, error)
+    finally:
+        # Сессия могла уйти посреди потока: ожидающие не получат частичный текст как итог
+        flights.finish(key, *outcome)
+    yield outcome
+
+# ==================== КОНВЕЙЕР АНАЛИЗА БОЛЬШИХ ДОКУМЕНТОВ ====================
+# Бюджет токенов на часть: чтобы RPM запросов модели укладывались в ее TPM,
+# за вычетом промпта и максимального вывода
+CHUNK_TOKEN_BUDGET = min(
+    cfg["tpm"] // cfg["rpm"] for cfg in FREE_TIER_CONFIG["models"].values()
+) - 2048 - 500
+
+# Начало раздела или пункта договора: "Статья 5", "Раздел II", "7.", "7.3.1" и т.п.
+CLAUSE_BOUNDARY = re.compile(
+    r"^(?=[ \t]*(?:"
+    r"(?:статья|раздел|глава|пункт|приложение|article|section|clause|schedule)\s+[\dIVXLC]+"
+    r"|\d{1,2}(?:\.\d{1,2})*\.?[ \t]+\S"
+    r"))",
+    re.IGNORECASE | re.MULTILINE
+)
+
+REDUCE_PROMPT = """
+Ниже анализы последовательных фрагментов ОДНОГО договора.
+Объедини их в единый отчет без повторов:
+1. Главные риски (🔴)
+2. Финансовые аспекты (💸)
+3. Проблемные пункты (⚠️)
+Сохраняй ссылки на номера пунктов. Кратко, по делу. MAX 500 слов.
+"""
+
+def _split_oversized(segment, max_tokens):
+    """Деление слишком длинного раздела по абзацам, затем по предложениям"""
+    if estimate_tokens(segment) <= max_tokens:
+        return [segment]
+    for separator in (r"\n\s*\n", r"(?<=[.;!?])\s+"):
+        pieces = [p for p in re.split(separator, segment) if p.strip()]
+        if len(pieces) > 1:
+            result = []
+            for piece in pieces:
+                result.extend(_split_oversized(piece + "\n", max_tokens))
+            return result
+    # Неделимый фрагмент режется по длине (с запасом: до 3 символов на токен)
+    step = max_tokens * 2
+    return [segment[i:i + step] for i in range(0, len(segment), step)]
+
+def split_into_chunks(text, max_tokens=CHUNK_TOKEN_BUDGET):
+    """Разбиение текста на части по границам разделов и пунктов в пределах бюджета токенов"""
+    chunks, current, current_tokens = [], [], 0
+    for section in CLAUSE_BOUNDARY.split(text):
+        if not section.strip():
+            continue
+        for segment in _split_oversized(section, max_tokens):
+            tokens = estimate_tokens(segment)
+            if current and current_tokens + tokens > max_tokens:
+                chunks.append("".join(current))
+                current, current_tokens = [], 0
+            current.append(segment)
+            current_tokens += tokens
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+def reduce_chunk_results(results, max_tokens=CHUNK_TOKEN_BUDGET, use_cache=True, backend=None):
+    """Промежуточная свертка анализов частей, пока они не поместятся в один запрос.
+
+    Возвращает (материал для финальной свертки, ошибка).
+    """
+    while True:
+        groups = split_into_chunks(
+            "\n\n".join(f"### Фрагмент {i}\n{r}\n" for i, r in enumerate(results, 1)),
+            max_tokens
+        )
+        if len(groups) == 1:
+            return groups[0], None
+        futures = [submit_gemini_with_limits(REDUCE_PROMPT, group, use_cache=use_cache, backend=backend)
+                   for group in groups]
+        merged = []
+        for future in futures:
+            text, error = future.result()
+            if error:
+                return None, error
+            merged.append(text)
+        results = merged
+
+def _final_call(prompt, content, total, use_cache, hedge, stream, backend=None):
+    """Финальный запрос конвейера; при stream=True выдает ("partial", ...) по мере генерации"""
+    if not stream:
+        return call_gemini_with_limits(prompt, content, use_cache=use_cache, hedge=hedge, backend=backend)
+    result, error, shown = None, None, None
+    for result, error in stream_gemini_with_limits(prompt, content, use_cache=use_cache, backend=backend):
+        if result and not error and result != shown:
+            shown = result
+            yield "partial", None, total, result, None
+    return result, error
+
+def analyze_document_chunked(prompt, text, max_tokens=CHUNK_TOKEN_BUDGET, use_cache=True, hedge=False, stream=False,
+                             backend=None):
+    """Map-reduce анализ: части анализируются параллельно в пределах лимитов.
+
+    Генератор выдает ("chunk", номер, всего, результат, ошибка) по мере готовности
+    частей и в конце ("final", None, всего, отчет, ошибка). При stream=True итоговый
+    отчет дополнительно приходит частями: ("partial", None, всего, текст, None).
+    backend — GeminiBackend (лимиты, кэш, клиент); по умолчанию общие для процесса.
+    """
+    chunks = split_into_chunks(text, max_tokens)
+    total = len(chunks)
+    if total <= 1:
+        result, error = yield from _final_call(prompt, text, 1, use_cache, hedge, stream, backend)
+        yield "chunk", 1, 1, result, error
+        yield "final", None, 1, result, error
+        return
+    
+    futures = {
+        submit_gemini_with_limits(prompt, f"[Фрагмент {i} из {total}]\n{chunk}", use_cache=use_cache, backend=backend): i
+        for i, chunk in enumerate(chunks, 1)
+    }
+    results = {}
+    for future in as_completed(futures):
+        index = futures[future]
+        result, error = future.result()
+        if result:
+            results[index] = result
+        yield "chunk", index, total, result, error
+    
+    if not results:
+        yield "final", None, total, None, "⚠️ Не удалось проанализировать ни одной части документа"
+        return
+    material, error = reduce_chunk_results([results[i] for i in sorted(results)], max_tokens, use_cache, backend)
+    report = None
+    if material:
+        report, error = yield from _final_call(REDUCE_PROMPT, material, total, use_cache, hedge, stream, backend)
+    if report and len(results) < total:
+        report += f"\n\n⚠️ Проанализировано частей: {len(results)} из {total}"
+    yield "final", None, total, report, error
+
+# ==================== ОПТИМИЗИРОВАННЫЕ ФУНКЦИИ ДЛЯ РАБОТЫ С ДОКУМЕНТАМИ ====================
+# Результат извлечения одной страницы PDF (или части DOCX/TXT)
+PageResult = namedtuple("PageResult", ["number", "total", "text", "elapsed", "error"])
+
+def iter_pdf_pages(file_bytes):
+    """Постраничное извлечение PDF по мере разбора.
+
+    Последовательно в вызывающем потоке: извлечение идет из многопоточного сервера,
+    а дочерний процесс fork мог бы унаследовать захваченную блокировку (логирование,
+    metrics.lock) и зависнуть. Параллельно разбираются разные документы пакета (run_batch).
+    """
+    from PyPDF2 import PdfReader
+    began = time.perf_counter()
+    try:
+        reader = PdfReader(io.BytesIO(file_bytes))
+        total = len(reader.pages)
+    except Exception as e:
+        yield PageResult(0, 0, "", time.perf_counter() - began, f"Не удалось открыть PDF: {e}")
+        return
+    
+    for index in range(total):
+        began = time.perf_counter()
+        try:
+            text, error = reader.pages[index].extract_text() or "", None
+        except Exception as e:
+            text, error = "", str(e)
+        yield PageResult(index + 1, total, text, time.perf_counter() - began, error)
+
+def _docx_table_text(table):
+    """Текст таблицы DOCX построчно; объединенные ячейки не повторяются"""
+    rows = []
+    for row in table.rows:
+        cells = []
+        for cell in row.cells:
+            text = cell.text.strip()
+            if text and (not cells or cells[-1] != text):
+                cells.append(text)
+        if cells:
+            rows.append(" | ".join(cells))
+    return "\n".join(rows)
+
+def _docx_blocks(container):
+    """Абзацы и таблицы контейнера DOCX в порядке следования"""
+    from docx.oxml.ns import qn
+    from docx.table import Table
+    for child in container.iterchildren():
+        if child.tag == qn("w:p"):
+            text = "".join(node.text or "" for node in child.iter(qn("w:t"))).strip()
+            if text:
+                yield text
+        elif child.tag == qn("w:tbl"):
+            text = _docx_table_text(Table(child, None))
+            if text:
+                yield text
+
+def iter_docx_parts(file_bytes, blocks_per_part=200):
+    """Извлечение DOCX частями: колонтитулы, тело документа (с таблицами) блоками"""
+    from docx import Document
+    began = time.perf_counter()
+    try:
+        doc = Document(io.BytesIO(file_bytes))
+    except Exception as e:
+        yield PageResult(0, 0, "", time.perf_counter() - began, f"Не удалось открыть DOCX: {e}")
+        return
+    
+    headers, footers = [], []
+    for section in doc.sections:
+        for target, part in ((headers, section.header), (footers, section.footer)):
+            if part.is_linked_to_previous:
+                continue
+            text = "\n".join(_docx_blocks(part._element))
+            if text and text not in target:
+                target.append(text)
+    
+    began = time.perf_counter()
+    body = list(_docx_blocks(doc.element.body))
+    total = bool(headers) + bool(footers) + -(-len(body) // blocks_per_part)
+    number = 0
+    if headers:
+        number += 1
+        yield PageResult(number, total, "\n".join(headers), time.perf_counter() - began, None)
+    
+    for start in range(0, len(body), blocks_per_part):
+        number += 1
+        text = "\n".join(body[start:start + blocks_per_part])
+        yield PageResult(number, total, text, time.perf_counter() - began, None)
+        began = time.perf_counter()
+    
+    if footers:
+        yield PageResult(number + 1, total, "\n".join(footers), 0.0, None)
+
+def decode_text(file_bytes):
+    """Текстовый файл: UTF-8, иначе Windows-1251"""
+    try:
+        return file_bytes.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return file_bytes.decode("cp1251", errors="replace")
+
+def iter_document_pages(file_bytes, filename):
+    """Потоковое извлечение текста документа: генератор PageResult по мере готовности"""
+    name = filename.lower()
+    if name.endswith(".pdf"):
+        fmt, pages = "pdf", iter_pdf_pages(file_bytes)
+    elif name.endswith(".docx"):
+        fmt, pages = "docx", iter_docx_parts(file_bytes)
+    elif name.endswith(".txt"):
+        fmt, pages = "txt", [PageResult(1, 1, decode_text(file_bytes), 0.0, None)]
+    else:
+        fmt, pages = "other", [PageResult(0, 0, "", 0.0, f"Неподдерживаемый формат: {filename}")]
+    for page in pages:
+        metrics.inc("legalai_extract_pages_total", format=fmt)
+        metrics.observe("legalai_extract_page_seconds", page.elapsed, format=fmt)
+        if page.error:
+            metrics.inc("legalai_extract_errors_total", format=fmt)
+        yield page
+
+def extract_text(file_bytes, filename):
+    """Извлечение и сжатие текста документа (без st.cache_data — для фоновых потоков)"""
+    parts = []
+    for page in iter_document_pages(file_bytes, filename):
+        if page.error:
+            logger.warning(f"Извлечение {filename}, стр. {page.number}: {page.error}")
+        if page.text.strip():
+            parts.append(page.text)
+    return compact_document(parts)
+
+@counted_cache_data("extract_text", show_spinner=False, max_entries=100, ttl=1800)
+def extract_text_cached(file_bytes, filename):
+    """Кэшированное извлечение текста"""
+    return extract_text(file_bytes, filename)
+
+# ==================== ЗАГРУЗКА ДОКУМЕНТОВ ПО URL ====================
+URL_DOCUMENT_TYPES = {
+    "text/html": "html", "application/xhtml+xml": "html", "text/plain": "txt",
+    "application/pdf": "pdf",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx",
+}
+# Служебные блоки страницы, которые не относятся к тексту документа
+HTML_NOISE_TAGS = ("script", "style", "noscript", "template", "iframe", "svg", "form",
+                   "button", "nav", "header", "footer", "aside")
+HTML_BLOCK_TAGS = ("p", "div", "li", "tr", "br", "h1", "h2", "h3", "h4", "h5", "h6",
+                   "section", "article", "main", "table", "blockquote", "pre", "dd", "dt")
+
+def extract_main_text(body, encoding=None):
+    """Основной текст HTML-страницы: без меню и подвалов, с переносами между блоками"""
+    import lxml.html
+    parser = lxml.html.HTMLParser(encoding=encoding, remove_comments=True)
+    root = lxml.html.document_fromstring(body, parser=parser)
+    for el in root.xpath("//" + " | //".join(HTML_NOISE_TAGS)
+                         + " | //*[@role='navigation' or @role='banner' or @role='contentinfo']"):
+        el.drop_tree()
+    for el in root.iter(*HTML_BLOCK_TAGS):
+        el.tail = "\n" + (el.tail or "")
+
+    # Явно размеченный основной блок, иначе контейнер с наибольшим объемом абзацев
+    candidates = root.xpath("//article | //main | //*[@role='main']")
+    if candidates:
+        main = max(candidates, key=lambda el: len(el.text_content()))
+    else:
+        scores = {}
+        for p in root.iter("p"):
+            parent = p.getparent()
+            if parent is not None:
+                scores[parent] = scores.get(parent, 0) + len(p.text_content())
+        main = max(scores, key=scores.get) if scores else None
+        body_el = root.find("body")
+        total = len((body_el if body_el is not None else root).text_content())
+        # Если абзацы разбросаны по странице, один контейнер не отражает документ
+        if main is None or scores[main] < total * 0.3:
+            main = body_el if body_el is not None else root
+    return main.text_content()
+
+class UrlFetcher:
+    """Загрузка страниц с лимитом размера и кэшем извлеченного текста (ETag/Last-Modified)"""
+
+    def __init__(self, db_name="pages.sqlite3", max_bytes=10 * 1024 * 1024,
+                 fresh_seconds=300, max_entries=200, timeout=(5, 20)):
+        self.max_bytes = max_bytes
+        self.fresh_seconds = fresh_seconds
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self._session = None
+        self.conn = open_sqlite(db_name)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                text TEXT NOT NULL,
+                checked REAL NOT NULL
+            )
+        """)
+
+    @property
+    def session(self):
+        """HTTP-сессия создается при первой загрузке страницы"""
+        with self.lock:
+            if self._session is None:
+                self._session = http_session(8, 8, {"User-Agent": "LegalAI-Auditor/1.0"})
+            return self._session
+
+    def _cached(self, url):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT etag, last_modified, text, checked FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+
+    def _store(self, url, etag, last_modified, text):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages (url, etag, last_modified, text, checked) "
+                "VALUES (?, ?, ?, ?, ?)", (url, etag, last_modified, text, time.time())
+            )
+            self.conn.execute(
+                "DELETE FROM pages WHERE url NOT IN "
+                "(SELECT url FROM pages ORDER BY checked DESC LIMIT ?)", (self.max_entries,)
+            )
+
+    def _touch(self, url):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE pages SET checked = ? WHERE url = ?", (time.time(), url))
+
+    def _download(self, response):
+        """Потоковое чтение тела с жестким лимитом; None при превышении"""
+        length = response.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > self.max_bytes:
+            return None
+        body = bytearray()
+        for block in response.iter_content(64 * 1024):
+            body.extend(block)
+            if len(body) > self.max_bytes:
+                return None
+        return bytes(body)
+
+    def _extract(self, body, kind, encoding):
+        if kind == "html":
+            return compact_text(extract_main_text(body, encoding))
+        if kind == "txt":
+            return compact_text(body.decode(encoding, errors="replace") if encoding else decode_text(body))
+        pages = [page.text for page in iter_document_pages(body, f"document.{kind}") if page.text.strip()]
+        return compact_document(pages)
+
+    def fetch(self, url):
+        """Текст документа по URL: (текст, ошибка). Повторный вызов обходится без сети"""
+        import requests
+        if urlparse(url).scheme not in ("http", "https"):
+            return None, "Поддерживаются только ссылки http:// и https://"
+        cached = self._cached(url)
+        if cached and time.time() - cached[3] < self.fresh_seconds:
+            metrics.inc("legalai_cache_requests_total", cache="pages", result="hit")
+            return cached[2], None
+
+        headers = {}
+        if cached:
+            if cached[0]:
+                headers["If-None-Match"] = cached[0]
+            if cached[1]:
+                headers["If-Modified-Since"] = cached[1]
+        try:
+            with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                if response.status_code == 304 and cached:
+                    self._touch(url)
+                    metrics.inc("legalai_cache_requests_total", cache="pages", result="revalidated")
+                    return cached[2], None
+                if response.status_code != 200:
+                    return None, f"Сервер вернул код {response.status_code}"
+                raw_type = response.headers.get("Content-Type", "").lower()
+                content_type = raw_type.split(";")[0].strip()
+                kind = URL_DOCUMENT_TYPES.get(content_type)
+                if not kind:
+                    return None, f"Неподдерживаемый тип содержимого: {content_type or 'не указан'}"
+                body = self._download(response)
+                if body is None:
+                    return None, f"Документ больше {self.max_bytes // (1024 * 1024)} МБ"
+                # Кодировка только из заголовка: для HTML без charset ее найдет lxml по <meta>
+                encoding = None
+                if "charset=" in raw_type:
+                    encoding = requests.utils.get_encoding_from_headers(response.headers)
+                text = self._extract(body, kind, encoding)
+                etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        except requests.RequestException as e:
+            logger.error(f"Ошибка загрузки {url}: {e}")
+            return None, "Ошибка загрузки URL"
+        except Exception as e:
+            logger.error(f"Ошибка разбора {url}: {e}")
+            return None, "Не удалось извлечь текст со страницы"
+
+        if not text:
+            return None, "На странице не найден текст"
+        self._store(url, etag, last_modified, text)
+        metrics.inc("legalai_cache_requests_total", cache="pages", result="miss")
+        return text, None
+
+@st.cache_resource
+def get_url_fetcher():
+    """Один загрузчик (пул соединений, кэш страниц) на процесс"""
+    return UrlFetcher(max_bytes=int(get_setting("LEGALAI_URL_MAX_MB", 10)) * 1024 * 1024)
+
+url_fetcher = get_url_fetcher()
+
+# ==================== СЖАТИЕ ТЕКСТА ПЕРЕД ОТПРАВКОЙ ====================
+# Номер страницы отдельной строкой: "5", "- 5 -", "Стр. 5 из 20", "Page 5 of 20"
+PAGE_NUMBER_LINE = re.compile(
+    r"^\s*(?:(?:стр(?:аница)?|page|с)\.?\s*)?[-–—]?\s*\d{1,4}\s*[-–—]?"
+    r"(?:\s*(?:из|of|/)\s*\d{1,4})?\s*$",
+    re.IGNORECASE
+)
+# Перенос слова в конце строки PDF: "обяза-\nтельства"
+HYPHENATION = re.compile(r"(\w)[-\u00ad]\n[ \t]*(?=[a-zа-яё])")
+# Разрыв строки внутри предложения: следующая строка начинается со строчной буквы
+SOFT_LINE_BREAK = re.compile(r"(?<![.;:!?»\")\]])[ \t]*\n[ \t]*(?=[a-zа-яё])")
+# Лигатуры PDF-шрифтов; NFKC не подходит — он заменяет "№" на "No", "²" на "2"
+LIGATURES = str.maketrans({
+    "\ufb00": "ff", "\ufb01": "fi", "\ufb02": "fl", "\ufb03": "ffi", "\ufb04": "ffl",
+    "\ufb05": "st", "\ufb06": "st",
+})
+# Повторы длиннее этого порога считаются шаблонными пунктами
+BOILERPLATE_MIN_CHARS = 80
+
+def normalize_extracted_text(text):
+    """Нормализация текста из PdfReader: лигатуры, мягкие переносы, пробелы, разрывы строк"""
+    text = unicodedata.normalize("NFC", text).translate(LIGATURES)
+    text = text.replace("\u00ad\n", "-\n").replace("\u00ad", "")
+    text = HYPHENATION.sub(r"\1", text)
+    text = SOFT_LINE_BREAK.sub(" ", text)
+    text = re.sub(r"[ \t\u00a0]+", " ", text)
+    text = re.sub(r" ?\n ?", "\n", text)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+def _furniture_key(line):
+    return re.sub(r"\d+", "#", line.strip().lower())
+
+def _edge_indexes(lines, edge_lines):
+    """Номера строк у верхнего и нижнего края страницы (не больше трети страницы).
+    У страницы из одной строки краев нет: это текст, а не колонтитул."""
+    if len(lines) < 2:
+        return set()
+    depth = min(edge_lines, len(lines) // 3) or min(1, len(lines))
+    return set(range(depth)) | set(range(len(lines) - depth, len(lines)))
+
+def strip_page_furniture(pages, edge_lines=2, max_chars=100):
+    """Удаление повторяющихся колонтитулов и номеров страниц по краям страниц.
+
+    Номера страниц снимаются, только если они есть по краям большинства страниц:
+    одиночная строка вида "2024" в начале текста остается.
+    """
+    split_pages = [[line for line in page.splitlines() if line.strip()] for page in pages]
+    counts, numbered = {}, 0
+    for lines in split_pages:
+        edges = [lines[i] for i in _edge_indexes(lines, edge_lines)]
+        numbered += any(PAGE_NUMBER_LINE.match(line) for line in edges)
+        if len(split_pages) >= 3:
+            for key in {_furniture_key(line) for line in edges if len(line) <= max_chars}:
+                counts[key] = counts.get(key, 0) + 1
+    threshold = max(2, len(split_pages) // 2)
+    repeated = {key for key, count in counts.items() if count >= threshold}
+    page_numbers = numbered >= threshold
+    
+    cleaned = []
+    for lines in split_pages:
+        edge = _edge_indexes(lines, edge_lines)
+        cleaned.append("\n".join(
+            line for i, line in enumerate(lines)
+            if not (i in edge and (_furniture_key(line) in repeated
+                                   or page_numbers and PAGE_NUMBER_LINE.match(line)))
+        ))
+    return cleaned
+
+def dedupe_boilerplate(text):
+    """Повторные вхождения длинных одинаковых абзацев удаляются (остается первое)"""
+    seen, kept = set(), []
+    for paragraph in text.split("\n"):
+        key = " ".join(paragraph.lower().split())
+        if len(key) >= BOILERPLATE_MIN_CHARS:
+            if key in seen:
+                continue
+            seen.add(key)
+        kept.append(paragraph)
+    return "\n".join(kept)
+
+def compact_document(pages):
+    """Подготовка текста к отправке: без колонтитулов, номеров страниц и повторов"""
+    pages = strip_page_furniture(pages)
+    return dedupe_boilerplate(normalize_extracted_text("\n".join(p for p in pages if p.strip())))
+
+def compact_text(text):
+    """Сжатие произвольного текста (ввод пользователя, веб-страница)"""
+    return compact_document([text])
+
+def compact_prompt(prompt):
+    """Промпт без отступов и пустых строк из многострочных f-строк"""
+    return "\n".join(line.strip() for line in prompt.strip().splitlines() if line.strip())
+
+def truncate_to_tokens(text, max_tokens):
+    """Обрезка текста по оценке токенов (по границе строки, если возможно)"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    lines, used = [], 0
+    for line in text.split("\n"):
+        tokens = estimate_tokens(line) + 1
+        if used + tokens > max_tokens:
+            if not lines:
+                lines.append(line[:max_tokens * 2])
+            break
+        lines.append(line)
+        used += tokens
+    return "\n".join(lines)
+
+# ==================== СРАВНЕНИЕ ДОКУМЕНТОВ ПО ПУНКТАМ ====================
+# Результат сопоставления пункта: identical / changed / added / removed
+ClauseDiff = namedtuple("ClauseDiff", ["status", "label", "old", "new", "similarity"])
+
+CLAUSE_LABEL = re.compile(
+    r"^\s*((?:статья|раздел|глава|пункт|приложение|article|section|clause|schedule)\s+[\dIVXLC.]+"
+    r"|\d{1,2}(?:\.\d{1,2})*\.?)",
+    re.IGNORECASE
+)
+# Похожие пункты (Жаккар по шинглам) считаются измененной версией друг друга
+CLAUSE_MATCH_THRESHOLD = 0.5
+# Короче этого (в словах) пункты сравниваются еще и по словам: шинглов слишком мало,
+# и правка одного слова обнуляет большую их часть
+CLAUSE_SHORT_WORDS = 20
+# Одинаковый номер пункта в обеих редакциях — сильный признак пары: прибавка к сходству
+CLAUSE_LABEL_BONUS = 0.25
+# Больше пар в одном расхождении не сравниваем попарно — сопоставляем по порядку
+CLAUSE_PAIRWISE_LIMIT = 40000
+
+COMPARE_PROMPT = """
+Ниже только различающиеся пункты двух редакций договора: БЫЛО/СТАЛО, добавленные и удаленные.
+Роль: {role}. Страна: {loc}.
+Для каждого пункта кратко: что изменилось и юридические последствия (🔴 риск, 💸 деньги, ⚠️ внимание).
+Ответ таблицей: Пункт | Изменение | Последствия.
+"""
+
+def segment_clauses(text):
+    """Пункты договора: (номер, текст); без нумерации — по абзацам"""
+    sections = [s.strip() for s in CLAUSE_BOUNDARY.split(text) if s.strip()]
+    if len(sections) <= 1:
+        sections = [p.strip() for p in re.split(r"\n\s*\n|\n", text) if p.strip()]
+    clauses = []
+    for section in sections:
+        match = CLAUSE_LABEL.match(section)
+        clauses.append((match.group(1).rstrip(".") if match else "", section))
+    return clauses
+
+def _clause_key(text):
+    return " ".join(text.lower().split())
+
+def _shingles(text, size=3):
+    words = _clause_key(text).split()
+    if len(words) < size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+def _clause_similarity(a, b, a_shingles, b_shingles):
+    """Сходство пунктов: Жаккар по шинглам, для коротких — не ниже доли общих слов по порядку"""
+    score = _jaccard(a_shingles, b_shingles)
+    a_words, b_words = _clause_key(a).split(), _clause_key(b).split()
+    if min(len(a_words), len(b_words)) < CLAUSE_SHORT_WORDS:
+        score = max(score, difflib.SequenceMatcher(None, a_words, b_words, autojunk=False).ratio())
+    return score
+
+def _pair_block(old, new):
+    """Сопоставление пунктов внутри расхождения: лучшие пары по сходству и совпадению номеров"""
+    if not old or not new:
+        return [], list(range(len(old))), list(range(len(new)))
+    if len(old) * len(new) > CLAUSE_PAIRWISE_LIMIT:
+        pairs = [(i, i, None) for i in range(min(len(old), len(new)))]
+    else:
+        old_sh = [_shingles(text) for _, text in old]
+        new_sh = [_shingles(text) for _, text in new]
+        candidates = []
+        for i, (old_label, old_text) in enumerate(old):
+            for j, (new_label, new_text) in enumerate(new):
+                score = _clause_similarity(old_text, new_text, old_sh[i], new_sh[j])
+                bonus = CLAUSE_LABEL_BONUS if old_label and old_label == new_label else 0.0
+                candidates.append((score + bonus, score, i, j))
+        candidates.sort(reverse=True)
+        pairs, used_old, used_new = [], set(), set()
+        for rank, score, i, j in candidates:
+            if rank < CLAUSE_MATCH_THRESHOLD:
+                break
+            if i not in used_old and j not in used_new:
+                pairs.append((i, j, score))
+                used_old.add(i)
+                used_new.add(j)
+    paired_old = {i for i, _, _ in pairs}
+    paired_new = {j for _, j, _ in pairs}
+    return (
+        sorted(pairs),
+        [i for i in range(len(old)) if i not in paired_old],
+        [j for j in range(len(new)) if j not in paired_new],
+    )
+
+def diff_clauses(text_a, text_b):
+    """Выравнивание пунктов двух редакций и пометка identical/changed/added/removed"""
+    old, new = segment_clauses(text_a), segment_clauses(text_b)
+    matcher = difflib.SequenceMatcher(
+        None, [_clause_key(t) for _, t in old], [_clause_key(t) for _, t in new], autojunk=False
+    )
+    result = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            result.extend(ClauseDiff("identical", old[i][0], old[i][1], new[j][1], 1.0)
+                          for i, j in zip(range(i1, i2), range(j1, j2)))
+            continue
+        block_old, block_new = old[i1:i2], new[j1:j2]
+        pairs, removed, added = _pair_block(block_old, block_new)
+        for i, j, score in pairs:
+            if score is None:
+                score = difflib.SequenceMatcher(None, block_old[i][1], block_new[j][1]).quick_ratio()
+            label = block_new[j][0] or block_old[i][0]
+            result.append(ClauseDiff("changed", label, block_old[i][1], block_new[j][1], score))
+        result.extend(ClauseDiff("removed", block_old[i][0], block_old[i][1], "", 0.0) for i in removed)
+        result.extend(ClauseDiff("added", block_new[j][0], "", block_new[j][1], 0.0) for j in added)
+    return result
+
+def word_diff_markdown(old, new):
+    """Изменения внутри пункта: ~~удалено~~ **добавлено**"""
+    old_words, new_words = old.split(), new.split()
+    parts = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_words, new_words).get_opcodes():
+        if tag == "equal":
+            parts.append(" ".join(old_words[i1:i2]))
+            continue
+        if i2 > i1:
+            parts.append(f"~~{' '.join(old_words[i1:i2])}~~")
+        if j2 > j1:
+            parts.append(f"**{' '.join(new_words[j1:j2])}**")
+    return " ".join(parts)
+
+def summarize_clause_changes(diffs, role, loc, max_tokens=CHUNK_TOKEN_BUDGET, use_cache=True):
+    """Юридическая оценка только различающихся пунктов; группы под бюджет токенов идут параллельно"""
+    blocks = []
+    for diff in diffs:
+        label = f"п. {diff.label}" if diff.label else "Пункт без номера"
+        if diff.status == "changed":
+            blocks.append(f"### {label} (изменен)\nБЫЛО: {diff.old}\nСТАЛО: {diff.new}")
+        elif diff.status == "added":
+            blocks.append(f"### {label} (добавлен)\nСТАЛО: {diff.new}")
+        elif diff.status == "removed":
+            blocks.append(f"### {label} (удален)\nБЫЛО: {diff.old}")
+    if not blocks:
+        return None, None
+    
+    groups, current, used = [], [], 0
+    for block in blocks:
+        block = truncate_to_tokens(block, max_tokens)
+        tokens = estimate_tokens(block)
+        if current and used + tokens > max_tokens:
+            groups.append("\n\n".join(current))
+            current, used = [], 0
+        current.append(block)
+        used += tokens
+    groups.append("\n\n".join(current))
+    
+    prompt = COMPARE_PROMPT.format(role=role, loc=loc)
+    futures = [submit_gemini_with_limits(prompt, group, use_cache=use_cache, hedge=True) for group in groups]
+    summaries, errors = [], []
+    for future in futures:
+        text, error = future.result()
+        if text:
+            summaries.append(text)
+        elif error:
+            errors.append(error)
+    if not summaries:
+        return None, errors[0] if errors else None
+    return "\n\n".join(summaries), None
+
+# ==================== ПРЕДВАРИТЕЛЬНЫЙ СКРИНИНГ ====================
+# Красные флаги: категория -> (вес, шаблоны по основам слов)
+RED_FLAGS = {
+    "Неустойка и штрафы": (10, [
+        r"неустойк", r"штраф", r"\bпени\b", r"penalt", r"liquidated damages",
+    ]),
+    "Одностороннее расторжение или изменение": (12, [
+        r"в одностороннем (?:внесудебном )?порядке", r"односторонн\w* (?:отказ|расторжени|изменени)",
+        r"terminate\w* (?:this agreement )?(?:unilaterally|at any time|for convenience)", r"unilateral",
+    ]),
+    "Подсудность и арбитраж": (6, [
+        r"подсудн", r"арбитражн\w* суд", r"третейск", r"договорн\w* подсудност",
+        r"по месту нахождения (?:истца|арендодателя|исполнителя|поставщика|продавца|кредитора)",
+        r"arbitration", r"exclusive jurisdiction",
+    ]),
+    "Автопролонгация": (8, [
+        r"автоматическ\w* (?:продлева|продлен|пролонг)", r"считается продленн", r"пролонгир",
+        r"auto(?:matic(?:ally)?)?[- ]renew",
+    ]),
+    "Ограничение ответственности": (8, [
+        r"не нес[её]т ответственност", r"ответственност\w* (?:\w+ )?ограничива", r"освобожда\w* от ответственност",
+        r"limitation of liability", r"shall not be liable",
+    ]),
+    "Безакцептное списание и предоплата": (7, [
+        r"безакцептн", r"100\s*%\s*предоплат", r"предоплат\w* в размере 100", r"advance payment of 100",
+    ]),
+    "Изменение цены": (7, [
+        r"(?:изменить|изменять|пересмотреть) (?:цену|стоимость|тариф|размер арендной)", r"индексац",
+        r"price (?:adjustment|increase)",
+    ]),
+    "Уступка прав": (5, [
+        r"уступ\w* прав", r"передать свои права", r"assign\w* (?:this agreement|its rights)",
+    ]),
+    "Персональные данные": (4, [
+        r"персональн\w* данн", r"personal data",
+    ]),
+}
+
+# Дополнения по юрисдикциям: те же категории плюс собственные
+JURISDICTION_FLAGS = {
+    "РФ": {
+        "Неустойка и штрафы": [r"ключев\w* ставк", r"ст(?:атьи|атья|\.)\s*333\s+ГК"],
+        "Подсудность и арбитраж": [r"МКАС", r"ст(?:атьи|атья|\.)\s*395\s+ГК"],
+        "Валютная оговорка": (6, [r"у\.\s?е\.", r"условн\w* единиц", r"эквивалент\w* (?:доллар|евро)"]),
+    },
+    "Казахстан": {
+        "Неустойка и штрафы": [r"\bМРП\b", r"месячн\w* расчетн\w* показател"],
+        "Подсудность и арбитраж": [r"МФЦА", r"\bAIFC\b", r"Международн\w* арбитражн\w* центр"],
+        "Валютная оговорка": (6, [r"эквивалент\w* (?:доллар|евро)", r"по курсу", r"у\.\s?е\."]),
+    },
+    "Узбекистан": {
+        "Неустойка и штрафы": [r"\bБРВ\b", r"базов\w* расчетн\w* величин"],
+        "Подсудность и арбитраж": [r"\bТМАЦ\b", r"Ташкентск\w* международн\w* арбитражн"],
+        "Валютная оговорка": (6, [r"эквивалент\w* (?:доллар|евро)", r"по курсу ЦБ", r"у\.\s?е\."]),
+    },
+    "Международная": {
+        "Подсудность и арбитраж": [r"\bICC\b", r"\bLCIA\b", r"\bSIAC\b", r"governing law", r"laws of England"],
+        "Ограничение ответственности": [r"indemnif", r"hold harmless", r"consequential damages"],
+        "Санкции и форс-мажор": (6, [r"sanction", r"санкци", r"force majeure", r"hardship"]),
+    },
+}
+
+# Важность категорий для роли пользователя
+ROLE_FLAG_WEIGHTS = {
+    "Физическое лицо": {"Автопролонгация": 1.5, "Безакцептное списание и предоплата": 1.5,
+                        "Неустойка и штрафы": 1.3, "Персональные данные": 1.5},
+    "Предприниматель": {"Ограничение ответственности": 1.3, "Подсудность и арбитраж": 1.3,
+                        "Изменение цены": 1.3, "Валютная оговорка": 1.3},
+}
+
+SCREEN_HIGH_RISK = 40       # С этого балла модели отправляется весь документ
+SCREEN_EXCERPT_SHARE = 0.7  # Выборка почти с весь текст смысла не имеет
+
+ScreenedClause = namedtuple("ScreenedClause", ["label", "text", "categories", "spans"])
+ScreenResult = namedtuple("ScreenResult", ["score", "level", "categories", "clauses", "total_clauses", "elapsed"])
+
+@functools.lru_cache(maxsize=None)
+def build_screener(role, loc):
+    """Скомпилированные флаги роли и юрисдикции: [(выражение, категория)], веса категорий.
+
+    Каждый шаблон компилируется отдельно и в нижнем регистре: у выражения с
+    буквальным началом sre ищет кандидатов быстрым поиском подстроки, а общая
+    альтернатива из десятков шаблонов проверяла бы каждую позицию текста.
+    Поэтому в шаблонах допустимы только строчные классы символов (b, s, w, d).
+    """
+    flags = {category: (weight, list(patterns)) for category, (weight, patterns) in RED_FLAGS.items()}
+    for category, extra in JURISDICTION_FLAGS.get(loc, {}).items():
+        if isinstance(extra, tuple):
+            flags[category] = (extra[0], list(extra[1]))
+        else:
+            flags[category][1].extend(extra)
+    role_weights = ROLE_FLAG_WEIGHTS.get(role, {})
+    weights = {category: weight * role_weights.get(category, 1.0) for category, (weight, _) in flags.items()}
+    matchers = [(re.compile(pattern.lower()), category)
+                for category, (_, patterns) in flags.items() for pattern in patterns]
+    return matchers, weights
+
+def _clause_offsets(text, segments):
+    """Начало каждого пункта в исходном тексте (пункты идут по порядку)"""
+    offsets, position = [], 0
+    for _, clause in segments:
+        found = text.find(clause, position)
+        offsets.append(found if found >= 0 else position)
+        position = max(position, found + len(clause)) if found >= 0 else position
+    return offsets
+
+def screen_document(text, role, loc):
+    """Локальная проверка текста по красным флагам: балл 0–100, уровень и отмеченные пункты"""
+    started = time.perf_counter()
+    matchers, weights = build_screener(role, loc)
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        # Редкие символы меняют длину при смене регистра: позиции совпадений сместились бы
+        matchers = [(re.compile(m.pattern, re.IGNORECASE), c) for m, c in matchers]
+        lowered = text
+    found = sorted(
+        (match.start(), match.end(), category)
+        for matcher, category in matchers for match in matcher.finditer(lowered)
+    )
+    segments = segment_clauses(text)
+    offsets = _clause_offsets(text, segments)
+    
+    hits, by_clause = {}, {}
+    for start, end, category in found:
+        hits[category] = hits.get(category, 0) + 1
+        index = max(0, bisect.bisect_right(offsets, start) - 1)
+        spans, categories = by_clause.setdefault(index, ([], []))
+        base = offsets[index]
+        # Пересекающиеся совпадения разных шаблонов подсвечиваются один раз
+        if not spans or start - base >= spans[-1][1]:
+            spans.append((start - base, min(end - base, len(segments[index][1]))))
+        if category not in categories:
+            categories.append(category)
+    clauses = [
+        ScreenedClause(segments[i][0], segments[i][1], tuple(categories), spans)
+        for i, (spans, categories) in sorted(by_clause.items())
+    ]
+    # Повторы категории повышают балл, но с насыщением
+    raw = sum(weights[c] * (1 + 0.5 * (min(n, 5) - 1)) for c, n in hits.items())
+    score = min(100, round(raw))
+    level = "высокий" if score >= SCREEN_HIGH_RISK else "средний" if score >= 15 else "низкий"
+    return ScreenResult(score, level, hits, clauses, len(segments), time.perf_counter() - started)
+
+@counted_cache_data("screen", max_entries=32, show_spinner=False)
+def screen_document_cached(text, role, loc):
+    """Скрининг для интерфейса: перезапуски страницы не проверяют тот же текст заново.
+    cache_data: каждая сессия получает свою копию результата"""
+    return screen_document(text, role, loc)
+
+def screened_content(text, screen):
+    """Что отправить модели: (текст или None, режим). Режимы: full — весь документ
+    (высокий риск), flagged — только отмеченные пункты, clean — модель не нужна"""
+    if screen.score >= SCREEN_HIGH_RISK:
+        return text, "full"
+    if not screen.clauses:
+        return None, "clean"
+    excerpt = "\n\n".join(clause.text for clause in screen.clauses)
+    if len(excerpt) >= len(text) * SCREEN_EXCERPT_SHARE:
+        return text, "full"
+    return excerpt, "flagged"
+
+def screened_prompt(role, loc, mode):
+    """Промпт анализа; для выборки модель предупреждается, что видит не весь договор"""
+    prompt = analysis_prompt(role, loc)
+    if mode == "flagged":
+        prompt += "\nДаны только пункты, отмеченные предварительной проверкой, а не весь договор.\n"
+    return prompt
+
+def screen_report(screen):
+    """Отчет без обращения к модели для документа без красных флагов"""
+    return (
+        f"✅ Предварительная проверка: красных флагов не найдено (балл {screen.score}, "
+        f"пунктов проверено: {screen.total_clauses}). Документ не отправлялся модели.\n\n"
+        "Для полного анализа отключите предварительный скрининг."
+    )
+
+def highlight_clause(clause):
+    """HTML пункта с подсветкой найденных фрагментов"""
+    parts, position = [], 0
+    for start, end in clause.spans:
+        parts.append(html.escape(clause.text[position:start]))
+        parts.append(f"<mark>{html.escape(clause.text[start:end])}</mark>")
+        position = end
+    parts.append(html.escape(clause.text[position:]))
+    return "".join(parts).replace("\n", "<br>")
+
+# ==================== ИНДЕКС ПРОШЛЫХ АНАЛИЗОВ ====================
+PASSAGE_CHARS = 1200
+CONTEXT_TOKENS = 3000
+INDEX_COMMON_SHARE = 0.25  # Слова из большей доли фрагментов почти не влияют на BM25, но замедляют поиск
+INDEX_COMMON_MIN = 5000  # Меньшие списки совпадений ранжируются быстро при любой частоте
+INDEX_STOPWORDS = frozenset("""
+    для что это как или при так все его она они были быть этот только также если без под над
+    составь составить напиши подготовь сделай основе анализа анализ документа
+    the and for with that this from are was were have has
+""".split())
+
+Passage = namedtuple("Passage", ["title", "kind", "text", "score"])
+
+def index_terms(text, limit=32):
+    """Термины запроса: (слово, префикс?); длинные слова ищутся по основе (штраф/штрафа/штрафом).
+
+    Диакритика снимается так же, как токенизатором индекса (й → и, ё → е).
+    """
+    terms = []
+    for word in re.findall(r"\w+", text.lower()):
+        if len(word) < 3 or word.isdigit() or word in INDEX_STOPWORDS:
+            continue
+        word = "".join(c for c in unicodedata.normalize("NFD", word) if not unicodedata.combining(c))
+        term = (word[:-2], True) if len(word) >= 6 else (word, False)
+        if term not in terms:
+            terms.append(term)
+            if len(terms) >= limit:
+                break
+    return terms
+
+def split_passages(text):
+    """Фрагменты для индекса: пункты договора, длинные — окнами по PASSAGE_CHARS"""
+    passages = []
+    for _, clause in segment_clauses(text):
+        passages.extend(clause[i:i + PASSAGE_CHARS] for i in range(0, len(clause), PASSAGE_CHARS))
+    return passages
+
+class PassageIndex:
+    """Полнотекстовый индекс (SQLite FTS5, BM25) прошлых анализов и пунктов договоров по делам.
+
+    Пополняется по мере завершения анализов; генерация берет из него
+    только самые релевантные фрагменты в пределах бюджета токенов.
+    """
+
+    def __init__(self, db_name="index.sqlite3"):
         self.lock = threading.Lock()
-        self.daily_requests = 0
-        self.last_reset = datetime.utcnow()
-        
-    def check_daily_limit(self):
-        """Проверка дневного лимита запросов"""
+        self.conn = open_sqlite(db_name)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS indexed (
+                matter TEXT NOT NULL,
+                key TEXT NOT NULL,
+                title TEXT NOT NULL,
+                passages INTEGER NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (matter, key)
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS passages USING fts5(
+                text, matter UNINDEXED, key UNINDEXED, title UNINDEXED, kind UNINDEXED,
+                tokenize = 'unicode61 remove_diacritics 2'
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS passages_vocab USING fts5vocab(passages, 'row');
+        """)
+
+    def add(self, matter, key, title, result, source=None):
+        """Анализ (и исходный текст) в индекс дела; повторное добавление того же ключа пропускается"""
+        rows = [(p, matter, key, title, "analysis") for p in split_passages(result or "")]
+        rows += [(p, matter, key, title, "clause") for p in split_passages(source or "")]
         with self.lock:
-            # Сброс счетчика в 00:00 PT (8:00 UTC)
-            now_utc = datetime.utcnow()
-            if now_utc.hour == 8 and now_utc.minute < 5:
-                if (now_utc - self.last_reset).days >= 1:
-                    self.daily_requests = 0
-                    self.last_reset = now_utc
-                    logger.info("Счетчик дневных запросов сброшен")
-            
-            if self.daily_requests >= FREE_TIER_CONFIG["global_limits"]["daily_request_limit"]:
-                return False
-            self.daily_requests += 1
-            return True
-    
-    def record_request(self, model):
-        """Запись запроса для расчета RPM"""
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                added = self.conn.execute(
+                    "INSERT OR IGNORE INTO indexed (matter, key, title, passages, created) VALUES (?, ?, ?, ?, ?)",
+                    (matter, key, title, len(rows), time.time())
+                ).rowcount
+                if added:
+                    self.conn.executemany(
+                        "INSERT INTO passages (text, matter, key, title, kind) VALUES (?, ?, ?, ?, ?)", rows
+                    )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return bool(added)
+
+    def search(self, matter, query, k=12, max_tokens=CONTEXT_TOKENS):
+        """Лучшие по BM25 фрагменты дела, суммарно не больше max_tokens"""
+        terms = index_terms(query)
+        if not terms:
+            return []
+        with metrics.timer("legalai_index_search_seconds"), self.lock:
+            terms = self._selective(terms)
+            expression = " OR ".join(f'"{word}"*' if prefix else f'"{word}"' for word, prefix in terms)
+            rows = self.conn.execute(
+                "SELECT title, kind, text, bm25(passages) AS score FROM passages "
+                "WHERE passages MATCH ? AND matter = ? ORDER BY score LIMIT ?",
+                (expression, matter, k * 3)
+            ).fetchall()
+        found, seen, budget = [], set(), max_tokens
+        for title, kind, text, score in rows:
+            tokens = estimate_tokens(text)
+            if text in seen or tokens > budget:
+                continue
+            seen.add(text)
+            found.append(Passage(title, kind, text, -score))
+            budget -= tokens
+            if len(found) >= k:
+                break
+        return found
+
+    def _selective(self, terms):
+        """Термины без слишком частых (по частоте в словаре индекса); хотя бы один самый редкий остается"""
+        total = self.conn.execute("SELECT SUM(passages) FROM indexed").fetchone()[0] or 0
+        frequencies = []
+        for word, prefix in terms:
+            if prefix:
+                frequency = self.conn.execute(
+                    "SELECT SUM(doc) FROM passages_vocab WHERE term >= ? AND term < ?", (word, word + "\uffff")
+                ).fetchone()[0]
+            else:
+                frequency = self.conn.execute(
+                    "SELECT doc FROM passages_vocab WHERE term = ?", (word,)
+                ).fetchone()
+                frequency = frequency[0] if frequency else 0
+            frequencies.append((frequency or 0, word, prefix))
+        selective = [(word, prefix) for frequency, word, prefix in frequencies
+                     if frequency <= max(total * INDEX_COMMON_SHARE, INDEX_COMMON_MIN)]
+        return selective or [min(frequencies)[1:]]
+
+    def stats(self, matter):
+        """Документов и фрагментов в индексе дела"""
         with self.lock:
-            now = time.time()
-            self.requests_log.append((now, model))
-            # Очистка старых записей (старше 1 минуты)
-            self.requests_log = [(t, m) for t, m in self.requests_log if now - t < 60]
-            
-            # Подсчет RPM для конкретной модели
-            model_count = len([(t, m) for t, m in self.requests_log if m == model])
-            return model_count < FREE_TIER_CONFIG["models"][model]["rpm"]
+            documents, passages = self.conn.execute(
+                "SELECT COUNT(*), SUM(passages) FROM indexed WHERE matter = ?", (matter,)
+            ).fetchone()
+        return documents, passages or 0
+
+@st.cache_resource
+def get_passage_index():
+    return PassageIndex()
+
+passage_index = get_passage_index()
+
+def index_analysis(matter, key, title, result, source=None):
+    """Пополнение индекса после анализа; сбой индекса не мешает отдать результат"""
+    if not matter or not result:
+        return
+    try:
+        passage_index.add(matter, key, title, result, source)
+    except sqlite3.Error as e:
+        logger.warning(f"Индекс: не удалось добавить {title}: {e}")
+
+def passages_context(passages):
+    """Контекст генерации: фрагменты с указанием документа"""
+    labels = {"analysis": "анализ", "clause": "пункт договора"}
+    return "\n\n".join(f"[{p.title}, {labels[p.kind]}]\n{p.text}" for p in passages)
+
+# ==================== ПАКЕТНЫЙ АУДИТ ====================
+ROLES = ["Предприниматель", "Юрист", "Физическое лицо"]
+JURISDICTIONS = ["РФ", "Казахстан", "Узбекистан", "Международная"]
+BATCH_EXTENSIONS = (".pdf", ".docx", ".txt")
+
+def analysis_prompt(role, loc):
+    """Промпт анализа договора (оптимизирован для экономии токенов)"""
+    return f"""
+    Роль: {role}. Страна: {loc}. 
+    Выдели: 
+    1. Главные риски (🔴)
+    2. Финансовые аспекты (💸)  
+    3. Проблемные пункты (⚠️)
+    Кратко, по делу. MAX 500 слов.
+    """
+
+def iter_batch_files(name, data):
+    """Файлы пакета: ZIP-архивы раскрываются, неподдерживаемые форматы пропускаются"""
+    if name.lower().endswith(".zip"):
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            for info in archive.infolist():
+                member = info.filename
+                if info.is_dir() or member.startswith("__MACOSX/"):
+                    continue
+                if member.lower().endswith(BATCH_EXTENSIONS):
+                    yield member, archive.read(info)
+    elif name.lower().endswith(BATCH_EXTENSIONS):
+        yield name, data
+
+def _extract_batch_item(name, data):
+    """Извлечение текста одного документа пакета (выполняется в пуле потоков)"""
+    parts, errors = [], []
+    for page in iter_document_pages(data, name):
+        if page.error:
+            errors.append(f"стр. {page.number}: {page.error}")
+        if page.text.strip():
+            parts.append(page.text)
+    if not parts:
+        return None, "; ".join(errors) or "Текст не извлечен"
+    return compact_document(parts), None
+
+class BatchStore:
+    """Задания пакетного аудита в SQLite: результаты переживают перезапуск"""
+
+    def __init__(self, db_name="batch.sqlite3"):
+        self.lock = threading.Lock()
+        self.conn = open_sqlite(db_name)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS batch_jobs (
+                id TEXT PRIMARY KEY,
+                role TEXT NOT NULL,
+                loc TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS batch_items (
+                job_id TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                name TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                text TEXT,
+                result TEXT,
+                error TEXT,
+                updated REAL,
+                PRIMARY KEY (job_id, digest)
+            );
+        """)
+
+    def create_job(self, role, loc, items, prescreen=True):
+        """Задание для набора (дайджест, имя); тот же набор и настройки дают то же задание.
+        Скрининг меняет то, что уходит модели, поэтому запуск без него — другое задание"""
+        material = json.dumps([role, loc, PROMPT_VERSION, sorted(d for d, _ in items), prescreen])
+        job_id = hashlib.sha256(material.encode("utf-8")).hexdigest()[:12]
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO batch_jobs (id, role, loc, created) VALUES (?, ?, ?, ?)",
+                    (job_id, role, loc, time.time())
+                )
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO batch_items (job_id, digest, name) VALUES (?, ?, ?)",
+                    [(job_id, digest, name) for digest, name in items]
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return job_id
+
+    def job(self, job_id):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT id, role, loc, created FROM batch_jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+
+    def to_extract(self, job_id):
+        """Дайджесты документов без извлеченного текста"""
+        with self.lock:
+            return [row[0] for row in self.conn.execute(
+                "SELECT digest FROM batch_items WHERE job_id = ? AND text IS NULL", (job_id,)
+            )]
+
+    def to_analyze(self, job_id):
+        """(дайджест, текст) документов, ожидающих анализа или упавших ранее"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT digest, text FROM batch_items "
+                "WHERE job_id = ? AND text IS NOT NULL AND status != 'done'", (job_id,)
+            ).fetchall()
+
+    def set_text(self, job_id, digest, text, error=None):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE batch_items SET text = ?, status = ?, error = ?, updated = ? "
+                "WHERE job_id = ? AND digest = ?",
+                (text, "error" if error else "pending", error, time.time(), job_id, digest)
+            )
+
+    def finish(self, job_id, digest, result, error=None):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE batch_items SET result = ?, status = ?, error = ?, updated = ? "
+                "WHERE job_id = ? AND digest = ?",
+                (result, "error" if error or not result else "done", error,
+                 time.time(), job_id, digest)
+            )
+
+    def items(self, job_id):
+        """Документы задания: имя, статус, длина текста, результат, ошибка"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT name, status, LENGTH(text), result, error FROM batch_items "
+                "WHERE job_id = ? ORDER BY name", (job_id,)
+            ).fetchall()
+
+@st.cache_resource
+def get_batch_store():
+    return BatchStore()
+
+batch_store = get_batch_store()
+
+def run_batch(files, role, loc, concurrency=None, extract_workers=None, on_progress=None, prescreen=True,
+              matter=None):
+    """Пакетный аудит набора файлов (имя, байты); возвращает id задания.
+
+    Тексты извлекаются пулом потоков, документы анализируются параллельно
+    через общий клиент и менеджер лимитов, поэтому загружаются все модели.
+    Уже готовые документы задания пропускаются: повторный запуск продолжает работу.
+    prescreen=True: документы без красных флагов не отправляются модели,
+    для остальных отправляются отмеченные пункты или весь текст при высоком риске.
+    matter: готовые анализы и пункты документов пополняют индекс этого дела.
+    """
+    on_progress = on_progress or (lambda stage, done, total: None)
+    documents = {}
+    for name, data in files:
+        for member, member_data in iter_batch_files(name, data):
+            documents.setdefault(content_digest(member_data), (member, member_data))
+    job_id = batch_store.create_job(role, loc, [(d, name) for d, (name, _) in documents.items()], prescreen)
+    
+    # Этап 1: извлечение текста
+    pending = [d for d in batch_store.to_extract(job_id) if d in documents]
+    workers = extract_workers or int(get_setting("LEGALAI_EXTRACT_WORKERS", min(os.cpu_count() or 1, 4)))
+    if pending:
+        # Потоки, а не fork: дочерний процесс многопоточного сервера может унаследовать
+        # захваченную блокировку (metrics.lock, логирование), и его метрики теряются
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="extract") as pool:
+            futures = {pool.submit(_extract_batch_item, *documents[d]): d for d in pending}
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    text, error = future.result()
+                except Exception as e:
+                    text, error = None, str(e)
+                batch_store.set_text(job_id, futures[future], text, error)
+                on_progress("extract", done, len(futures))
     
-    def get_wait_time(self, model):
-        """Время ожидания при превышении RPM"""
+    # Этап 2: анализ; запросы всех документов идут через общий бюджет RPM/TPM
+    def analyze(digest, text):
+        content, mode = text, "full"
+        if prescreen:
+            screen = screen_document(text, role, loc)
+            content, mode = screened_content(text, screen)
+        key = cache_key("analysis", text, role=role, loc=loc, mode=mode)
+        result, error = result_cache.get(key), None
+        try:
+            if result is None and mode == "clean":
+                result = screen_report(screen)
+            elif result is None:
+                prompt = screened_prompt(role, loc, mode)
+                for stage, _, _, part, error in analyze_document_chunked(prompt, content):
+                    if stage == "final":
+                        result = part
+                if result and not error:
+                    result_cache.put(key, result)
+        except Exception as e:
+            logger.error(f"Пакет {job_id}: ошибка анализа {digest[:12]}: {e}")
+            result, error = None, str(e)
+        batch_store.finish(job_id, digest, result, error)
+        if not error:
+            index_analysis(matter, key, documents.get(digest, (digest[:12],))[0], result, text)
+    
+    queue = batch_store.to_analyze(job_id)
+    concurrency = concurrency or sum(cfg["rpm"] for cfg in FREE_TIER_CONFIG["models"].values()) // 2
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as pool:
+        futures = [pool.submit(analyze, digest, text) for digest, text in queue]
+        for done, future in enumerate(as_completed(futures), 1):
+            future.result()
+            on_progress("analyze", done, len(futures))
+    return job_id
+
+def batch_report_csv(job_id):
+    """Сводный CSV-отчет задания (UTF-8 с BOM для Excel)"""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["Документ", "Статус", "Символов", "Анализ", "Ошибка"])
+    for row in batch_store.items(job_id):
+        writer.writerow(["" if v is None else v for v in row])
+    return out.getvalue().encode("utf-8-sig")
+
+def batch_report_docx(job_id):
+    """Сводный DOCX-отчет задания"""
+    from docx import Document
+    _, role, loc, _ = batch_store.job(job_id)
+    doc = Document()
+    doc.add_heading("Пакетный аудит договоров", 0)
+    doc.add_paragraph(f"Анализ для: {role}. Юрисдикция: {loc}. Задание: {job_id}")
+    for name, status, _, result, error in batch_store.items(job_id):
+        doc.add_heading(name, 1)
+        doc.add_paragraph(result if status == "done" else f"Ошибка: {error}")
+    bio = io.BytesIO()
+    doc.save(bio)
+    return bio.getvalue()
+
+# ==================== ФОНОВЫЕ ЗАДАЧИ ====================
+JOB_FINISHED = ("done", "error")
+
+# Снимок задачи для интерфейса
+JobState = namedtuple("JobState", [
+    "id", "kind", "status", "progress", "message", "partial", "details", "result", "error", "created", "finished"
+])
+
+class Job:
+    """Задача в пуле: функция получает ее первым аргументом и сообщает прогресс через update"""
+
+    def __init__(self, job_id, kind, key, lock):
+        self.id, self.kind, self.key, self.lock = job_id, kind, key, lock
+        self.status = "queued"
+        self.progress, self.message, self.partial = 0.0, "", None
+        self.details = []
+        self.result, self.error = None, None
+        self.created, self.finished = time.time(), None
+
+    def update(self, progress=None, message=None, partial=None, detail=None):
+        """Прогресс 0..1, строка состояния, накопленный текст ответа, готовая часть (заголовок, текст)"""
         with self.lock:
-            if not self.requests_log:
-                return 0
-            oldest = min(t for t, m in self.requests_log if m == model)
-            return max(0, 60 - (time.time() - oldest))
+            if progress is not None:
+                self.progress = progress
+            if message is not None:
+                self.message = message
+            if partial is not None:
+                self.partial = partial
+            if detail is not None:
+                self.details.append(detail)
 
-# Инициализация менеджера лимитов
-limit_manager = RateLimitManager()
+    def state(self):
+        with self.lock:
+            return JobState(self.id, self.kind, self.status, self.progress, self.message, self.partial,
+                            list(self.details), self.result, self.error, self.created, self.finished)
+
+class JobExecutor:
+    """Фоновое выполнение анализов в ограниченном пуле потоков процесса.
+
+    Задача переживает перезапуски скрипта и закрытие вкладки браузера.
+    Одинаковые задачи (по ключу содержимого и настроек) не запускаются
+    повторно: второй запрос получает id уже идущей или готовой задачи.
+    """
+
+    def __init__(self, workers=4, keep_seconds=3600, max_jobs=200):
+        self.keep_seconds = keep_seconds
+        self.max_jobs = max_jobs
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.by_key = {}
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+
+    def submit(self, kind, key, func, *args, reuse_finished=True):
+        """id задачи; func(job, *args) возвращает (результат, ошибка)"""
+        with self.lock:
+            self._prune()
+            existing = self.jobs.get(self.by_key.get(key))
+            if existing and existing.status != "error" and (reuse_finished or existing.status not in JOB_FINISHED):
+                metrics.inc("legalai_jobs_total", kind=kind, status="deduplicated")
+                return existing.id
+            job = Job(uuid.uuid4().hex[:12], kind, key, threading.Lock())
+            self.jobs[job.id] = job
+            self.by_key[key] = job.id
+        metrics.inc("legalai_jobs_total", kind=kind, status="submitted")
+        self.pool.submit(self._run, job, func, args)
+        return job.id
+
+    def _run(self, job, func, args):
+        with job.lock:
+            job.status = "running"
+        try:
+            result, error = func(job, *args)
+        except Exception as e:
+            logger.error(f"Задача {job.kind} {job.id}: {e}")
+            result, error = None, f"Ошибка выполнения: {e}"
+        with job.lock:
+            job.result, job.error = result, error
+            job.status = "error" if error and result is None else "done"
+            job.progress, job.finished = 1.0, time.time()
+        metrics.inc("legalai_jobs_total", kind=job.kind, status=job.status)
+
+    def forget_finished(self):
+        """Готовые задачи больше не переиспользуются (после очистки кэша считаются заново).
+        Сами задачи остаются: открытые страницы по-прежнему видят свои результаты"""
+        with self.lock:
+            for key, job_id in list(self.by_key.items()):
+                if self.jobs[job_id].status in JOB_FINISHED:
+                    del self.by_key[key]
+
+    def get(self, job_id):
+        """Снимок задачи или None (неизвестна или удалена по сроку)"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+        return job.state() if job else None
+
+    def _prune(self):
+        """Удаление завершенных задач старше срока и сверх лимита (под self.lock)"""
+        now = time.time()
+        finished = sorted((j for j in self.jobs.values() if j.finished), key=lambda j: j.finished)
+        excess = len(self.jobs) - self.max_jobs
+        for job in finished:
+            if now - job.finished > self.keep_seconds or excess > 0:
+                del self.jobs[job.id]
+                if self.by_key.get(job.key) == job.id:
+                    del self.by_key[job.key]
+                excess -= 1
+
+@st.cache_resource
+def get_job_executor():
+    """Один пул задач на процесс: общий для всех сессий"""
+    return JobExecutor(workers=int(get_setting("LEGALAI_JOB_WORKERS", 4)))
+
+job_executor = get_job_executor()
+
+def analysis_job(job, content, is_image, mode, screen, role, loc, use_cache, key, matter, title, source):
+    """Анализ документа: кэш, скрининг, map-reduce по частям с потоковым итогом; итог — в индекс дела"""
+    if use_cache:
+        cached = result_cache.get(key)
+        if cached is not None:
+            job.update(message="Из кэша")
+            index_analysis(matter, key, title, cached, source)
+            return cached, None
+    if mode == "clean":
+        result = screen_report(screen)
+        index_analysis(matter, key, title, result, source)
+        return result, None
+    
+    prompt = screened_prompt(role, loc, mode)
+    if mode == "flagged":
+        job.update(message=f"К модели уходят только отмеченные пункты: {len(content)} символов")
+    result, error = None, None
+    if is_image:
+        job.update(message="Анализирую изображение...")
+        for result, error in stream_gemini_with_limits(prompt, content, is_image, use_cache=use_cache):
+            if result and not error:
+                job.update(partial=result)
+    else:
+        done = 0
+        for stage, index, total, part, error in analyze_document_chunked(
+            prompt, content, use_cache=use_cache, hedge=True, stream=True
+        ):
+            if stage == "chunk":
+                done += 1
+                job.update(progress=done / total, message=f"Проанализировано частей: {done}/{total}")
+                if total > 1:
+                    job.update(detail=(f"Часть {index} из {total}", part or error))
+            elif stage == "partial":
+                job.update(partial=part)
+            else:
+                result = part
+    if error:
+        return None, error
+    if result:
+        result_cache.put(key, result)
+        index_analysis(matter, key, title, result, source)
+    return result, None
+
+def compare_job(job, file_a, file_b, role, loc, use_cache):
+    """Сравнение двух редакций: выравнивание пунктов и оценка только различий"""
+    job.update(message="Извлекаю текст...")
+    text_a, text_b = extract_text(*file_a), extract_text(*file_b)
+    job.update(progress=0.3, message="Сопоставляю пункты...")
+    diffs = diff_clauses(text_a, text_b)
+    changes = [d for d in diffs if d.status != "identical"]
+    if not changes:
+        return {"diffs": diffs, "summary": None}, None
+    job.update(progress=0.5, message="Оцениваю последствия изменений...")
+    summary, error = summarize_clause_changes(changes, role, loc, use_cache=use_cache)
+    return {"diffs": diffs, "summary": summary}, error
+
+def generation_job(job, prompt, context, use_cache):
+    """Генерация документа по запросу и результату анализа"""
+    job.update(message="Генерирую...")
+    return call_gemini_with_limits(prompt, context, use_cache=use_cache, hedge=True)
+
+def batch_job(job, files, role, loc, prescreen, matter):
+    """Пакетный аудит; результат — id задания в хранилище пакетов"""
+    stage_labels = {"extract": "Извлечение текста", "analyze": "Анализ"}
+    return run_batch(
+        files, role, loc, prescreen=prescreen, matter=matter,
+        on_progress=lambda stage, done, total: job.update(
+            progress=done / total, message=f"{stage_labels[stage]}: {done}/{total}"
+        )
+    ), None
+
+# ==================== БЕНЧМАРК ====================
+# Корпус, замена API и сам замер — в bench.py; здесь конвейер приложения для него
+def bench_pipeline(url, data_dir, limits_scale=20, client_timeout=5.0, stream=False, role=None, loc=None):
+    """Изолированный конвейер для bench.run_benchmark: (извлечение, анализ -> ошибка, закрытие).
+
+    Лимиты, кэш и клиент создаются заново в data_dir и передаются конвейеру явно:
+    рабочий каталог .legalai, общие объекты процесса и настоящий ключ API не
+    используются. Лимиты Free Tier умножаются на limits_scale в копии конфигурации,
+    чтобы замер показывал само приложение, а не ожидание квоты (1 — как есть).
+    """
+    config = copy.deepcopy(FREE_TIER_CONFIG)
+    for cfg in config["models"].values():
+        for name in ("rpm", "tpm", "rpd"):
+            cfg[name] *= limits_scale
+    config["global_limits"]["daily_request_limit"] *= limits_scale
+    limiter = RateLimitManager(os.path.join(data_dir, "quota.sqlite3"), config)
+    client = GeminiClient(limiter, url, timeout=client_timeout, api_key="bench")
+    backend = GeminiBackend(limiter, ResultCache(os.path.join(data_dir, "cache.sqlite3")), client, SingleFlight())
+    prompt = analysis_prompt(role or ROLES[1], loc or JURISDICTIONS[0])
+    
+    def analyze(text):
+        error = None
+        for stage, _, _, part, err in analyze_document_chunked(prompt, text, stream=stream, backend=backend):
+            if stage == "final":
+                error = err or (None if part else "пустой ответ")
+        return error
+    
+    return extract_text_cached, analyze, client.close
+
+# ==================== КОМАНДНАЯ СТРОКА ====================
+def iter_cli_files(paths):
+    """Файлы из аргументов командной строки; каталоги обходятся рекурсивно"""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for name in sorted(names):
+                    if name.lower().endswith(BATCH_EXTENSIONS + (".zip",)):
+                        full = os.path.join(root, name)
+                        with open(full, "rb") as f:
+                            yield os.path.relpath(full, path), f.read()
+        else:
+            with open(path, "rb") as f:
+                yield os.path.basename(path), f.read()
+
+def cli_main(argv=None):
+    """Запуск без интерфейса: python app.py batch ДОКУМЕНТЫ... --out отчет.csv
+    или python app.py bench [--baseline прошлый.json]"""
+    parser = argparse.ArgumentParser(prog="app.py", description="LegalAI Enterprise Pro без интерфейса")
+    commands = parser.add_subparsers(dest="command", required=True)
+    batch = commands.add_parser(
+        "batch",
+        help="Пакетный аудит договоров (PDF, DOCX, TXT, ZIP, каталоги)",
+        description="Повторный запуск с теми же файлами и настройками продолжает прерванное задание."
+    )
+    batch.add_argument("paths", nargs="+", help="Файлы, ZIP-архивы или каталоги")
+    batch.add_argument("--role", choices=ROLES, default=ROLES[1])
+    batch.add_argument("--loc", choices=JURISDICTIONS, default=JURISDICTIONS[0])
+    batch.add_argument("--out", default="batch_report.csv", help="Отчет: .csv или .docx")
+    batch.add_argument("--concurrency", type=int, help="Документов в работе одновременно")
+    batch.add_argument("--workers", type=int, help="Потоков извлечения текста")
+    batch.add_argument("--no-prescreen", action="store_true",
+                       help="Отправлять модели все документы целиком, без локального скрининга")
+    batch.add_argument("--matter", help="Дело: результаты пополняют его индекс для генерации")
+    bench = commands.add_parser(
+        "bench",
+        help="Офлайн-бенчмарк на синтетических договорах и локальной замене Gemini API",
+        description="Реальный API, квоты и кэш .legalai не используются."
+    )
+    bench.add_argument("--pages", type=int, nargs="+", default=[2, 10, 40], help="Размеры документов, страниц")
+    bench.add_argument("--docs", type=int, default=2, help="Документов каждого размера")
+    bench.add_argument("--concurrency", type=int, default=4, help="Документов в анализе одновременно")
+    bench.add_argument("--stream", action="store_true", help="Итоговый отчет через streamGenerateContent")
+    bench.add_argument("--latency", type=float, default=0.3, help="Задержка ответа, сек")
+    bench.add_argument("--jitter", type=float, default=0.1, help="Случайная добавка к задержке, сек")
+    bench.add_argument("--rate-429", type=float, default=0.0, help="Доля ответов 429")
+    bench.add_argument("--retry-after", type=int, default=1, help="Retry-After для 429, сек")
+    bench.add_argument("--timeout-rate", type=float, default=0.0, help="Доля зависших запросов")
+    bench.add_argument("--client-timeout", type=float, default=5.0, help="Таймаут клиента, сек")
+    bench.add_argument("--limits-scale", type=float, default=20, help="Множитель лимитов Free Tier (1 — как есть)")
+    bench.add_argument("--seed", type=int, default=0)
+    bench.add_argument("--out", help="Сохранить результат в JSON")
+    bench.add_argument("--baseline", help="JSON прошлого прогона: код выхода 1 при регрессии")
+    bench.add_argument("--tolerance", type=float, default=0.2, help="Допустимое ухудшение метрик (доля)")
+    bench.add_argument("--verbose", action="store_true", help="Журнал запросов")
+    args = parser.parse_args(argv)
+    
+    if args.command == "bench":
+        import bench as benchmark
+        if not args.verbose:
+            logger.setLevel(logging.ERROR)
+        report = benchmark.run_benchmark(
+            functools.partial(bench_pipeline, limits_scale=args.limits_scale,
+                              client_timeout=args.client_timeout, stream=args.stream),
+            args.pages, args.docs, args.concurrency, args.client_timeout, args.seed,
+            labels={"stream": args.stream, "limits_scale": args.limits_scale},
+            count_tokens=estimate_tokens, latency=args.latency, jitter=args.jitter,
+            rate_429=args.rate_429, retry_after=args.retry_after, timeout_rate=args.timeout_rate
+        )
+        print(benchmark.format_bench_report(report))
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as f:
+                problems = benchmark.bench_regressions(report, json.load(f), args.tolerance)
+            for problem in problems:
+                print(f"Регрессия: {problem}", file=sys.stderr)
+            return 1 if problems else 0
+        return 0
+    
+    stages = {"extract": "Извлечение", "analyze": "Анализ"}
+    job_id = run_batch(
+        iter_cli_files(args.paths), args.role, args.loc,
+        concurrency=args.concurrency, extract_workers=args.workers, prescreen=not args.no_prescreen,
+        matter=args.matter,
+        on_progress=lambda stage, done, total: print(f"{stages[stage]}: {done}/{total}", file=sys.stderr)
+    )
+    report = batch_report_docx(job_id) if args.out.lower().endswith(".docx") else batch_report_csv(job_id)
+    with open(args.out, "wb") as f:
+        f.write(report)
+    
+    items = batch_store.items(job_id)
+    failed = sum(1 for item in items if item[1] != "done")
+    print(f"Задание {job_id}: готово {len(items) - failed} из {len(items)}, отчет: {args.out}")
+    return 1 if failed else 0
+
+if __name__ == "__main__" and not st.runtime.exists():
+    sys.exit(cli_main())
 
 # ==================== НАСТРОЙКА ИНТЕРФЕЙСА ====================
 st.set_page_config(
@@ -145,129 +3073,68 @@ st.markdown("""
         background-color: #6c757d !important;
         color: white !important;
     }
+    .risk-card {
+        border-left: 4px solid #FF4B4B;
+        background-color: rgba(255, 75, 75, 0.06);
+        padding: 6px 12px;
+        margin: 4px 0;
+        border-radius: 4px;
+    }
 </style>
 """, unsafe_allow_html=True)
 
-# ==================== УЛУЧШЕННАЯ ФУНКЦИЯ ВЫЗОВА GEMINI ====================
-@st.cache_data(show_spinner=False, max_entries=50, ttl=3600)  # Кэш на 1 час
-def call_gemini_with_limits(_prompt_hash, prompt, content, is_image=False, max_retries=3):
-    """
-    Улучшенная функция вызова с учетом всех лимитов Free Tier
-    """
-    if not st.secrets.get("GOOGLE_API_KEY"):
-        return None, "❌ API ключ не настроен"
-    
-    # Проверка дневного лимита
-    if not limit_manager.check_daily_limit():
-        return None, "⚠️ Достигнут дневной лимит запросов. Попробуйте завтра."
-    
-    # Подготовка моделей в порядке приоритета
-    models_priority = sorted(
-        FREE_TIER_CONFIG["models"].keys(),
-        key=lambda x: FREE_TIER_CONFIG["models"][x]["priority"]
-    )
-    
-    for model in models_priority:
-        for retry in range(max_retries):
-            try:
-                # Проверка RPM для модели
-                if not limit_manager.record_request(model):
-                    wait_time = limit_manager.get_wait_time(model)
-                    if wait_time > 0:
-                        logger.warning(f"RPM лимит для {model}. Ждем {wait_time:.1f} сек")
-                        time.sleep(wait_time)
-                
-                url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={st.secrets['GOOGLE_API_KEY']}"
-                
-                # Формирование запроса с оптимизацией
-                if is_image:
-                    mime_type = "image/jpeg" if content[:3] == b'\xff\xd8\xff' else "image/png"
-                    img_b64 = base64.b64encode(content).decode('utf-8')
-                    payload = {
-                        "contents": [{
-                            "parts": [
-                                {"text": prompt[:1000]},  # Ограничиваем промпт
-                                {"inline_data": {"mime_type": mime_type, "data": img_b64}}
-                            ]
-                        }],
-                        "generationConfig": {
-                            "temperature": 0.1,
-                            "maxOutputTokens": 1024,  # Ограничиваем вывод
-                            "topP": 0.8
-                        }
-                    }
-                else:
-                    # Оптимизация текста для экономии токенов
-                    if len(content) > 30000:
-                        content = content[:15000] + "\n\n... [текст сокращен для Free Tier] ...\n\n" + content[-15000:]
-                    
-                    payload = {
-                        "contents": [{
-                            "parts": [{"text": f"{prompt[:500]}\n\nТЕКСТ:\n{content}"}]
-                        }],
-                        "generationConfig": {
-                            "temperature": 0.2,
-                            "maxOutputTokens": 2048,  # Лимит вывода
-                            "topP": 0.9
-                        }
-                    }
-                
-                # Вызов API
-                response = requests.post(url, json=payload, timeout=30)
-                
-                if response.status_code == 429:
-                    # Обработка Rate Limit
-                    retry_after = int(response.headers.get('Retry-After', 60))
-                    logger.warning(f"Rate limit для {model}. Retry после {retry_after} сек")
-                    time.sleep(retry_after)
-                    continue
-                    
-                elif response.status_code == 200:
-                    result = response.json()
-                    if 'candidates' in result and result['candidates']:
-                        text = result['candidates'][0]['content']['parts'][0]['text']
-                        logger.info(f"Успешно: {model}, токены: ~{len(text)//4}")
-                        return text, None
-                
-                else:
-                    error_msg = response.json().get('error', {}).get('message', 'Unknown')
-                    logger.error(f"Ошибка {model}: {response.status_code} - {error_msg}")
-                    break
-                    
-            except requests.exceptions.Timeout:
-                logger.warning(f"Таймаут {model}, попытка {retry+1}")
-                time.sleep(2 ** retry)  # Exponential backoff
-                continue
-            except Exception as e:
-                logger.error(f"Ошибка {model}: {str(e)}")
-                break
-        
-        # Если модель не сработала, пробуем следующую по приоритету
-        logger.info(f"Переход к следующей модели после {model}")
-        continue
-    
-    return None, "⚠️ Все модели недоступны. Проверьте лимиты и попробуйте позже."
+def render_report(text):
+    """Отчет одним блоком markdown: строки с рисками (🔴/💸/⚠️) выделяются карточками.
+    Ответ модели выводится с unsafe_allow_html, поэтому экранируется каждая строка."""
+    lines = []
+    for line in text.split('\n'):
+        if '🔴' in line or '💸' in line or '⚠️' in line:
+            lines.append(f'\n<div class="risk-card">{html.escape(line)}</div>\n')
+        else:
+            lines.append(html.escape(line, quote=False))
+    return "\n".join(lines)
 
-# ==================== ОПТИМИЗИРОВАННЫЕ ФУНКЦИИ ДЛЯ РАБОТЫ С ДОКУМЕНТАМИ ====================
-@st.cache_data(show_spinner=False, max_entries=100, ttl=1800)
-def extract_text_cached(file_bytes, filename):
-    """Кэшированное извлечение текста"""
-    try:
-        if filename.lower().endswith(".pdf"):
-            reader = PdfReader(io.BytesIO(file_bytes))
-            return " ".join([page.extract_text() for page in reader.pages if page.extract_text()])
-        elif filename.lower().endswith(".docx"):
-            doc = Document(io.BytesIO(file_bytes))
-            return "\n".join([p.text for p in doc.paragraphs if p.text.strip()])
-        return ""
-    except:
-        return ""
+def current_job(kind):
+    """Задача вкладки: id из сессии, после перезагрузки страницы — из адреса (?job_<вид>=...)"""
+    param = f"job_{kind}"
+    job_id = st.session_state.get(param) or st.query_params.get(param)
+    job = job_executor.get(job_id) if job_id else None
+    if job is None and param in st.query_params:
+        del st.query_params[param]
+    return job
+
+def remember_job(kind, job_id):
+    """Id задачи в сессии и в адресе страницы: вкладка браузера находит ее после переподключения"""
+    st.session_state[f"job_{kind}"] = job_id
+    st.query_params[f"job_{kind}"] = job_id
+
+@st.fragment(run_every=1.0)
+def watch_job(job_id):
+    """Опрос идущей задачи раз в секунду; по завершении — перезапуск страницы с итогом"""
+    job = job_executor.get(job_id)
+    if job is None or job.status in JOB_FINISHED:
+        st.rerun()
+    st.progress(job.progress, text=job.message or ("В очереди..." if job.status == "queued" else "Выполняется..."))
+    if job.partial:
+        st.markdown(render_report(job.partial), unsafe_allow_html=True)
+    for title, text in job.details:
+        with st.expander(title, expanded=False):
+            st.markdown(text)
+
+def report_docx(text):
+    """Отчет анализа в DOCX"""
+    from docx import Document
+    doc = Document()
+    doc.add_heading("Анализ документа", 0)
+    doc.add_paragraph(text)
+    bio = io.BytesIO()
+    doc.save(bio)
+    return bio.getvalue()
 
 # ==================== ОБНОВЛЕННЫЙ ИНТЕРФЕЙС ====================
-# Боковая панель с информацией о лимитах
-with st.sidebar:
-    st.header("⚙️ Конфигурация")
-    
+@st.fragment(run_every=30)
+def quota_panel():
+    """Лимиты Free Tier и состояние моделей; обновляются сами, без перезапуска страницы"""
     # Информация о Free Tier
     with st.expander("📊 Лимиты Free Tier", expanded=True):
         st.markdown(f"""
@@ -289,33 +3156,69 @@ with st.sidebar:
         elif limit_manager.daily_requests > 500:
             st.warning("ℹ️ Использовано более 50% лимита")
     
-    # Настройки
-    role = st.radio("Анализ для:", ["Предприниматель", "Юрист", "Физическое лицо"])
-    loc = st.selectbox("Юрисдикция:", ["РФ", "Казахстан", "Узбекистан", "Международная"])
-    
-    # Оптимизация запросов
-    st.subheader("Оптимизация")
-    use_cache = st.checkbox("Использовать кэш", value=True, 
-                           help="Кэширует результаты на 1 час для экономии запросов")
-    optimize_text = st.checkbox("Сокращать длинные тексты", value=True,
-                               help="Автоматически сокращает документы >30K символов")
+    # Живое состояние моделей: по нему планировщик выбирает модель для запроса
+    with st.expander("🩺 Состояние моделей"):
+        models_state = gemini_client.scheduler.snapshot()
+        models_headroom = limit_manager.headroom(list(FREE_TIER_CONFIG["models"]))
+        state_labels = {"closed": "🟢", "half-open": "🟡", "open": "🔴"}
+        rows = ["| Модель | p50/p95, сек | Ошибки | RPD |", "|---|---|---|---|"]
+        for model, stats in models_state.items():
+            p50 = f"{stats['p50']:.1f}" if stats["p50"] is not None else "—"
+            p95 = f"{stats['p95']:.1f}" if stats["p95"] is not None else "—"
+            rows.append(
+                f"| {state_labels[stats['state']]} {model} | {p50}/{p95} | "
+                f"{stats['error_rate']:.0%} | {models_headroom[model][1]} |"
+            )
+        st.markdown("\n".join(rows))
+
+@st.fragment
+def cache_panel():
+    """Статистика кэша и его очистка"""
+    cache_stats = result_cache.stats()
+    st.caption(
+        f"Кэш: {cache_stats['entries']} записей, {cache_stats['bytes'] / 1024 / 1024:.1f} МБ · "
+        f"попаданий {cache_stats.get('hits', 0)}, промахов {cache_stats.get('misses', 0)}"
+    )
     
     st.divider()
     
-    if st.button("🗑️ Очистить кэш", use_container_width=True):
+    if st.button("🗑️ Очистить кэш", width="stretch"):
         st.cache_data.clear()
+        result_cache.clear()
+        job_executor.forget_finished()
         st.success("Кэш очищен!")
         time.sleep(1)
         st.rerun()
 
-# ==================== ГЛАВНЫЙ ИНТЕРФЕЙС ====================
-st.title("⚖️ LegalAI Enterprise Pro")
-st.markdown('<div class="limit-warning">⚠️ Работает в режиме Google AI Studio Free Tier. Строгие лимиты: ~1000 запросов/день</div>', unsafe_allow_html=True)
+# Боковая панель с информацией о лимитах
+with st.sidebar:
+    st.header("⚙️ Конфигурация")
+    quota_panel()
+    
+    # Настройки: от них зависят все вкладки, поэтому их смена перезапускает страницу целиком
+    role = st.radio("Анализ для:", ROLES)
+    loc = st.selectbox("Юрисдикция:", JURISDICTIONS)
+    # Индекс общий для процесса, поэтому дело задается явно: без него анализы не индексируются
+    matter = st.text_input("Дело / проект:", placeholder="Например: Поставка, ООО «Ромашка»",
+                           help="Анализы индексируются по делу; генерация берет из индекса только "
+                                "релевантные фрагменты. Без названия дела индекс не используется").strip()
+    
+    # Оптимизация запросов
+    st.subheader("Оптимизация")
+    use_cache = st.checkbox("Использовать кэш", value=True, 
+                           help="Повторный анализ того же документа с теми же настройками не тратит запросы")
+    prescreen = st.checkbox("Предварительный скрининг", value=True,
+                            help="Локальная проверка по красным флагам: модели уходят только отмеченные пункты, "
+                                 "документы без флагов не тратят запросы, высокий риск — весь документ")
+    cache_panel()
 
-# Вкладки
-tab1, tab2, tab3 = st.tabs(["🚀 Анализ", "🔍 Сравнение", "📋 Генерация"])
+# ==================== ВКЛАДКИ ====================
+# Каждая вкладка — фрагмент: действия внутри нее перезапускают только ее, а не весь скрипт.
+# Страница целиком перезапускается при смене настроек и по завершении фоновой задачи.
 
-with tab1:
+@st.fragment
+def analysis_tab(role, loc, use_cache, prescreen, matter):
+    """Анализ одного документа: загрузка, скрининг, фоновый анализ"""
     col1, col2 = st.columns([1, 1.2])
     
     with col1:
@@ -324,33 +3227,95 @@ with tab1:
         # Выбор типа ввода
         input_type = st.radio("Источник:", ["Файл", "Текст", "URL"], horizontal=True)
         
-        input_data, is_image = None, False
+        input_data, is_image, input_title = None, False, None
         
         if input_type == "Файл":
-            file = st.file_uploader("Загрузите документ", type=["pdf", "docx", "txt", "png", "jpg"])
+            file = st.file_uploader("Загрузите документ", type=["pdf", "docx", "txt", "png", "jpg", "jpeg", "webp"])
             if file:
+                input_title = file.name
                 if file.type.startswith("image"):
                     input_data, is_image = file.getvalue(), True
                     st.image(file, width=300)
+                    # Подготовка сразу при загрузке; анализ возьмет результат из кэша клиента
+                    try:
+                        prepared = gemini_client.prepared_image(input_data)
+                        st.info(
+                            f"К отправке: {prepared.payload_bytes // 1024} КБ вместо "
+                            f"{prepared.source_bytes // 1024} КБ, фрагментов: {len(prepared.parts)}, "
+                            f"~{prepared.tokens} токенов"
+                        )
+                    except Exception:
+                        st.error("Не удалось прочитать изображение")
+                        input_data, is_image = None, False
                 else:
-                    with st.spinner("Извлекаю текст..."):
-                        input_data = extract_text_cached(file.getvalue(), file.name)
-                        st.info(f"Извлечено: {len(input_data)} символов")
+                    # Извлечение с прогрессом по страницам; результат живет до смены файла
+                    file_bytes = file.getvalue()
+                    digest = content_digest(file_bytes)
+                    extracted = st.session_state.get("extracted")
+                    session_hit = bool(extracted) and extracted["digest"] == digest
+                    metrics.inc("legalai_cache_requests_total", cache="session_extracted",
+                                result="hit" if session_hit else "miss")
+                    if not session_hit:
+                        progress = st.progress(0.0, text="Извлекаю текст...")
+                        pages, errors, elapsed = [], [], 0.0
+                        for page in iter_document_pages(file_bytes, file.name):
+                            elapsed += page.elapsed
+                            if page.error:
+                                errors.append(f"стр. {page.number}: {page.error}")
+                            if page.text.strip():
+                                pages.append(page.text)
+                            if page.total:
+                                progress.progress(
+                                    page.number / page.total,
+                                    text=f"Извлекаю текст... {page.number}/{page.total}"
+                                )
+                        progress.empty()
+                        extracted = {
+                            "digest": digest, "text": compact_document(pages),
+                            "raw_tokens": estimate_tokens("\n".join(pages)),
+                            "pages": len(pages), "errors": errors, "elapsed": elapsed
+                        }
+                        st.session_state["extracted"] = extracted
+                    input_data = extracted["text"]
+                    st.info(
+                        f"Извлечено: {len(input_data)} символов (~{estimate_tokens(input_data)} токенов "
+                        f"из ~{extracted['raw_tokens']} до сжатия), частей: {extracted['pages']}, "
+                        f"{extracted['elapsed']:.1f} сек"
+                    )
+                    if extracted["errors"]:
+                        with st.expander(f"⚠️ Ошибки извлечения: {len(extracted['errors'])}"):
+                            st.write("\n".join(f"- {e}" for e in extracted["errors"]))
         
         elif input_type == "Текст":
-            input_data = st.text_area("Введите текст:", height=200)
+            input_data = compact_text(st.text_area("Введите текст:", height=200))
+            input_title = f"Текст от {datetime.now():%d.%m.%Y %H:%M}"
             if input_data:
-                st.info(f"Длина: {len(input_data)} символов")
+                st.info(f"Длина: {len(input_data)} символов (~{estimate_tokens(input_data)} токенов)")
         
         else:  # URL
             url = st.text_input("URL документа:")
+            input_title = url.strip()
             if url:
-                try:
-                    response = requests.get(url, timeout=10)
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    input_data = soup.get_text()[:20000]  # Лимит
-                except:
-                    st.error("Ошибка загрузки URL")
+                # Текст страницы кэшируется: повторные перезапуски скрипта не качают ее заново
+                input_data, error = url_fetcher.fetch(url.strip())
+                if error:
+                    st.error(error)
+                else:
+                    st.info(f"Загружено: {len(input_data)} символов (~{estimate_tokens(input_data)} токенов)")
+        
+        # Локальный скрининг: миллисекунды, без запросов к модели
+        screen = None
+        if input_data and not is_image:
+            screen = screen_document_cached(input_data, role, loc)
+            with st.expander(f"🧮 Скрининг: риск {screen.level} ({screen.score}/100), "
+                             f"отмечено пунктов {len(screen.clauses)} из {screen.total_clauses}"):
+                if screen.categories:
+                    st.markdown("\n".join(f"- {c}: {n}" for c, n in screen.categories.items()))
+                for clause in screen.clauses[:30]:
+                    st.markdown(f'<div class="risk-card">{highlight_clause(clause)}</div>', unsafe_allow_html=True)
+                if len(screen.clauses) > 30:
+                    st.caption(f"И еще пунктов: {len(screen.clauses) - 30}")
+                st.caption(f"Проверка заняла {screen.elapsed * 1000:.0f} мс")
         
         # Проверка лимитов перед активацией кнопки
         daily_remaining = 1000 - limit_manager.daily_requests
@@ -363,7 +3328,7 @@ with tab1:
             "🚀 Запустить анализ", 
             disabled=not can_make_request,
             type="primary" if can_make_request else "secondary",
-            use_container_width=True
+            width="stretch"
         )
         
         if not can_make_request and daily_remaining <= 0:
@@ -373,74 +3338,56 @@ with tab1:
         st.subheader("Результаты")
         
         if analyze_btn and input_data:
-            # Создаем уникальный хеш для кэширования
-            prompt_text = f"Анализ для {role} в {loc}"
-            content_hash = hashlib.md5(f"{prompt_text}_{input_data[:1000]}".encode()).hexdigest()
+            # Адрес результата: полный документ + роль, юрисдикция, версия промпта и модели
+            content, mode = input_data, "full"
+            if prescreen and screen is not None:
+                content, mode = screened_content(input_data, screen)
+            analysis_key = cache_key("analysis", input_data, role=role, loc=loc, mode=mode)
             
-            # Проверяем кэш если включено
-            cache_key = f"analysis_{content_hash}"
-            if use_cache and cache_key in st.session_state:
-                result = st.session_state[cache_key]
+            # Анализ идет в фоне: переживает перезапуски скрипта и закрытие вкладки
+            remember_job("analysis", job_executor.submit(
+                "analysis", f"{analysis_key}:{matter}", analysis_job,
+                content, is_image, mode, screen, role, loc, use_cache, analysis_key,
+                matter, input_title, None if is_image else input_data,
+                reuse_finished=use_cache
+            ))
+        
+        analysis = current_job("analysis")
+        if analysis and analysis.status not in JOB_FINISHED:
+            watch_job(analysis.id)
+        elif analysis:
+            if analysis.message == "Из кэша":
                 st.markdown('<div class="cache-badge">Из кэша</div>', unsafe_allow_html=True)
-            else:
-                with st.spinner(f"Анализирую (осталось {daily_remaining-1} запросов)..."):
-                    # Оптимизация промпта для экономии токенов
-                    prompt = f"""
-                    Роль: {role}. Страна: {loc}. 
-                    Выдели: 
-                    1. Главные риски (🔴)
-                    2. Финансовые аспекты (💸)  
-                    3. Проблемные пункты (⚠️)
-                    Кратко, по делу. MAX 500 слов.
-                    """
-                    
-                    result, error = call_gemini_with_limits(
-                        content_hash, prompt, 
-                        input_data[:30000] if optimize_text and len(input_data) > 30000 else input_data,
-                        is_image
-                    )
-                    
-                    if error:
-                        st.error(error)
-                        result = None
-                    elif result and use_cache:
-                        st.session_state[cache_key] = result
-            
-            if result:
-                # Отображение результата
-                lines = result.split('\n')
-                for line in lines:
-                    if '🔴' in line or '💸' in line or '⚠️' in line:
-                        st.markdown(f'<div class="risk-card">{line}</div>', unsafe_allow_html=True)
-                    else:
-                        st.markdown(line)
+            elif analysis.message:
+                st.caption(analysis.message)
+            if analysis.error:
+                st.error(analysis.error)
+            if analysis.result:
+                st.session_state["audit_result"] = analysis.result
+                st.markdown(render_report(analysis.result), unsafe_allow_html=True)
+                for title, text in analysis.details:
+                    with st.expander(title, expanded=False):
+                        st.markdown(text)
                 
-                # Кнопка скачивания
-                if st.button("📥 Сохранить отчет", use_container_width=True):
-                    doc = Document()
-                    doc.add_heading("Анализ документа", 0)
-                    doc.add_paragraph(result)
-                    bio = io.BytesIO()
-                    doc.save(bio)
-                    st.download_button(
-                        label="Скачать DOCX",
-                        data=bio.getvalue(),
-                        file_name="analysis.docx",
-                        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-                    )
-        
-        elif not analyze_btn:
+                st.download_button(
+                    "📥 Сохранить отчет", report_docx(analysis.result), file_name="analysis.docx",
+                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                    width="stretch"
+                )
+        else:
             st.info("Загрузите документ и нажмите кнопку для анализа")
             st.markdown("""
             **Оптимизация для Free Tier:**
             - Кэширование результатов
-            - Автосокращение длинных текстов  
+            - Анализ длинных текстов по частям
             - Приоритизация моделей
             - Лимит вывода: 2000 токенов
             """)
 
-with tab2:
-    st.subheader("Сравнение документов (оптимизировано)")
+@st.fragment
+def compare_tab(role, loc, use_cache):
+    """Сравнение двух редакций договора по пунктам"""
+    st.subheader("Сравнение документов по пунктам")
     
     col_a, col_b = st.columns(2)
     with col_a:
@@ -449,21 +3396,53 @@ with tab2:
         file_b = st.file_uploader("Документ B", type=["pdf", "docx"], key="fb")
     
     if st.button("⚖️ Сравнить", disabled=not (file_a and file_b)):
-        with st.spinner("Сравниваю..."):
-            # Используем кэшированное извлечение
-            text_a = extract_text_cached(file_a.getvalue(), file_a.name)[:15000]
-            text_b = extract_text_cached(file_b.getvalue(), file_b.name)[:15000]
-            
-            prompt = "Сравни два документа, выдели только ключевые различия в таблице. Кратко."
-            content = f"ДОК А:\n{text_a}\n\nДОК Б:\n{text_b}"
-            
-            content_hash = hashlib.md5(f"compare_{text_a[:500]}_{text_b[:500]}".encode()).hexdigest()
-            result, error = call_gemini_with_limits(content_hash, prompt, content)
+        # Локальное выравнивание пунктов: в модель уходят только различия
+        bytes_a, bytes_b = file_a.getvalue(), file_b.getvalue()
+        compare_key = cache_key(
+            "compare", content_digest(bytes_a) + content_digest(bytes_b), role=role, loc=loc
+        )
+        remember_job("compare", job_executor.submit(
+            "compare", compare_key, compare_job,
+            (bytes_a, file_a.name), (bytes_b, file_b.name), role, loc, use_cache,
+            reuse_finished=use_cache
+        ))
+    
+    comparison = current_job("compare")
+    if comparison and comparison.status not in JOB_FINISHED:
+        watch_job(comparison.id)
+    elif comparison and comparison.result:
+        diffs = comparison.result["diffs"]
+        counts = {status: sum(1 for d in diffs if d.status == status)
+                  for status in ("identical", "changed", "added", "removed")}
+        c1, c2, c3, c4 = st.columns(4)
+        c1.metric("Совпадают", counts["identical"])
+        c2.metric("Изменены", counts["changed"])
+        c3.metric("Добавлены", counts["added"])
+        c4.metric("Удалены", counts["removed"])
+        
+        changes = [d for d in diffs if d.status != "identical"]
+        if not changes:
+            st.success("Редакции совпадают по содержанию пунктов")
+        else:
+            status_labels = {"changed": "✏️ изменен", "added": "➕ добавлен", "removed": "➖ удален"}
+            with st.expander(f"Различающиеся пункты: {len(changes)}"):
+                for diff in changes:
+                    st.markdown(f"**{status_labels[diff.status]}** {('п. ' + diff.label) if diff.label else ''}")
+                    if diff.status == "changed":
+                        st.markdown(word_diff_markdown(diff.old, diff.new))
+                    else:
+                        st.markdown(diff.new or f"~~{diff.old}~~")
             
-            if result:
-                st.markdown(result)
+            if comparison.error:
+                st.error(comparison.error)
+            if comparison.result["summary"]:
+                st.markdown(comparison.result["summary"])
+    elif comparison:
+        st.error(comparison.error)
 
-with tab3:
+@st.fragment
+def generation_tab(use_cache, matter):
+    """Генерация документов по фрагментам из индекса дела"""
     st.subheader("Генерация документов")
     
     if 'audit_result' in st.session_state:
@@ -473,16 +3452,184 @@ with tab3:
                        placeholder="Например: составь протокол разногласий на основе анализа",
                        height=100)
     
+    if matter:
+        indexed_documents, indexed_passages = passage_index.stats(matter)
+        st.caption(f"Индекс дела «{matter}»: документов {indexed_documents}, фрагментов {indexed_passages}")
+    else:
+        st.caption("Дело не указано: генерация использует только результат последнего анализа")
+    
     if st.button("📝 Сгенерировать", disabled=not task):
-        with st.spinner("Генерирую..."):
-            context = st.session_state.get('audit_result', '')
-            prompt = f"{task}. Будь кратким. MAX 300 слов."
-            
-            content_hash = hashlib.md5(f"generate_{task}_{context[:500]}".encode()).hexdigest()
-            result, error = call_gemini_with_limits(content_hash, prompt, context[:10000])
-            
-            if result:
-                st.markdown(result)
+        # В промпт идут только релевантные фрагменты дела, а не документы целиком
+        audit_result = st.session_state.get('audit_result', '')
+        passages = passage_index.search(matter, f"{task}\n{audit_result}") if matter else []
+        st.session_state["generation_passages"] = passages
+        context = passages_context(passages) if passages else truncate_to_tokens(audit_result, CONTEXT_TOKENS)
+        prompt = f"{truncate_to_tokens(task, 300)}. Будь кратким. MAX 300 слов."
+        remember_job("generate", job_executor.submit(
+            "generate", cache_key("generate", context, prompt=prompt), generation_job,
+            prompt, context, use_cache,
+            reuse_finished=use_cache
+        ))
+    
+    generation = current_job("generate")
+    if generation and generation.status not in JOB_FINISHED:
+        watch_job(generation.id)
+    elif generation:
+        if generation.error:
+            st.error(generation.error)
+        if generation.result:
+            st.markdown(generation.result)
+        passages = st.session_state.get("generation_passages")
+        if passages:
+            with st.expander(f"📚 Контекст: фрагментов {len(passages)} из документов "
+                             f"{len({p.title for p in passages})}, "
+                             f"~{sum(estimate_tokens(p.text) for p in passages)} токенов"):
+                for passage in passages:
+                    st.markdown(f"**{passage.title}** · BM25 {passage.score:.1f}")
+                    st.text(passage.text)
+
+@st.fragment
+def batch_tab(role, loc, prescreen, matter):
+    """Пакетный аудит набора договоров"""
+    st.subheader("Пакетный аудит")
+    st.caption("Договоры или ZIP-архивы data room. Повторный запуск того же набора продолжает прерванное задание.")
+    
+    batch_files = st.file_uploader(
+        "Документы", type=["pdf", "docx", "txt", "zip"], accept_multiple_files=True, key="batch_files"
+    )
+    
+    if st.button("📦 Запустить пакетный аудит", disabled=not batch_files):
+        files = [(f.name, f.getvalue()) for f in batch_files]
+        batch_key = cache_key(
+            "batch", "".join(name + content_digest(data) for name, data in files),
+            role=role, loc=loc, prescreen=prescreen, matter=matter
+        )
+        # Готовое задание не переиспользуется: повторный запуск дозапускает ошибочные документы
+        remember_job("batch", job_executor.submit(
+            "batch", batch_key, batch_job, files, role, loc, prescreen, matter, reuse_finished=False
+        ))
+    
+    batch = current_job("batch")
+    if batch and batch.status not in JOB_FINISHED:
+        watch_job(batch.id)
+    elif batch and batch.error:
+        st.error(batch.error)
+    elif batch:
+        job_id = batch.result
+        items = batch_store.items(job_id)
+        done_count = sum(1 for item in items if item[1] == "done")
+        st.success(f"Задание {job_id}: готово {done_count} из {len(items)}")
+        st.dataframe(
+            [{"Документ": name, "Статус": status, "Символов": chars or 0, "Ошибка": error or ""}
+             for name, status, chars, _, error in items],
+            width="stretch"
+        )
+        col_csv, col_docx = st.columns(2)
+        with col_csv:
+            st.download_button("📥 Отчет CSV", batch_report_csv(job_id), file_name=f"batch_{job_id}.csv",
+                               mime="text/csv", width="stretch")
+        with col_docx:
+            st.download_button("📥 Отчет DOCX", batch_report_docx(job_id), file_name=f"batch_{job_id}.docx",
+                               mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                               width="stretch")
+
+@st.fragment
+def metrics_tab():
+    """Метрики процесса; кнопка обновляет только эту вкладку"""
+    col_title, col_refresh = st.columns([4, 1])
+    col_title.subheader("Метрики процесса")
+    col_refresh.button("🔄 Обновить", width="stretch")
+    st.caption(
+        "С момента запуска сервера. Для Prometheus задайте LEGALAI_METRICS_PORT: "
+        "счетчики будут доступны по адресу http://узел:порт/metrics."
+    )
+    counters, histograms = metrics.snapshot()
+    
+    def counter_sum(name, **match):
+        return sum(value for (metric, pairs), value in counters.items()
+                   if metric == name and all(dict(pairs).get(k) == v for k, v in match.items()))
+    
+    col_calls, col_tokens, col_backoff = st.columns(3)
+    col_calls.metric("Запросов к API", sum(h["count"] for (name, _), h in histograms.items()
+                                           if name == "legalai_api_request_seconds"))
+    col_tokens.metric("Токенов (вход / выход)",
+                      f"{metrics.format_value(counter_sum('legalai_api_tokens_total', kind='prompt'))} / "
+                      f"{metrics.format_value(counter_sum('legalai_api_tokens_total', kind='output'))}")
+    col_backoff.metric("Ожидание квоты, сек", f"{counter_sum('legalai_backoff_sleep_seconds_total'):.1f}")
+    
+    st.markdown("**Модели**")
+    model_rows = []
+    for model in FREE_TIER_CONFIG["models"]:
+        hists = [h for (name, pairs), h in histograms.items()
+                 if name == "legalai_api_request_seconds" and dict(pairs)["model"] == model]
+        ok = [h for (name, pairs), h in histograms.items()
+              if name == "legalai_api_request_seconds" and dict(pairs) == {"model": model, "outcome": "ok"}]
+        outcomes = {dict(pairs)["outcome"]: h["count"] for (name, pairs), h in histograms.items()
+                    if name == "legalai_api_request_seconds" and dict(pairs)["model"] == model}
+        model_rows.append({
+            "Модель": model,
+            "Запросов": sum(h["count"] for h in hists),
+            "Исходы": ", ".join(f"{k}: {v}" for k, v in sorted(outcomes.items())) or "—",
+            "p50 / p95 (ok), сек": f"≤{metrics.quantile(ok[0], 0.5):g} / ≤{metrics.quantile(ok[0], 0.95):g}" if ok else "—",
+            "Повторы": int(counter_sum("legalai_api_retries_total", model=model)),
+            "Переходы дальше": int(counter_sum("legalai_api_fallbacks_total", model=model)),
+            "Токены вход/выход": f"{metrics.format_value(counter_sum('legalai_api_tokens_total', model=model, kind='prompt'))} / "
+                                 f"{metrics.format_value(counter_sum('legalai_api_tokens_total', model=model, kind='output'))}",
+        })
+    st.dataframe(model_rows, width="stretch", hide_index=True)
+    
+    col_extract, col_caches = st.columns(2)
+    with col_extract:
+        st.markdown("**Извлечение текста**")
+        extract_rows = []
+        for (name, pairs), hist in sorted(histograms.items()):
+            if name != "legalai_extract_page_seconds":
+                continue
+            fmt = dict(pairs)["format"]
+            extract_rows.append({
+                "Формат": fmt, "Страниц": hist["count"],
+                "Ошибок": int(counter_sum("legalai_extract_errors_total", format=fmt)),
+                "Среднее, мс": round(1000 * hist["sum"] / hist["count"], 1) if hist["count"] else 0,
+                "p95, мс": f"≤{1000 * metrics.quantile(hist, 0.95):g}",
+            })
+        st.dataframe(extract_rows, width="stretch", hide_index=True)
+    with col_caches:
+        st.markdown("**Кэши**")
+        cache_rows = {}
+        for (name, pairs), value in counters.items():
+            if name == "legalai_cache_requests_total":
+                labels = dict(pairs)
+                cache_rows.setdefault(labels["cache"], {})[labels["result"]] = int(value)
+        st.dataframe([
+            {"Кэш": cache, "Попаданий": hits.get("hit", 0) + hits.get("revalidated", 0),
+             "Промахов": hits.get("miss", 0),
+             "Доля попаданий": f"{(hits.get('hit', 0) + hits.get('revalidated', 0)) / max(1, sum(hits.values())):.0%}"}
+            for cache, hits in sorted(cache_rows.items())
+        ], width="stretch", hide_index=True)
+    
+    with st.expander("Текст для Prometheus"):
+        st.code(metrics.render_prometheus(), language="text")
+
+# ==================== ГЛАВНЫЙ ИНТЕРФЕЙС ====================
+st.title("⚖️ LegalAI Enterprise Pro")
+st.markdown('<div class="limit-warning">⚠️ Работает в режиме Google AI Studio Free Tier. Строгие лимиты: ~1000 запросов/день</div>', unsafe_allow_html=True)
+
+# Вкладки: выбранная отслеживается, метрики собираются, только пока их вкладка открыта
+tab1, tab2, tab3, tab4, tab5 = st.tabs(
+    ["🚀 Анализ", "🔍 Сравнение", "📋 Генерация", "📦 Пакет", "📊 Метрики"], key="main_tab", on_change="rerun"
+)
+
+with tab1:
+    analysis_tab(role, loc, use_cache, prescreen, matter)
+with tab2:
+    compare_tab(role, loc, use_cache)
+with tab3:
+    generation_tab(use_cache, matter)
+with tab4:
+    batch_tab(role, loc, prescreen, matter)
+with tab5:
+    if tab5.open:
+        metrics_tab()
 
 # ==================== ФУТЕР С ИНФОРМАЦИЕЙ О ЛИМИТАХ ====================
 st.divider()
@@ -496,8 +3643,7 @@ with col_info3:
 
 # Скрипт для автоматического сброса счетчика в 08:00 UTC
 if st.button("🔄 Обновить счетчик лимитов (тест)"):
-    limit_manager.daily_requests = 0
-    limit_manager.last_reset = datetime.utcnow()
+    limit_manager.reset_daily()
     st.success("Счетчик сброшен!")
     time.sleep(1)
     st.rerun()
@@ -0,0 +1,349 @@
+# Офлайн-бенчмарк LegalAI: синтетические договоры и локальная замена Gemini API.
+# Запуск: python app.py bench (конвейер приложения передается в run_benchmark явно)
+import hashlib
+import io
+import json
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class MockGeminiServer:
+    """Локальная замена generateContent/streamGenerateContent для офлайн-замеров.
+
+    Задержка ответа складывается из базовой, доли на объем входа и случайного
+    разброса; часть запросов получает 429 с Retry-After или зависает дольше
+    таймаута клиента. count_tokens — оценка токенов входа (по умолчанию ~4 символа).
+    """
+
+    def __init__(self, latency=0.3, jitter=0.1, per_1k_tokens=0.02, rate_429=0.0, retry_after=1,
+                 timeout_rate=0.0, hang=5.0, stream_chunks=8, seed=0, count_tokens=None):
+        from http.server import ThreadingHTTPServer
+        self.count_tokens = count_tokens or (lambda text: max(1, len(text) // 4))
+        self.latency = latency
+        self.jitter = jitter
+        self.per_1k_tokens = per_1k_tokens
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.stream_chunks = stream_chunks
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="mock-gemini", daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/v1beta"
+
+    def calls(self):
+        """Всего обращений к серверу (включая 429 и зависшие)"""
+        with self.lock:
+            return sum(self.counts.values())
+
+    def _count(self, outcome):
+        with self.lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+
+    def _outcome(self):
+        with self.lock:
+            roll = self.random.random()
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if roll < self.rate_429:
+            return "429", delay
+        if roll < self.rate_429 + self.timeout_rate:
+            return "timeout", delay
+        return "200", delay
+
+    def _answer(self, prompt_text):
+        """Ответ в формате отчета: несколько строк рисков, зависящих от входа"""
+        seed = hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()[:6]
+        return "\n".join([
+            f"🔴 Риск {seed}: одностороннее расторжение без компенсации",
+            f"💸 Штраф {int(seed, 16) % 50 + 1}% от суммы договора",
+            "⚠️ Срок ответа на претензию не указан",
+            "Рекомендация: согласовать протокол разногласий",
+        ])
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        from http.server import BaseHTTPRequestHandler
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, headers=()):
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                prompt_text = "".join(
+                    part.get("text", "") for part in payload.get("contents", [{}])[0].get("parts", [])
+                )
+                outcome, delay = mock._outcome()
+                mock._count(outcome)
+                if outcome == "429":
+                    self._send(429, {"error": {"message": "Resource exhausted"}},
+                               [("Retry-After", str(mock.retry_after))])
+                    return
+                if outcome == "timeout":
+                    time.sleep(mock.hang)
+                    self.close_connection = True
+                    return
+                prompt_tokens = mock.count_tokens(prompt_text)
+                time.sleep(delay + mock.per_1k_tokens * prompt_tokens / 1000)
+                text = mock._answer(prompt_text)
+                usage = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": mock.count_tokens(text)}
+                if ":streamGenerateContent" not in self.path:
+                    self._send(200, {"candidates": [{"content": {"parts": [{"text": text}]}}],
+                                     "usageMetadata": usage})
+                    return
+                # SSE частями через chunked-кодирование, как у настоящего API
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                step = -(-len(text) // mock.stream_chunks)
+                pieces = [text[i:i + step] for i in range(0, len(text), step)]
+                for number, piece in enumerate(pieces, 1):
+                    event = {"candidates": [{"content": {"parts": [{"text": piece}]}}]}
+                    if number == len(pieces):
+                        event["usageMetadata"] = usage
+                    data = f"data: {json.dumps(event, ensure_ascii=False)}\r\n\r\n".encode("utf-8")
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    self.wfile.flush()
+                    time.sleep(mock.latency * 0.1)
+                self.wfile.write(b"0\r\n\r\n")
+
+        return Handler
+
+BENCH_CLAUSES_EN = [
+    "The Tenant shall pay a penalty of {n}% of the monthly rent for each day of delay.",
+    "The Landlord may terminate this Agreement unilaterally with {n} days notice.",
+    "All disputes shall be resolved by the arbitration court at the Landlord location.",
+    "The Contractor is liable for damages not exceeding {n} percent of the contract price.",
+    "Confidential information shall not be disclosed for {n} years after termination.",
+    "Payment is due within {n} business days after the invoice is received.",
+]
+BENCH_CLAUSES_RU = [
+    "Арендатор уплачивает неустойку {n}% от месячной платы за каждый день просрочки.",
+    "Арендодатель вправе расторгнуть договор в одностороннем порядке, уведомив за {n} дней.",
+    "Споры рассматриваются в арбитражном суде по месту нахождения Арендодателя.",
+    "Ответственность Исполнителя ограничена {n} процентами от цены договора.",
+    "Конфиденциальная информация не раскрывается в течение {n} лет после расторжения.",
+    "Оплата производится в течение {n} рабочих дней с момента получения счета.",
+]
+
+def write_pdf(pages):
+    """Минимальный PDF (Helvetica, ASCII): одна текстовая колонка на страницу"""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(len(pages)))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>")
+    font = 3 + 2 * len(pages)
+    for number, text in enumerate(pages):
+        lines = " ".join(
+            "({}) Tj T*".format(line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)"))
+            for line in text.split("\n")
+        )
+        stream = f"BT /F1 9 Tf 12 TL 40 800 Td {lines} ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       f"/Resources << /Font << /F1 {font} 0 R >> >> /Contents {4 + 2 * number} 0 R >>")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    out, offsets = bytearray(b"%PDF-1.4\n"), []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{obj}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+def write_docx(pages):
+    """DOCX с разрывами страниц и таблицей реквизитов"""
+    from docx import Document
+    document = Document()
+    for number, text in enumerate(pages, 1):
+        for line in text.split("\n"):
+            document.add_paragraph(line)
+        if number % 5 == 0:
+            table = document.add_table(rows=2, cols=2)
+            for row, (name, value) in enumerate([("Сторона", f"ООО Ромашка-{number}"), ("ИНН", str(7700000000 + number))]):
+                table.cell(row, 0).text, table.cell(row, 1).text = name, value
+        document.add_page_break()
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+def bench_corpus(page_counts, per_size=2, seed=0):
+    """Синтетические договоры растущего объема: (имя, байты, страниц), PDF и DOCX поочередно"""
+    rng = random.Random(seed)
+    for pages in page_counts:
+        for index in range(per_size):
+            is_pdf = index % 2 == 0
+            clauses = BENCH_CLAUSES_EN if is_pdf else BENCH_CLAUSES_RU
+            title = f"Contract {pages}-{index}" if is_pdf else f"Договор № {pages}-{index}"
+            texts, clause = [], 1
+            for page in range(1, pages + 1):
+                lines = [title]
+                for _ in range(12):
+                    lines.append(f"{clause}. " + rng.choice(clauses).format(n=rng.randint(1, 90)))
+                    clause += 1
+                lines.append(f"- {page} -")
+                texts.append("\n".join(lines))
+            data = write_pdf(texts) if is_pdf else write_docx(texts)
+            yield f"contract_{pages:03d}p_{index}.{'pdf' if is_pdf else 'docx'}", data, pages
+
+def percentiles(samples):
+    """p50/p95/p99 и максимум по ближайшему рангу, в секундах"""
+    if not samples:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    ordered = sorted(samples)
+    rank = lambda q: ordered[min(len(ordered) - 1, max(0, -(-len(ordered) * q // 100) - 1))]
+    return {"p50": rank(50), "p95": rank(95), "p99": rank(99), "max": ordered[-1]}
+
+def peak_rss_mb():
+    """Пиковый RSS процесса и дочерних процессов извлечения (только Unix)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+# Метрика -> (больше значит лучше, изменение меньше этого считается шумом)
+BENCH_REGRESSION_KEYS = {
+    "throughput_docs_per_s": (True, 0.0),
+    "extract_cold.p95": (False, 0.05),
+    "analyze_cold.p95": (False, 0.05),
+    "analyze_warm.p95": (False, 0.05),
+    "api_calls_per_doc": (False, 0.0),
+    "peak_rss_mb": (False, 5.0),
+}
+
+def _bench_value(report, key):
+    value = report
+    for name in key.split("."):
+        value = value.get(name) if isinstance(value, dict) else None
+    return value
+
+def bench_regressions(report, baseline, tolerance):
+    """Метрики, ухудшившиеся относительно базового прогона больше чем на tolerance"""
+    problems = []
+    for key, (higher_is_better, noise) in BENCH_REGRESSION_KEYS.items():
+        now, before = _bench_value(report, key), _bench_value(baseline, key)
+        if not now or not before:
+            continue
+        change = (before - now) / before if higher_is_better else (now - before) / before
+        if change > tolerance and abs(now - before) > noise:
+            problems.append(f"{key}: {before} -> {now} (хуже на {change:.0%})")
+    if report.get("errors", 0) > baseline.get("errors", 0):
+        problems.append(f"errors: {baseline.get('errors', 0)} -> {report['errors']}")
+    return problems
+
+def run_benchmark(make_pipeline, page_counts=(2, 10, 40), per_size=2, concurrency=4, client_timeout=5.0,
+                  seed=0, labels=None, **mock_options):
+    """Прогон корпуса через конвейер приложения против MockGeminiServer.
+
+    make_pipeline(url, data_dir) возвращает (extract(байты, имя) -> текст,
+    analyze(текст) -> ошибка или None, close()) со своими лимитами, кэшем и
+    клиентом: close освобождает клиент после замера, data_dir — временный
+    каталог, удаляется после замера. labels дополняют раздел config отчета
+    (например, stream и limits_scale).
+    """
+    mock = MockGeminiServer(hang=client_timeout + 1, seed=seed, **mock_options)
+    data_dir = tempfile.mkdtemp(prefix="legalai-bench-")
+    close = None
+    
+    try:
+        extract, analyze_text, close = make_pipeline(mock.url, data_dir)
+        
+        def analyze(text):
+            started = time.perf_counter()
+            error = analyze_text(text)
+            return time.perf_counter() - started, error
+        
+        corpus = list(bench_corpus(page_counts, per_size, seed))
+        timings = {name: [] for name in ("extract_cold", "extract_warm", "analyze_cold", "analyze_warm")}
+        texts = []
+        for name, data, _ in corpus:
+            for phase in ("extract_cold", "extract_warm"):
+                started = time.perf_counter()
+                text = extract(data, name)
+                timings[phase].append(time.perf_counter() - started)
+            texts.append(text)
+        
+        errors = 0
+        calls_before = mock.calls()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for elapsed, error in pool.map(analyze, texts):
+                timings["analyze_cold"].append(elapsed)
+                errors += bool(error)
+        wall = time.perf_counter() - started
+        cold_calls = mock.calls() - calls_before
+        
+        for text in texts:
+            elapsed, error = analyze(text)
+            timings["analyze_warm"].append(elapsed)
+            errors += bool(error)
+        
+        report = {
+            "config": {"pages": list(page_counts), "docs_per_size": per_size, "concurrency": concurrency,
+                       **(labels or {}), "latency": mock.latency,
+                       "rate_429": mock.rate_429, "timeout_rate": mock.timeout_rate, "seed": seed},
+            "documents": len(corpus),
+            "pages": sum(pages for _, _, pages in corpus),
+            "throughput_docs_per_s": round(len(corpus) / wall, 3),
+            "api_calls": cold_calls,
+            "api_calls_per_doc": round(cold_calls / len(corpus), 2),
+            "warm_api_calls": mock.calls() - calls_before - cold_calls,
+            "responses": dict(mock.counts),
+            "errors": errors,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        for phase, samples in timings.items():
+            report[phase] = {k: round(v, 4) for k, v in percentiles(samples).items()}
+        return report
+    finally:
+        if close is not None:
+            close()
+        mock.close()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+def format_bench_report(report):
+    """Сводка прогона для консоли"""
+    lines = [
+        f"Документов: {report['documents']} ({report['pages']} стр.), "
+        f"пропускная способность: {report['throughput_docs_per_s']} док/с",
+        f"Вызовов API: {report['api_calls']} ({report['api_calls_per_doc']} на документ), "
+        f"повторный прогон: {report['warm_api_calls']}, ответы: {report['responses']}",
+        f"Ошибок: {report['errors']}, пиковый RSS: {report['peak_rss_mb']} МБ",
+        f"{'Этап':<14}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  (сек)",
+    ]
+    for phase in ("extract_cold", "extract_warm", "analyze_cold", "analyze_warm"):
+        stats = report[phase]
+        lines.append(f"{phase:<14}" + "".join(f"{stats[k]:>9.3f}" for k in ("p50", "p95", "p99", "max")))
+    return "\n".join(lines)
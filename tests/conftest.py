@@ -0,0 +1,140 @@
+import atexit
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# app.py при импорте открывает базы в DATA_DIR: тесты не трогают рабочий каталог .legalai
+os.environ["LEGALAI_DATA_DIR"] = tempfile.mkdtemp(prefix="legalai-tests-")
+atexit.register(shutil.rmtree, os.environ["LEGALAI_DATA_DIR"], True)
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(scope="session")
+def app():
+    import app as module
+    return module
+
+@pytest.fixture
+def config(app):
+    """Копия лимитов Free Tier, которую тест может менять"""
+    return json.loads(json.dumps(app.FREE_TIER_CONFIG))
+
+@pytest.fixture
+def limiter(app, config, tmp_path):
+    return app.RateLimitManager(str(tmp_path / "quota.sqlite3"), config)
+
+class LocalServer:
+    """HTTP-сервер на 127.0.0.1 со случайным портом; handle(request) отвечает на запрос"""
+
+    def __init__(self, handle):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                handle(self)
+
+            def do_POST(self):
+                self.body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                handle(self)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def send(request, status, body=b"", headers=()):
+    """Ответ с телом и Content-Length"""
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode("utf-8")
+        headers = (("Content-Type", "application/json"),) + tuple(headers)
+    request.send_response(status)
+    for name, value in headers:
+        request.send_header(name, value)
+    request.send_header("Content-Length", str(len(body)))
+    request.end_headers()
+    request.wfile.write(body)
+
+@pytest.fixture
+def serve():
+    """serve(handle) -> LocalServer; серверы закрываются после теста"""
+    servers = []
+
+    def start(handle):
+        servers.append(LocalServer(handle))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
+
+class GeminiStub:
+    """Замена generateContent: ответы по моделям из очереди, по умолчанию 200"""
+
+    def __init__(self, serve, delay=0.0):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.scripts = {}
+        self.calls = []
+        self.server = serve(self._handle)
+        self.url = self.server.url + "/v1beta"
+
+    def script(self, model, *responses):
+        """Очередь ответов модели: (код, заголовки); после нее — успешный ответ"""
+        self.scripts[model] = list(responses)
+
+    def _handle(self, request):
+        model = request.path.split("/models/")[1].split(":")[0]
+        with self.lock:
+            self.calls.append(model)
+            queue = self.scripts.get(model)
+            status, headers = queue.pop(0) if queue else (200, ())
+        time.sleep(self.delay)
+        if status == 200:
+            send(request, 200, {"candidates": [{"content": {"parts": [{"text": f"ответ {model}"}]}}],
+                                "usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": 2}})
+        else:
+            send(request, status, {"error": {"message": f"status {status}"}}, headers)
+
+def call(app, backend, content="Договор поставки", max_retries=2):
+    """Один запрос к модели через submit_gemini_with_limits: (результат, ошибка)"""
+    return app.submit_gemini_with_limits("Проверь договор", content, max_retries=max_retries,
+                                         backend=backend).result(timeout=60)
+
+@pytest.fixture
+def gemini(serve):
+    return GeminiStub(serve)
+
+@pytest.fixture
+def make_client(app, limiter):
+    """make_client(url) -> GeminiClient; клиенты закрываются после теста"""
+    clients = []
+
+    def make(url, timeout=5):
+        clients.append(app.GeminiClient(limiter, url, timeout=timeout, api_key="test"))
+        return clients[-1]
+
+    yield make
+    for client in clients:
+        client.close()
+
+@pytest.fixture
+def backend(app, limiter, gemini, make_client, tmp_path):
+    """Изолированный GeminiBackend против GeminiStub"""
+    return app.GeminiBackend(limiter, app.ResultCache(str(tmp_path / "cache.sqlite3")),
+                             make_client(gemini.url), app.SingleFlight())
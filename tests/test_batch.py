@@ -0,0 +1,30 @@
+import pytest
+
+CLEAN = "1. Стороны договорились о поставке товара.\n2. Товар передается по накладной.".encode("utf-8")
+
+@pytest.fixture
+def store(app, tmp_path):
+    return app.BatchStore(str(tmp_path / "batch.sqlite3"))
+
+def test_same_set_and_settings_resume_the_same_job(store):
+    items = [("d1", "a.txt"), ("d2", "b.txt")]
+    assert store.create_job("Заказчик", "РФ", items) == store.create_job("Заказчик", "РФ", items[::-1])
+
+def test_prescreen_setting_starts_a_separate_job(store):
+    items = [("d1", "a.txt")]
+    assert store.create_job("Заказчик", "РФ", items) != store.create_job("Заказчик", "РФ", items, prescreen=False)
+
+def test_rerun_without_prescreen_sends_clean_document_to_model(app, monkeypatch, store):
+    monkeypatch.setattr(app, "batch_store", store)
+    sent = []
+
+    def analyze(prompt, content, **options):
+        sent.append(content)
+        yield "final", None, 1, "🔴 Анализ модели", None
+
+    monkeypatch.setattr(app, "analyze_document_chunked", analyze)
+    screened = app.run_batch([("a.txt", CLEAN)], app.ROLES[1], app.JURISDICTIONS[0], prescreen=True)
+    assert not sent and store.items(screened)[0][1] == "done"
+    full = app.run_batch([("a.txt", CLEAN)], app.ROLES[1], app.JURISDICTIONS[0], prescreen=False)
+    assert full != screened
+    assert len(sent) == 1 and store.items(full)[0][3] == "🔴 Анализ модели"
@@ -0,0 +1,35 @@
+def clause(number, words=10):
+    """Пункт договора примерно на 60 токенов"""
+    return f"{number}. Поставщик обязуется " + " ".join(["поставить товар"] * words) + ".\n"
+
+def test_chunks_fit_budget_and_start_at_clause_boundaries(app):
+    text = "".join(clause(i) for i in range(1, 13))
+    chunks = app.split_into_chunks(text, max_tokens=120)
+    assert len(chunks) > 1
+    assert "".join(chunks) == text
+    for chunk in chunks:
+        assert app.estimate_tokens(chunk) <= 120
+        assert app.CLAUSE_BOUNDARY.match(chunk)
+
+def test_oversized_clause_is_split_by_sentences(app):
+    text = "Статья 1 " + " ".join(f"Предложение номер {i} о сроках поставки." for i in range(60))
+    chunks = app.split_into_chunks(text, max_tokens=50)
+    assert len(chunks) > 1
+    assert all(app.estimate_tokens(chunk) <= 50 for chunk in chunks)
+
+def test_reduce_folds_results_until_they_fit_one_request(app, backend, gemini):
+    results = [f"Риски фрагмента {i}: штраф {i}% за просрочку" for i in range(1, 21)]
+    material, error = app.reduce_chunk_results(results, max_tokens=60, backend=backend)
+    assert error is None
+    assert app.estimate_tokens(material) <= 60
+    # Промежуточные свертки были: двадцать анализов в 60 токенов не помещаются
+    assert len(gemini.calls) > 1
+
+def test_chunked_analysis_maps_every_part_and_reduces_once(app, backend, gemini):
+    text = "".join(clause(i) for i in range(1, 4))
+    events = list(app.analyze_document_chunked("Проверь договор", text, max_tokens=80, backend=backend))
+    chunks = sorted(index for stage, index, _, _, error in events if stage == "chunk" and not error)
+    assert chunks == [1, 2, 3]
+    stage, _, total, report, error = events[-1]
+    assert (stage, total, error) == ("final", 3, None) and report
+    assert len(gemini.calls) == 4
@@ -0,0 +1,30 @@
+def statuses(diffs):
+    return [(diff.status, diff.label) for diff in diffs]
+
+def test_identical_documents_have_no_changes(app):
+    text = "1. Предмет договора: поставка товара.\n2. Цена 100 рублей."
+    assert statuses(app.diff_clauses(text, text)) == [("identical", "1"), ("identical", "2")]
+
+def test_one_word_edit_in_short_clause_is_changed(app):
+    old = "1. Предмет договора: поставка товара.\n2. Оплата в течение 10 дней.\n3. Срок действия один год."
+    new = "1. Предмет договора: поставка товара.\n2. Оплата в течение 30 дней.\n3. Срок действия один год."
+    diffs = app.diff_clauses(old, new)
+    assert statuses(diffs) == [("identical", "1"), ("changed", "2"), ("identical", "3")]
+    assert app.word_diff_markdown(diffs[1].old, diffs[1].new) == "2. Оплата в течение ~~10~~ **30** дней."
+
+def test_renumbered_clauses_are_paired(app):
+    clauses = ["Поставщик передает товар покупателю в месте нахождения склада поставщика.",
+               "Покупатель оплачивает товар в течение десяти рабочих дней после приемки.",
+               "Споры рассматриваются в арбитражном суде по месту нахождения истца."]
+    old = "\n".join(f"{i}. {text}" for i, text in enumerate(clauses, 1))
+    new = "\n".join(f"{i}. {text}" for i, text in enumerate(["Термины и определения."] + clauses, 1))
+    diffs = app.diff_clauses(old, new)
+    assert [diff.status for diff in diffs].count("added") == 1
+    assert [diff.status for diff in diffs].count("removed") == 0
+    changed = [diff for diff in diffs if diff.status == "changed"]
+    assert len(changed) == 3 and all(diff.old.split(". ", 1)[1] == diff.new.split(". ", 1)[1] for diff in changed)
+
+def test_added_and_removed_clauses(app):
+    old = "1. Предмет договора.\n2. Неустойка 1% в день за просрочку оплаты по договору."
+    new = "1. Предмет договора.\n2. Конфиденциальность сведений о сделке сохраняется пять лет."
+    assert sorted(statuses(app.diff_clauses(old, new))) == [("added", "2"), ("identical", "1"), ("removed", "2")]
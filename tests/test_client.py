@@ -0,0 +1,54 @@
+import socket
+
+from conftest import call
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def test_429_cools_model_down_and_falls_back(app, backend, gemini, limiter):
+    gemini.script("gemini-2.5-flash-lite", (429, [("Retry-After", "30")]))
+    result, error = call(app, backend)
+    assert error is None
+    assert gemini.calls[0] == "gemini-2.5-flash-lite"
+    assert result == f"ответ {gemini.calls[-1]}" and gemini.calls[-1] != "gemini-2.5-flash-lite"
+    assert 25 < limiter.get_wait_time("gemini-2.5-flash-lite") <= 30
+
+def test_5xx_is_retried(app, backend, gemini):
+    gemini.script("gemini-2.5-flash-lite", (503, ()))
+    result, error = call(app, backend)
+    assert error is None and result
+    assert len(gemini.calls) == 2
+
+def test_4xx_from_every_model_is_rejected(app, backend, gemini):
+    for model in app.FREE_TIER_CONFIG["models"]:
+        gemini.script(model, (400, ()), (400, ()))
+    assert call(app, backend) == (None, app.ERROR_REJECTED)
+    # Отклоненная модель не пробуется повторно
+    assert sorted(gemini.calls) == sorted(app.FREE_TIER_CONFIG["models"])
+
+def test_connection_error_is_not_rejected_or_negative_cached(app, backend, limiter, make_client):
+    client = make_client(f"http://127.0.0.1:{closed_port()}/v1beta", timeout=2)
+    backend = backend._replace(client=client)
+    result, error = call(app, backend, max_retries=1)
+    assert result is None
+    assert error not in app.DETERMINISTIC_ERRORS
+    assert "недоступны" in error
+    assert not backend.flights.failures
+    # Сетевой сбой охлаждает модель, как таймаут
+    assert limiter.get_wait_time("gemini-2.5-flash-lite") > 0
+
+def test_cached_call_does_not_charge_quota(app, backend, gemini, limiter):
+    assert call(app, backend)[1] is None
+    assert call(app, backend)[1] is None
+    assert len(gemini.calls) == 1 and limiter.daily_requests == 1
+
+def test_close_stops_loop_and_http_threads(app, backend):
+    assert call(app, backend)[1] is None
+    client = backend.client
+    threads = [client.loop_thread, *client.executor._threads]
+    client.close()
+    assert client.loop.is_closed() and not [thread for thread in threads if thread.is_alive()]
+    # Повторный вызов (фикстура закрывает клиент еще раз) безопасен
+    client.close()
@@ -0,0 +1,24 @@
+def test_number_sign_and_superscripts_survive(app):
+    text = app.compact_text("Договор № 15 от 01.02.2024, площадь 40 м²")
+    assert text == "Договор № 15 от 01.02.2024, площадь 40 м²"
+
+def test_lone_numeric_first_line_is_kept(app):
+    assert app.compact_text("2024\nДоговор аренды помещения") == "2024\nДоговор аренды помещения"
+
+def test_repeated_headers_and_page_numbers_are_removed(app):
+    pages = [f"ООО «Ромашка» — Договор поставки\nПункт {i} о поставке товара.\nСтр. {i} из 4" for i in range(1, 5)]
+    text = app.compact_document(pages)
+    assert "Ромашка" not in text and "Стр." not in text
+    assert [line for line in text.splitlines()] == [f"Пункт {i} о поставке товара." for i in range(1, 5)]
+
+def test_ligatures_soft_hyphens_and_line_wraps_are_joined(app):
+    text = app.compact_text("The ﬁnal of­fer is bind-\ning for the\nparties.")
+    assert text == "The final offer is binding for the parties."
+
+def test_repeated_boilerplate_paragraph_is_kept_once(app):
+    boilerplate = "Стороны обязуются соблюдать конфиденциальность сведений, полученных при исполнении договора."
+    text = app.compact_text(f"{boilerplate}\nПункт 1.\n{boilerplate}\nПункт 2.")
+    assert text.count(boilerplate) == 1 and "Пункт 2." in text
+
+def test_prompt_indentation_is_dropped(app):
+    assert app.compact_prompt("\n    Роль: юрист\n\n    Кратко.\n") == "Роль: юрист\nКратко."
@@ -0,0 +1,20 @@
+import threading
+
+import bench
+
+def test_large_pdf_streams_pages_in_order_without_extra_processes(app):
+    data = bench.write_pdf([f"Page {n} text" for n in range(1, 61)])
+    threads = threading.active_count()
+    pages = list(app.iter_document_pages(data, "contract.pdf"))
+    assert [page.number for page in pages] == list(range(1, 61))
+    assert all(page.total == 60 and page.error is None for page in pages)
+    assert pages[41].text.strip() == "Page 42 text"
+    assert threading.active_count() == threads
+
+def test_broken_pdf_reports_error(app):
+    page, = app.iter_document_pages(b"%PDF-1.4 not really", "broken.pdf")
+    assert page.error and page.total == 0
+
+def test_unsupported_format_is_reported(app):
+    page, = app.iter_document_pages(b"data", "scan.djvu")
+    assert "Неподдерживаемый формат" in page.error
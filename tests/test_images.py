@@ -0,0 +1,59 @@
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+def covered_rows(tiles, image):
+    """Строки исходного изображения, попавшие хотя бы в одну часть (по вертикальной полосе)"""
+    rows = set()
+    for tile in tiles:
+        top = tile.getpixel((0, 0))[0] * 256 + tile.getpixel((0, 0))[1]
+        rows.update(range(top, top + tile.size[1]))
+    return rows
+
+def striped(width, height):
+    """Изображение, в котором номер строки закодирован в цвете первого столбца"""
+    image = Image.new("RGB", (width, height), "white")
+    for y in range(height):
+        image.putpixel((0, y), (y // 256, y % 256, 0))
+    return image
+
+@pytest.mark.parametrize("height", [1000, 2500, 6000, 20000])
+def test_tall_scan_tiles_cover_every_row(app, height):
+    image = striped(1000, height)
+    tiles = app._split_tall(image)
+    assert len(tiles) <= app.IMAGE_MAX_TILES
+    assert covered_rows(tiles, image) == set(range(height))
+
+def test_tiles_of_capped_scan_overlap(app):
+    tiles = app._split_tall(striped(1000, 20000))
+    assert len(tiles) == app.IMAGE_MAX_TILES
+    tops = [tile.getpixel((0, 0))[0] * 256 + tile.getpixel((0, 0))[1] for tile in tiles]
+    assert all(top + tile.size[1] > next_top for top, tile, next_top in zip(tops, tiles, tops[1:]))
+
+@pytest.mark.parametrize("image", [
+    Image.new("RGBA", (40, 40), (0, 0, 0, 0)),
+    Image.new("LA", (40, 40), (0, 0)),
+])
+def test_transparent_areas_become_white(app, image):
+    frame, = app._image_frames(image)
+    assert frame.mode in ("RGB", "L")
+    assert frame.getpixel((0, 0)) in ((255, 255, 255), 255)
+
+def test_palette_transparency_becomes_white(app):
+    image = Image.new("P", (40, 40), 0)
+    image.putpalette([0, 0, 0] * 256)
+    image.info["transparency"] = 0
+    frame, = app._image_frames(image)
+    assert frame.getpixel((0, 0)) == (255, 255, 255)
+
+def test_prepare_image_downscales_and_reencodes(app):
+    buffer = io.BytesIO()
+    Image.new("RGB", (4000, 3000), "white").save(buffer, "PNG")
+    prepared = app.prepare_image(buffer.getvalue())
+    assert len(prepared.parts) == 1
+    mime, data = prepared.parts[0]
+    with Image.open(io.BytesIO(base64.b64decode(data))) as result:
+        assert max(result.size) <= app.IMAGE_MAX_SIDE
+    assert prepared.tokens > 0
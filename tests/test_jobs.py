@@ -0,0 +1,51 @@
+import threading
+import time
+
+import pytest
+
+@pytest.fixture
+def executor(app):
+    executor = app.JobExecutor(workers=2)
+    yield executor
+    executor.pool.shutdown(wait=True)
+
+def wait(executor, job_id):
+    for _ in range(200):
+        job = executor.get(job_id)
+        if job.status in ("done", "error"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError("задача не завершилась")
+
+def test_identical_running_job_is_reused(executor):
+    release = threading.Event()
+
+    def slow(job):
+        release.wait(5)
+        return "итог", None
+
+    first = executor.submit("analysis", "k", slow)
+    assert executor.submit("analysis", "k", slow, reuse_finished=False) == first
+    release.set()
+    assert wait(executor, first).result == "итог"
+
+def test_finished_job_is_reused_until_cache_is_cleared(executor):
+    runs = []
+
+    def work(job):
+        runs.append(1)
+        return f"итог {len(runs)}", None
+
+    first = executor.submit("analysis", "k", work)
+    wait(executor, first)
+    assert executor.submit("analysis", "k", work) == first
+    executor.forget_finished()
+    # Открытая страница по-прежнему видит старую задачу
+    assert executor.get(first).result == "итог 1"
+    second = executor.submit("analysis", "k", work)
+    assert second != first and wait(executor, second).result == "итог 2"
+
+def test_failed_job_is_not_reused(executor):
+    first = executor.submit("analysis", "k", lambda job: (None, "сбой"))
+    assert wait(executor, first).status == "error"
+    assert executor.submit("analysis", "k", lambda job: ("итог", None)) != first
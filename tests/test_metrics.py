@@ -0,0 +1,24 @@
+def test_large_counters_are_rendered_without_exponent(app):
+    metrics = app.Metrics()
+    metrics.inc("legalai_api_tokens_total", 1234568, model="m", kind="prompt")
+    metrics.inc("legalai_backoff_sleep_seconds_total", 0.1)
+    metrics.inc("legalai_backoff_sleep_seconds_total", 0.2)
+    text = metrics.render_prometheus()
+    assert 'legalai_api_tokens_total{kind="prompt",model="m"} 1234568\n' in text
+    assert f"legalai_backoff_sleep_seconds_total {0.1 + 0.2!r}\n" in text
+    assert "e+" not in text
+
+def test_histogram_exposition_is_cumulative(app):
+    metrics = app.Metrics()
+    for seconds in (0.001, 0.2, 100):
+        metrics.observe("legalai_extract_page_seconds", seconds, format="pdf")
+    lines = metrics.render_prometheus().splitlines()
+    assert 'legalai_extract_page_seconds_bucket{format="pdf",le="0.005"} 1' in lines
+    assert 'legalai_extract_page_seconds_bucket{format="pdf",le="60"} 2' in lines
+    assert 'legalai_extract_page_seconds_bucket{format="pdf",le="+Inf"} 3' in lines
+    assert 'legalai_extract_page_seconds_count{format="pdf"} 3' in lines
+
+def test_format_value(app):
+    assert app.Metrics.format_value(1234568.0) == "1234568"
+    assert app.Metrics.format_value(7) == "7"
+    assert app.Metrics.format_value(2.5) == "2.5"
@@ -0,0 +1,32 @@
+import pytest
+
+@pytest.fixture
+def index(app, tmp_path):
+    return app.PassageIndex(str(tmp_path / "index.sqlite3"))
+
+def test_search_is_scoped_to_matter(index):
+    index.add("дело-1", "a", "Договор аренды", "🔴 Неустойка 1% в день за просрочку арендной платы.")
+    index.add("дело-2", "b", "Договор поставки", "🔴 Неустойка за просрочку поставки товара.")
+    found = index.search("дело-1", "неустойка за просрочку")
+    assert [passage.title for passage in found] == ["Договор аренды"]
+    assert index.search("дело-3", "неустойка") == []
+
+def test_analysis_and_source_clauses_are_both_indexed(index):
+    assert index.add("дело", "a", "Договор аренды", "Риск: односторонний отказ арендодателя.",
+                     "5. Арендодатель вправе отказаться от договора в одностороннем порядке.")
+    kinds = {passage.kind for passage in index.search("дело", "односторонний отказ")}
+    assert kinds == {"analysis", "clause"}
+    # Повторное добавление того же ключа пропускается
+    assert not index.add("дело", "a", "Договор аренды", "Риск: односторонний отказ арендодателя.")
+    assert index.stats("дело") == (1, 2)
+
+def test_search_respects_token_budget(app, index):
+    for i in range(10):
+        index.add("дело", f"k{i}", f"Договор {i}", f"Штраф за нарушение сроков оплаты, вариант {i}. " * 20)
+    found = index.search("дело", "штраф сроков оплаты", max_tokens=400)
+    assert found and sum(app.estimate_tokens(passage.text) for passage in found) <= 400
+    assert len(index.search("дело", "штраф", k=3)) == 3
+
+def test_query_without_terms_returns_nothing(index):
+    index.add("дело", "a", "Договор", "Текст анализа.")
+    assert index.search("дело", "?!") == []
@@ -0,0 +1,53 @@
+def test_rpm_is_shared_between_connections(app, config, tmp_path):
+    for cfg in config["models"].values():
+        cfg["rpm"] = 2
+    path = str(tmp_path / "quota.sqlite3")
+    first = app.RateLimitManager(path, config)
+    second = app.RateLimitManager(path, config)
+    model = "gemini-2.5-flash"
+    assert first.acquire([model], 100) == (model, 0)
+    assert second.acquire([model], 100) == (model, 0)
+    chosen, wait = first.acquire([model], 100)
+    assert chosen is None and 0 < wait <= 60
+    # Вторая модель со своим окном по-прежнему доступна
+    assert second.acquire([model, "gemini-2.0-flash-lite"], 100) == ("gemini-2.0-flash-lite", 0)
+
+def test_cooldown_is_visible_to_other_connection(app, config, tmp_path):
+    path = str(tmp_path / "quota.sqlite3")
+    first = app.RateLimitManager(path, config)
+    second = app.RateLimitManager(path, config)
+    first.cool_down("gemini-2.5-flash-lite", 30)
+    chosen, wait = second.acquire(["gemini-2.5-flash-lite"], 10)
+    assert chosen is None and 25 < wait <= 30
+
+def test_daily_limit_is_shared_between_connections(app, config, tmp_path):
+    config["global_limits"]["daily_request_limit"] = 3
+    path = str(tmp_path / "quota.sqlite3")
+    first = app.RateLimitManager(path, config)
+    second = app.RateLimitManager(path, config)
+    assert [first.check_daily_limit(), second.check_daily_limit(), first.check_daily_limit()] == [True] * 3
+    assert not second.check_daily_limit()
+    assert first.daily_requests == second.daily_requests == 3
+
+def test_model_rpd_is_shared_between_connections(app, config, tmp_path):
+    config["models"]["gemini-2.5-flash"]["rpd"] = 1
+    path = str(tmp_path / "quota.sqlite3")
+    first = app.RateLimitManager(path, config)
+    second = app.RateLimitManager(path, config)
+    assert first.acquire(["gemini-2.5-flash"], 10) == ("gemini-2.5-flash", 0)
+    # Дневная квота исчерпана: ждать в пределах суток бессмысленно
+    assert second.acquire(["gemini-2.5-flash"], 10) == (None, None)
+
+def test_ledger_survives_restart(app, config, tmp_path):
+    path = str(tmp_path / "quota.sqlite3")
+    first = app.RateLimitManager(path, config)
+    assert first.acquire(["gemini-2.5-flash"], 10) == ("gemini-2.5-flash", 0)
+    assert first.check_daily_limit()
+    first.cool_down("gemini-2.5-flash-lite", 30)
+    first.conn.close()
+    # Новый процесс (или перезапуск Streamlit) видит ту же квоту и паузы
+    restarted = app.RateLimitManager(path, config)
+    assert restarted.daily_requests == 1
+    assert restarted.get_wait_time("gemini-2.5-flash-lite") > 25
+    rpd = config["models"]["gemini-2.5-flash"]["rpd"]
+    assert restarted.headroom(["gemini-2.5-flash"])["gemini-2.5-flash"][1] == rpd - 1
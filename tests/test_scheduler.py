@@ -0,0 +1,58 @@
+import pytest
+
+@pytest.fixture
+def scheduler(app, limiter):
+    return app.ModelScheduler(limiter)
+
+@pytest.fixture
+def models(config):
+    """Модели от высшего приоритета к низшему"""
+    return sorted(config["models"], key=lambda model: config["models"][model]["priority"])
+
+def test_without_statistics_models_follow_priority(scheduler, models):
+    assert scheduler.rank(models, 100) == (models, 0)
+
+def test_fast_model_outranks_slow_one(scheduler, models):
+    first, last = models[0], models[-1]
+    for _ in range(3):
+        scheduler.record(first, True, 20.0)
+        scheduler.record(last, True, 0.5)
+    ranked, wait = scheduler.rank(models, 100)
+    assert wait == 0 and ranked[0] == last and ranked[-1] == first
+
+def test_failing_model_is_ranked_lower(scheduler, models):
+    first = models[0]
+    for ok in (True, False, True, False, True):
+        scheduler.record(first, ok, 8.0)
+    ranked, _ = scheduler.rank(models, 100)
+    assert ranked[-1] == first
+
+def test_breaker_opens_after_consecutive_failures_and_probes_once(app, scheduler, models, monkeypatch):
+    first = models[0]
+    for _ in range(3):
+        scheduler.record(first, False, 0.0)
+    assert scheduler.snapshot()[first]["state"] == "open"
+    assert first not in scheduler.rank(models, 100)[0]
+    # Только открытые модели: ждать до пробы предохранителя
+    ranked, wait = scheduler.rank([first], 100)
+    assert ranked == [] and 25 < wait <= 30
+
+    now = app.time.time()
+    monkeypatch.setattr(app.time, "time", lambda: now + 31)
+    assert scheduler.rank([first], 100) == ([first], 0)
+    scheduler.begin(first)
+    # Пока идет проба, других запросов к модели нет
+    assert scheduler.rank([first], 100)[0] == []
+    scheduler.record(first, True, 1.0)
+    assert scheduler.snapshot()[first]["state"] == "closed"
+
+def test_failed_probe_reopens_breaker_for_longer(app, scheduler, models, monkeypatch):
+    first = models[0]
+    for _ in range(3):
+        scheduler.record(first, False, 0.0)
+    now = app.time.time()
+    monkeypatch.setattr(app.time, "time", lambda: now + 31)
+    scheduler.begin(first)
+    scheduler.record(first, False, 0.0)
+    _, wait = scheduler.rank([first], 100)
+    assert 55 < wait <= 60
@@ -0,0 +1,37 @@
+CLEAN = ("1. Предмет договора: исполнитель оказывает услуги по уборке помещения.\n"
+         "2. Стоимость услуг составляет 10 000 рублей в месяц.\n"
+         "3. Договор составлен в двух экземплярах.\n")
+
+RISKY = ("1. Предмет договора: поставка оборудования.\n"
+         "2. За просрочку оплаты начисляется неустойка 1% в день.\n"
+         "3. Поставщик вправе в одностороннем порядке изменить цену товара.\n"
+         "4. Договор составлен в двух экземплярах.\n")
+
+def test_clean_document_is_not_sent_to_model(app):
+    screen = app.screen_document(CLEAN, "Юрист", "РФ")
+    assert screen.score == 0 and not screen.clauses and screen.total_clauses == 3
+    assert app.screened_content(CLEAN, screen) == (None, "clean")
+
+def test_risky_clauses_are_flagged_and_highlighted(app):
+    screen = app.screen_document(RISKY, "Юрист", "РФ")
+    assert [clause.label for clause in screen.clauses] == ["2", "3"]
+    assert screen.clauses[0].categories == ("Неустойка и штрафы",)
+    assert "Одностороннее расторжение или изменение" in screen.clauses[1].categories
+    start, end = screen.clauses[0].spans[0]
+    assert screen.clauses[0].text[start:end] == "неустойк"
+    assert "<mark>неустойк</mark>" in app.highlight_clause(screen.clauses[0])
+
+def test_flagged_excerpt_or_full_text_depends_on_score(app):
+    screen = app.screen_document(RISKY + CLEAN * 3, "Юрист", "РФ")
+    content, mode = app.screened_content(RISKY + CLEAN * 3, screen)
+    assert mode == "flagged" and "неустойка" in content and "уборке" not in content
+    heavy = RISKY * 4
+    assert app.screened_content(heavy, app.screen_document(heavy, "Юрист", "РФ"))[1] == "full"
+
+def test_role_and_jurisdiction_change_weights(app):
+    text = "1. Договор автоматически продлевается на следующий год.\n2. Сумма 100 у.е.\n"
+    lawyer = app.screen_document(text, "Юрист", "РФ")
+    person = app.screen_document(text, "Физическое лицо", "РФ")
+    assert person.score > lawyer.score
+    assert "Валютная оговорка" in lawyer.categories
+    assert "Валютная оговорка" not in app.screen_document(text, "Юрист", "Международная").categories
@@ -0,0 +1,59 @@
+import threading
+
+from conftest import GeminiStub, call
+
+def test_flight_shares_leader_result_with_waiters(app):
+    flights = app.SingleFlight()
+    future, leader = flights.begin("k")
+    waiter, follower = flights.begin("k")
+    assert leader and not follower and waiter is future
+    flights.finish("k", "итог")
+    assert waiter.result(timeout=1) == ("итог", None)
+    assert flights.begin("k")[1]
+
+def test_only_deterministic_errors_are_remembered(app, monkeypatch):
+    flights = app.SingleFlight(negative_ttl=60)
+    flights.begin("плохой")
+    flights.finish("плохой", None, app.ERROR_REJECTED)
+    flights.begin("сеть")
+    flights.finish("сеть", None, "⚠️ Модели недоступны")
+    future, leader = flights.begin("плохой")
+    assert not leader and future.result() == (None, app.ERROR_REJECTED)
+    assert flights.begin("сеть")[1]
+    # По истечении negative_ttl запрос снова доходит до API
+    now = app.time.monotonic()
+    monkeypatch.setattr(app.time, "monotonic", lambda: now + 61)
+    assert flights.begin("плохой")[1]
+
+def test_rejected_request_is_not_sent_again(app, backend, gemini, limiter):
+    for model in app.FREE_TIER_CONFIG["models"]:
+        gemini.script(model, (400, ()), (400, ()))
+    assert call(app, backend) == (None, app.ERROR_REJECTED)
+    calls, requests_today = len(gemini.calls), limiter.daily_requests
+    assert call(app, backend) == (None, app.ERROR_REJECTED)
+    assert len(gemini.calls) == calls and limiter.daily_requests == requests_today
+
+def test_identical_concurrent_calls_share_one_request_and_one_quota_unit(app, backend, serve, limiter, make_client):
+    slow = GeminiStub(serve, delay=0.5)
+    backend = backend._replace(client=make_client(slow.url))
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(call(app, backend, "Один и тот же договор")))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 5 and len(set(results)) == 1 and results[0][1] is None
+    assert len(slow.calls) == 1
+    assert limiter.daily_requests == 1
+
+def test_leader_failure_before_request_releases_waiters(app, backend, gemini, monkeypatch):
+    def locked():
+        raise app.sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(backend.limiter, "check_daily_limit", locked)
+    assert call(app, backend) == (None, app.ERROR_INTERNAL)
+    assert not backend.flights.inflight
+    # Ключ не завис: следующий такой же вызов снова доходит до модели
+    monkeypatch.undo()
+    result, error = call(app, backend)
+    assert error is None and result and len(gemini.calls) == 1
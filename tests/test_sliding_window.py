@@ -0,0 +1,40 @@
+import pytest
+
+def test_sliding_window_waits_for_oldest_request_by_rpm(app):
+    window = app.SlidingWindow(rpm=2, tpm=1000)
+    window.add(100.0, 10)
+    window.add(110.0, 10)
+    assert not window.has_room(120.0, 10)
+    assert window.wait_time(120.0, 10) == pytest.approx(40.0)
+
+def test_sliding_window_waits_until_enough_tokens_expire(app):
+    window = app.SlidingWindow(rpm=10, tpm=100)
+    window.add(100.0, 60)
+    window.add(130.0, 30)
+    # Нужно 50 токенов: освободить хватит первого события (60), второе может остаться
+    assert window.wait_time(140.0, 50) == pytest.approx(20.0)
+    assert window.wait_time(140.0, 10) == 0.0
+
+def test_sliding_window_evicts_expired_events(app):
+    window = app.SlidingWindow(rpm=1, tpm=100)
+    window.add(100.0, 100)
+    assert window.wait_time(160.0, 100) == 0.0
+    assert window.tokens == 0
+
+def test_sliding_window_caps_request_above_tpm(app):
+    window = app.SlidingWindow(rpm=5, tpm=100)
+    # Запрос больше TPM ждет пустого окна, а не бесконечно
+    assert window.has_room(0.0, 500)
+
+def test_tokens_are_shared_between_connections(app, config, tmp_path):
+    for cfg in config["models"].values():
+        cfg["tpm"] = 1000
+    path = str(tmp_path / "quota.sqlite3")
+    first = app.RateLimitManager(path, config)
+    second = app.RateLimitManager(path, config)
+    model = "gemini-2.5-flash"
+    assert first.acquire([model], 700) == (model, 0)
+    # Окно TPM считает реальные токены, а не число запросов
+    chosen, wait = second.acquire([model], 400)
+    assert chosen is None and 0 < wait <= 60
+    assert second.acquire([model], 300) == (model, 0)
@@ -0,0 +1,76 @@
+import pytest
+
+from conftest import send
+
+PAGE = ("<html><head><meta charset='windows-1251'></head><body><nav>Главная | Поиск</nav>"
+        "<article>" + "".join(f"<p>Статья {i}. Арендатор уплачивает штраф {i}% за просрочку.</p>"
+                              for i in range(1, 30)) +
+        "</article><footer>© Портал</footer></body></html>").encode("cp1251")
+
+@pytest.fixture
+def site(serve):
+    """Страница с ETag, большой документ без Content-Length и картинка"""
+    site = serve(lambda request: handle(site, request))
+    site.requests = []
+    return site
+
+def handle(site, request):
+    site.requests.append((request.path, request.headers.get("If-None-Match")))
+    if request.path == "/page":
+        if request.headers.get("If-None-Match") == '"v1"':
+            send(request, 304)
+        else:
+            send(request, 200, PAGE, [("Content-Type", "text/html"), ("ETag", '"v1"')])
+    elif request.path == "/declared-big":
+        send(request, 200, b"x" * 4096, [("Content-Type", "text/plain")])
+    elif request.path == "/streamed-big":
+        # Без Content-Length: лимит должен сработать при чтении потока
+        request.send_response(200)
+        request.send_header("Content-Type", "text/plain")
+        request.send_header("Connection", "close")
+        request.end_headers()
+        for _ in range(64):
+            request.wfile.write(b"y" * 1024)
+        request.close_connection = True
+    elif request.path == "/image":
+        send(request, 200, b"\x89PNG", [("Content-Type", "image/png")])
+    else:
+        send(request, 404)
+
+@pytest.fixture
+def fetcher(app, tmp_path):
+    return app.UrlFetcher(str(tmp_path / "pages.sqlite3"), max_bytes=2048, fresh_seconds=300)
+
+def test_main_text_is_extracted_without_navigation(fetcher, site):
+    text, error = fetcher.fetch(site.url + "/page")
+    assert error is None
+    assert "Статья 1. Арендатор уплачивает штраф 1%" in text
+    assert "Главная" not in text and "Портал" not in text
+
+def test_fresh_page_is_served_without_network(fetcher, site):
+    first = fetcher.fetch(site.url + "/page")
+    assert fetcher.fetch(site.url + "/page") == first
+    assert len(site.requests) == 1
+
+def test_stale_page_is_revalidated_with_etag(fetcher, site):
+    first = fetcher.fetch(site.url + "/page")
+    fetcher.fresh_seconds = 0
+    assert fetcher.fetch(site.url + "/page") == first
+    assert site.requests == [("/page", None), ("/page", '"v1"')]
+
+def test_declared_length_over_cap_is_refused(fetcher, site):
+    text, error = fetcher.fetch(site.url + "/declared-big")
+    assert text is None and "больше" in error
+
+def test_stream_over_cap_is_cut_off(fetcher, site):
+    text, error = fetcher.fetch(site.url + "/streamed-big")
+    assert text is None and "больше" in error
+
+def test_unsupported_content_type_is_refused(fetcher, site):
+    text, error = fetcher.fetch(site.url + "/image")
+    assert text is None and "image/png" in error
+
+def test_http_error_and_scheme_are_reported(fetcher, site):
+    assert fetcher.fetch(site.url + "/missing") == (None, "Сервер вернул код 404")
+    text, error = fetcher.fetch("file:///etc/passwd")
+    assert text is None and "http" in error